@@ -0,0 +1,157 @@
+import html
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from fpwrapper import fingerprint
+
+logger = logging.getLogger(__name__)
+
+# seconds between batches of entries written, and between removals of expired entries
+FLUSH_INTERVAL = 5
+PRUNE_INTERVAL = 60 * 60
+# entries queued beyond which they are written without waiting for the interval
+FLUSH_SIZE = 1000
+# longest summary indexed, in characters
+MAX_SUMMARY = 4000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    feed TEXT,
+    fingerprint INTEGER,
+    link TEXT,
+    title TEXT,
+    published TEXT,
+    archived REAL,
+    UNIQUE (feed, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS entries_archived ON entries (archived);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_text USING fts5 (title, summary, tags);
+"""
+
+def _plain(text: str):
+    return html.unescape(re.sub(r"<[^>]*>", " ", text or ""))
+
+class EntryArchive(object):
+    """Keeps every entry polled from every feed, with a full-text index of their titles, summaries and tags
+
+    Entries are queued by the poll path and written in batches by a
+    background thread, once per feed however many chats follow it. Entries
+    older than max_age seconds, and the oldest beyond max_entries, are
+    removed periodically.
+    """
+    def __init__(self, filename: str, max_age: float = 30 * 24 * 60 * 60, max_entries: int = 1000000):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # raises sqlite3.OperationalError if SQLite was built without FTS5
+        self.db.executescript(SCHEMA)
+        self.queue = []
+        self.pruned = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, feed: str, entries: list):
+        """Queues entries of feed (by its canonical url) to be archived."""
+        with self._cond:
+            self.queue.append((feed, entries, time.time()))
+            if len(self.queue) >= FLUSH_SIZE:
+                self._cond.notify()
+
+    def search(self, terms: list, feeds: set, limit: int = 10):
+        """Returns (feed, link, title, published) of the entries of feeds best matching every one of terms."""
+        if not terms or not feeds:
+            return []
+        # terms are quoted so that they are matched as words, rather than as query syntax
+        query = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        feeds = sorted(feeds)
+        with self._lock:
+            return self.db.execute(
+                f"""
+                SELECT e.feed, e.link, e.title, e.published
+                FROM entries_text JOIN entries e ON e.id = entries_text.rowid
+                WHERE entries_text MATCH ? AND e.feed IN ({",".join("?" * len(feeds))})
+                ORDER BY rank LIMIT ?
+                """,
+                (query, *feeds, limit),
+            ).fetchall()
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="EntryArchive", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._lock:
+            self.db.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and len(self.queue) < FLUSH_SIZE:
+                    self._cond.wait(FLUSH_INTERVAL)
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+                if time.time() - self.pruned > PRUNE_INTERVAL:
+                    self.prune()
+            except sqlite3.Error:
+                logger.exception("Error while archiving entries")
+
+    def flush(self):
+        """Writes queued entries in a single transaction."""
+        with self._cond:
+            queue, self.queue = self.queue, []
+        if not queue:
+            return
+        with self._lock, self.db:
+            for feed, entries, archived in queue:
+                for entry in entries:
+                    # stored as a signed 64-bit integer, as SQLite does
+                    h = fingerprint(entry)
+                    h = h - (1 << 64) if h >= 1 << 63 else h
+                    cursor = self.db.execute(
+                        "INSERT OR IGNORE INTO entries (feed, fingerprint, link, title, published, archived) VALUES (?, ?, ?, ?, ?, ?)",
+                        (feed, h, entry.get("link", ""), entry.get("title", ""), entry.get("published", ""), archived),
+                    )
+                    if not cursor.rowcount:
+                        # archived already, e.g. through another url of the feed
+                        continue
+                    tags = " ".join(
+                        tag.get("term", "") or "" for tag in entry.get("tags", None) or ()
+                        if isinstance(tag, dict)
+                    )
+                    self.db.execute(
+                        "INSERT INTO entries_text (rowid, title, summary, tags) VALUES (?, ?, ?, ?)",
+                        (cursor.lastrowid, _plain(entry.get("title", "")), _plain(entry.get("summary", ""))[:MAX_SUMMARY], tags),
+                    )
+
+    def prune(self):
+        """Removes entries older than max_age, then the oldest beyond max_entries."""
+        self.pruned = time.time()
+        with self._lock, self.db:
+            # ids increase in the order entries were archived
+            oldest = self.db.execute(
+                "SELECT id FROM entries ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (self.max_entries,),
+            ).fetchone()
+            expired = "archived < ? OR id <= ?"
+            params = (time.time() - self.max_age, oldest[0] if oldest else 0)
+            self.db.execute(f"DELETE FROM entries_text WHERE rowid IN (SELECT id FROM entries WHERE {expired})", params)
+            removed = self.db.execute(f"DELETE FROM entries WHERE {expired}", params).rowcount
+        if removed:
+            logger.info("Removed %s entries from the archive", removed)
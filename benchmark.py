@@ -0,0 +1,385 @@
+"""Offline benchmark of the bot's polling and delivery pipeline
+
+Starts a synthetic feed server in a separate process, subscribes thousands
+of simulated chats to its feeds, and runs the FeedScheduler, fan_out,
+asap_update and digest_update against a stand-in for the Bot API which
+records the messages sent instead of sending them. No API token or network
+access is needed.
+
+    python benchmark.py --chats 5000 --feeds 2000 --duration 120
+
+Each run reports polls per second, the latency from an entry's publication
+to its message being sent, and the CPU time and peak memory used, and is
+appended to a JSON lines file (benchmark.jsonl by default) along with the
+commit it was run at, so that runs may be compared across commits.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent import futures
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bot
+from fetcher import AsyncFetcher, UrllibFetcher
+from fpwrapper import FeedCollection, registry
+from localconfig import envs
+from metrics import metrics
+from scheduler import FeedScheduler
+from sender import SendQueue
+
+# entries carry the time they were published in their link, which ends up in the message sent
+PUBLISHED = re.compile(r"published=([0-9.]+)")
+
+# synthetic feeds
+class SyntheticFeeds(object):
+    """Generates feeds which each publish an entry every update seconds, with a stable offset per feed"""
+    def __init__(self, feeds: int, entries: int, size: int, update: float, latency: float, errors: dict, start: float):
+        self.feeds = feeds
+        self.entries = entries
+        self.size = size
+        self.update = update
+        self.latency = latency
+        self.errors = errors
+        self.start = start
+
+    def latest(self, feed: int, now: float):
+        """Returns the number of the feed's latest entry, and when it was published."""
+        offset = (feed * 7919 % 1000) / 1000 * self.update
+        n = int((now - self.start - offset) // self.update)
+        return n, self.start + offset + n * self.update
+
+    def body(self, host: str, feed: int, now: float):
+        n, published = self.latest(feed, now)
+        padding = "x" * max(self.size // self.entries - 200, 0)
+        items = "".join(
+            f"<item><title>Entry {i} of feed {feed}</title>"
+            f"<link>http://{host}/{feed}/{i}?published={published - (n - i) * self.update:.3f}</link>"
+            f"<guid>{feed}-{i}</guid>"
+            f"<pubDate>{formatdate(published - (n - i) * self.update, usegmt=True)}</pubDate>"
+            f"<description>{padding}</description></item>"
+            for i in range(n, max(n - self.entries, -1), -1)
+        )
+        return n, (
+            f"<?xml version='1.0'?><rss version='2.0'><channel>"
+            f"<title>Feed {feed}</title><link>http://{host}/{feed}</link><description>Synthetic feed {feed}</description>"
+            f"{items}</channel></rss>"
+        ).encode("utf-8")
+
+class SyntheticHandler(BaseHTTPRequestHandler):
+    feeds = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.feeds.latency:
+            time.sleep(random.expovariate(1 / self.feeds.latency))
+        outcome = random.random()
+        for error, probability in self.feeds.errors.items():
+            outcome -= probability
+            if outcome < 0:
+                if error == "drop":
+                    self.close_connection = True
+                    return
+                self.send_response(int(error))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        try:
+            feed = int(self.path.strip("/").split("/")[0])
+        except ValueError:
+            feed = -1
+        if not 0 <= feed < self.feeds.feeds:
+            self.send_error(404)
+            return
+        n, body = self.feeds.body(self.headers.get("Host", ""), feed, time.time())
+        etag = f"\"{n}\""
+        if self.headers.get("If-None-Match", None) == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve_feeds(hosts: int, feeds: SyntheticFeeds, addresses, stopped):
+    """Entry point of the feed server's process, serving feeds on as many loopback addresses as hosts."""
+    handler = type("Handler", (SyntheticHandler,), {"feeds": feeds})
+    servers = []
+    for i in range(hosts):
+        server = ThreadingHTTPServer((f"127.0.0.{i + 1}", 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    addresses.put([ server.server_address for server in servers ])
+    stopped.wait()
+    for server in servers:
+        server.shutdown()
+
+# stand-ins for the bot's dispatcher and the Bot API
+class FakeBot(object):
+    """Records messages instead of sending them, taking latency seconds per call like the Bot API would"""
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.sent = [] # (time sent, chat_id, text)
+
+    def send_message(self, chat_id, text: str, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.sent.append((time.time(), chat_id, text))
+
+class FakeDispatcher(object):
+    """The parts of a telegram.ext.Dispatcher which callbacks use outside of handlers"""
+    use_context = True
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.chat_data = {}
+        self.user_data = {}
+        self.bot_data = {}
+        self.job_queue = None
+        self.persistence = None
+
+def subscribe(dispatcher: FakeDispatcher, addresses: list, chats: int, feeds: int, per_chat: int, asap: float):
+    """Creates chats as /start does, subscribing each to per_chat feeds spread over the hosts, returning the time taken to prepare the feeds."""
+    urls = [
+        f"http://{addresses[feed % len(addresses)][0]}:{addresses[feed % len(addresses)][1]}/{feed}"
+        for feed in range(feeds)
+    ]
+    started = time.perf_counter()
+    prepared = {}
+    for url, future in [ (url, registry.prepare(url)) for url in urls ]:
+        try:
+            prepared[url] = future.result()
+        except Exception:
+            prepared[url] = None
+    elapsed = time.perf_counter() - started
+    for chat_id in range(1, chats + 1):
+        dispatcher.chat_data[chat_id] = {
+            "feeds": {
+                "asap": FeedCollection([], owner=(chat_id, "asap")),
+                "digest": FeedCollection([], owner=(chat_id, "digest")),
+            },
+            "reprs": {},
+            "digesttime": datetime.time(0, 0, 0),
+        }
+        for url in random.sample(urls, min(per_chat, feeds)):
+            mode = "asap" if random.random() < asap else "digest"
+            dispatcher.chat_data[chat_id]["feeds"][mode].add_feed(url, prepared[url])
+    return elapsed
+
+def drain(queue: SendQueue, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = queue.stats()
+        if not stats["in_flight"] and not any(value for key, value in stats.items() if key.startswith("queued_")):
+            return True
+        time.sleep(0.1)
+    return False
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(q * len(values)), len(values) - 1)], 3)
+
+def fetches():
+    return {
+        dict(labels)["status"]: value
+        for (name, labels), value in metrics.snapshot()["counters"].items()
+        if name == "fetch_responses_total"
+    }
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    random.seed(args.seed)
+    feeds = SyntheticFeeds(
+        feeds=args.feeds,
+        entries=args.entries,
+        size=args.size,
+        update=args.update,
+        latency=args.latency,
+        errors=args.errors,
+        start=time.time() - args.entries * args.update,
+    )
+    context = multiprocessing.get_context("spawn")
+    addresses, stopped = context.Queue(), context.Event()
+    server = context.Process(target=serve_feeds, args=(args.hosts, feeds, addresses, stopped), daemon=True)
+    server.start()
+    addresses = addresses.get()
+
+    if args.fetcher == "async":
+        registry.fetcher = AsyncFetcher(
+            max_connections=args.connections,
+            max_per_host=args.per_host,
+        )
+    else:
+        registry.fetcher = UrllibFetcher(max_workers=args.connections)
+    if args.parse_processes > 0:
+        registry.parser = futures.ProcessPoolExecutor(
+            max_workers=args.parse_processes,
+            mp_context=context,
+        )
+    fake = FakeBot(latency=args.send_latency)
+    dispatcher = FakeDispatcher(fake)
+    bot.sender = SendQueue(rate=args.send_rate, chat_rate=args.send_rate, workers=args.send_workers)
+    bot.sender.start(fake)
+    scheduler = FeedScheduler(
+        registry,
+        on_update=lambda url, feed: bot.fan_out(dispatcher, url, feed),
+        interval=args.interval,
+        max_workers=args.workers,
+        max_in_flight=args.connections,
+        rate=args.fetch_rate,
+    )
+
+    cpu_started = resource.getrusage(resource.RUSAGE_SELF)
+    subscribe_seconds = subscribe(dispatcher, addresses, args.chats, args.feeds, args.per_chat, args.asap)
+    print(f"subscribed {args.chats} chats to {args.feeds} feeds in {subscribe_seconds:.1f}s", file=sys.stderr)
+
+    # entries found while subscribing are not published during the run
+    initial = fetches()
+    sent_before = len(fake.sent)
+    started = time.time()
+    scheduler.start()
+    time.sleep(args.duration)
+    scheduler.stop()
+    elapsed = time.time() - started
+    polled = { status: count - initial.get(status, 0) for status, count in fetches().items() }
+    drained = drain(bot.sender, args.duration)
+    asap_sent = fake.sent[sent_before:]
+
+    # every chat's digest falls due at once, as it would at midnight
+    ctx = bot.CallbackContext(dispatcher)
+    digest_started = time.perf_counter()
+    for chat_id in dispatcher.chat_data:
+        bot.digest_update.__wrapped__(ctx, chat_id)
+    drain(bot.sender, args.duration)
+    digest_seconds = time.perf_counter() - digest_started
+    digest_sent = len(fake.sent) - sent_before - len(asap_sent)
+
+    bot.sender.stop()
+    registry.fetcher.close()
+    if registry.parser is not None:
+        registry.parser.shutdown()
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    # only parse processes have exited by now, and the feed server is not counted
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stopped.set()
+    server.join()
+
+    latencies = [
+        sent_at - float(published)
+        for sent_at, chat_id, text in asap_sent
+        for published in PUBLISHED.findall(text)
+    ]
+    cpu_seconds = (cpu.ru_utime - cpu_started.ru_utime) + (cpu.ru_stime - cpu_started.ru_stime) + children.ru_utime + children.ru_stime
+    return {
+        "commit": commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "params": { key: value for key, value in vars(args).items() if key not in ("output", "compare") },
+        "subscribe_seconds": round(subscribe_seconds, 3),
+        "polls": sum(polled.values()),
+        "polls_per_sec": round(sum(polled.values()) / elapsed, 2),
+        "statuses": polled,
+        "not_modified": round(polled.get("304", 0) / (sum(polled.values()) or 1), 3),
+        "asap_messages": len(asap_sent),
+        "asap_entries": len(latencies),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "drained": drained,
+        "digest_messages": digest_sent,
+        "digest_seconds": round(digest_seconds, 3),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_percent": round(100 * cpu_seconds / (elapsed + digest_seconds), 1),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(max(cpu.ru_maxrss, children.ru_maxrss) / 1024, 1),
+    }
+
+def report(result: dict, previous: dict = None):
+    for key, value in result.items():
+        if key in ("params", "statuses"):
+            value = json.dumps(value, sort_keys=True)
+        line = f"{key:>18}: {value}"
+        if previous is not None and isinstance(value, (int, float)) and not isinstance(value, bool):
+            line += f"  (was {previous.get(key, None)} at {previous['commit']})"
+        print(line)
+
+def parse_errors(text: str):
+    """Parses an error mix such as "500=0.02,drop=0.01" into probabilities of each outcome."""
+    errors = {}
+    for part in filter(None, text.split(",")):
+        outcome, _, probability = part.partition("=")
+        if outcome != "drop" and not outcome.isdigit():
+            raise argparse.ArgumentTypeError(f"{outcome} is neither an HTTP status nor drop")
+        errors[outcome] = float(probability)
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--chats", type=int, default=1000, help="simulated chats")
+    parser.add_argument("--per-chat", type=int, default=10, help="feeds each chat is subscribed to")
+    parser.add_argument("--asap", type=float, default=0.5, help="fraction of subscriptions in asap mode, the rest being digest")
+    parser.add_argument("--feeds", type=int, default=500, help="synthetic feeds served")
+    parser.add_argument("--hosts", type=int, default=16, help="loopback addresses the feeds are spread over")
+    parser.add_argument("--entries", type=int, default=20, help="entries listed in each feed")
+    parser.add_argument("--size", type=int, default=20 * 1024, help="approximate size of each feed, in bytes")
+    parser.add_argument("--update", type=float, default=30, help="seconds between new entries in each feed")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean response time of the feed server, in seconds")
+    parser.add_argument("--errors", type=parse_errors, default={}, help="mix of failed responses, e.g. 500=0.02,404=0.01,drop=0.01")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to poll for")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between polls of each feed")
+    parser.add_argument("--fetcher", choices=("async", "urllib"), default="async")
+    parser.add_argument("--connections", type=int, default=envs["fetch_connections"])
+    parser.add_argument("--per-host", type=int, default=envs["fetch_per_host"])
+    parser.add_argument("--workers", type=int, default=envs["fetch_workers"])
+    parser.add_argument("--fetch-rate", type=float, default=0, help="polls started per second, or 0 for no limit")
+    parser.add_argument("--parse-processes", type=int, default=envs["parse_processes"])
+    parser.add_argument("--send-rate", type=float, default=1e6, help="messages sent per second, in total and per chat")
+    parser.add_argument("--send-workers", type=int, default=4)
+    parser.add_argument("--send-latency", type=float, default=0, help="seconds taken by each call to the Bot API")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.jsonl", help="file results are appended to")
+    parser.add_argument("--compare", action="store_true", help="compare with the last result in --output run with the same parameters")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare and os.path.exists(args.output):
+        params = { key: value for key, value in vars(args).items() if key not in ("output", "compare") }
+        with open(args.output) as f:
+            for line in f:
+                result = json.loads(line)
+                if result["params"] == params:
+                    previous = result
+    result = run(args)
+    report(result, previous)
+    with open(args.output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 import datetime
+import functools
 import html
+import io
 import logging
-import random
+import multiprocessing
+import sqlite3
+import threading
 import traceback
-from collections import defaultdict
+import xml.etree.ElementTree as ET
+from concurrent import futures
 
 from telegram import (
     MessageEntity,
@@ -19,61 +24,126 @@ from telegram.ext import (
     Defaults,
     Filters,
     MessageHandler,
-    PicklePersistence,
     Updater,
 )
 from telegram.ext.dispatcher import run_async
 
-from fpwrapper import FeedCollection, FeedCollectionError
+from archive import EntryArchive
+from fetcher import AsyncFetcher, ResponseCache
+from filters import FilterError, filters, parse_rule
+from fpwrapper import DeliveredIndex, FeedCollection, FeedCollectionError, registry
 from localconfig import strings, envs
+from metrics import MetricsServer, Timer, metrics
+from scheduler import DigestSchedule, FeedScheduler
+from sender import ASAP, BROADCAST, DIGEST, INTERACTIVE, Coalescer, SendQueue, pack
+from shards import ShardSupervisor
+from storage import SQLitePersistence
+from templates import TemplateError, compile_template, validate
+from webhook import WebhookServer
+from websub import WebSub
+
+logger = logging.getLogger(__name__)
 
 # declare symbols for conversation states
-MAIN, ADD_URL, ADD_MODE, REMOVE_URL, EDIT_URL, EDIT_REPR = map(chr, range(6))
+MAIN, ADD_URL, ADD_MODE, REMOVE_URL, EDIT_URL, EDIT_REPR, IMPORT_FILE = map(chr, range(7))
 
-class EscapedDict(defaultdict):
-    def __getitem__(self, key):
-        value = defaultdict.__getitem__(self, key)
-        if isinstance(value, str):
-            return html.escape(value)
-        elif isinstance(value, dict):
-            return EscapedDict(self.default_factory, value)
-        else:
-            return value
+# largest OPML file accepted by /import, in bytes
+MAX_OPML_SIZE = 1024 * 1024
 
 class SimpleReplies(object):
     """Wrapper providing simple functions which reply with no side effects"""
+    def __init__(self):
+        self.replies = {}
+
     def __getitem__(self, key):
-        @run_async
-        def r(upd: Update, ctx: CallbackContext, mapping: dict = {}, **kwargs):
-            mapping["_escaped"] = EscapedDict(str, mapping)
-            upd.message.reply_text(
-                text=strings[key].format_map(mapping),
-                **kwargs
-            )
-        return r
+        if key not in self.replies:
+            template = compile_template(strings[key])
+            def r(upd: Update, ctx: CallbackContext, mapping: dict = None, **kwargs):
+                sender.call(INTERACTIVE, upd.effective_chat.id, upd.message.reply_text,
+                    text=template.render(**(mapping or {})),
+                    **kwargs
+                )
+            self.replies[key] = r
+        return self.replies[key]
 reply = SimpleReplies()
 
+class PendingAdds(object):
+    """Subscribes a chat to feeds as the registry prepares them concurrently, replying as they are added
+
+    Results are replied in groups of progress_every, so that imports of many
+    feeds are not answered with a message per feed.
+    """
+    def __init__(self, upd: Update, ctx: CallbackContext, mode: str, urls: list, progress_every: int = 1, summary: bool = False):
+        self.upd = upd
+        self.ctx = ctx
+        self.fc = ctx.chat_data["feeds"][mode]
+        self.progress_every = progress_every
+        self.summary = summary
+        self.remaining = len(urls)
+        self.counts = { "added": 0, "invalid": 0, "duplicate": 0 }
+        self.added = []
+        self.invalid = []
+        self.duplicates = []
+        self._lock = threading.Lock()
+        for url in urls:
+            registry.prepare(url).add_done_callback(functools.partial(self._prepared, url))
+
+    def _prepared(self, url: str, future):
+        try:
+            feed = future.result()
+        except Exception:
+            logger.exception("Error while preparing %s", url)
+            feed = None
+        with self._lock:
+            if feed is None or feed.failures or feed.gone:
+                # feeds which could not be fetched and parsed are not subscribed to
+                self.invalid.append(url)
+            else:
+                try:
+                    self.fc.add_feed(url, feed)
+                except FeedCollectionError:
+                    self.duplicates.append(url)
+                else:
+                    self.added.append(url)
+            self.remaining -= 1
+            done = len(self.added) + len(self.invalid) + len(self.duplicates)
+            if self.remaining and done < self.progress_every:
+                return
+            added, self.added = self.added, []
+            invalid, self.invalid = self.invalid, []
+            duplicates, self.duplicates = self.duplicates, []
+            self.counts["added"] += len(added)
+            self.counts["invalid"] += len(invalid)
+            self.counts["duplicate"] += len(duplicates)
+            finished = not self.remaining
+        if added:
+            reply["add_success"](self.upd, self.ctx, mapping={"urls": ", ".join(added)})
+        if invalid:
+            reply["add_invalid"](self.upd, self.ctx, mapping={"urls": ", ".join(invalid)})
+        if duplicates:
+            reply["add_dupurl"](self.upd, self.ctx, mapping={"urls": ", ".join(duplicates)})
+        if finished and self.summary:
+            reply["import_done"](self.upd, self.ctx, mapping=self.counts)
+
+digests = DigestSchedule(spread=envs["digest_spread"])
+sender = SendQueue(
+    rate=envs["send_rate"],
+    chat_rate=envs["chat_send_rate"],
+)
+batches = Coalescer()
+
 # simple command callbacks
 def start(upd: Update, ctx: CallbackContext):
     """Initializes user settings and moves main_conv into MAIN"""
+    chat_id = upd.effective_chat.id
     ctx.chat_data["feeds"] = {
-        "asap": FeedCollection([]),
-        "digest": FeedCollection([]),
+        "asap": FeedCollection([], owner=(chat_id, "asap")),
+        "digest": FeedCollection([], owner=(chat_id, "digest")),
     }
     ctx.chat_data["reprs"] = {}
     ctx.chat_data["digesttime"] = datetime.time(0, 0, 0)
-    # enroll user in job_queue
-    ctx.job_queue.run_repeating(
-        callback=asap_update,
-        interval=envs["asap_freq"],
-        first=random.randrange(0, envs["asap_freq"]), # random staggering
-        context=upd.effective_chat.id,
-    )
-    ctx.job_queue.run_daily(
-        callback=digest_update,
-        time=ctx.chat_data["digesttime"],
-        context=upd.effective_chat.id,
-    )
+    # enroll user in digest schedule; feeds are polled by the FeedScheduler
+    digests.add(chat_id, ctx.chat_data["digesttime"])
 
     reply["welcome"](upd, ctx)
     return MAIN
@@ -93,6 +163,127 @@ def show_feeds(upd: Update, ctx: CallbackContext):
     else:
         reply["showfeeds"](upd, ctx, mapping=feeds)
 
+def batch_command(upd: Update, ctx: CallbackContext):
+    """Sets whether, and for how long, ASAP entries are collected into batched messages"""
+    if not ctx.args:
+        ctx.chat_data["coalesce"] = 0
+        reply["batch_poll"](upd, ctx)
+    elif ctx.args[0].lower() == "off":
+        ctx.chat_data.pop("coalesce", None)
+        reply["batch_off"](upd, ctx)
+    elif ctx.args[0].isdigit():
+        ctx.chat_data["coalesce"] = int(ctx.args[0])
+        reply["batch_window"](upd, ctx, mapping={"seconds": ctx.args[0]})
+    else:
+        reply["batch_what"](upd, ctx)
+
+def edit_command(upd: Update, ctx: CallbackContext):
+    """Sets how entries of a feed are presented, or resets it to the default if no repr is given"""
+    # the repr is taken verbatim from the message, keeping its line breaks
+    args = upd.message.text.split(None, 2)
+    if len(args) < 2:
+        reply["edit_what"](upd, ctx)
+        return MAIN
+    url = args[1]
+    if not any(url in fc.feeds for fc in ctx.chat_data["feeds"].values()):
+        reply["remove_feednotfound"](upd, ctx, mapping={"url": url})
+    elif len(args) < 3:
+        ctx.chat_data["reprs"].pop(url, None)
+        reply["edit_reset"](upd, ctx, mapping={"url": url})
+    else:
+        # reprs are checked once here, rather than failing on every entry
+        try:
+            validate(args[2])
+        except TemplateError as e:
+            reply["edit_invalid"](upd, ctx, mapping={"error": e.message})
+        else:
+            ctx.chat_data["reprs"][url] = args[2]
+            registry.request_fields(url, compile_template(args[2]).entry_fields())
+            reply["edit_success"](upd, ctx, mapping={"url": url})
+    return MAIN
+
+def filter_command(kind: str, upd: Update, ctx: CallbackContext):
+    """Adds an include or exclude rule to a feed's filters, or lists them if no rule is given"""
+    args = upd.message.text.split(None, 2)
+    if len(args) < 2:
+        reply["filter_what"](upd, ctx)
+        return MAIN
+    url = args[1]
+    rules = ctx.chat_data.setdefault("filters", {})
+    if not any(url in fc.feeds for fc in ctx.chat_data["feeds"].values()):
+        reply["remove_feednotfound"](upd, ctx, mapping={"url": url})
+    elif len(args) < 3:
+        reply["filter_list"](upd, ctx, mapping={
+            "url": url,
+            "include": ", ".join(rules.get(url, {}).get("include", ())) or "-",
+            "exclude": ", ".join(rules.get(url, {}).get("exclude", ())) or "-",
+        })
+    else:
+        try:
+            if parse_rule(args[2]) in filters.disabled:
+                raise FilterError(args[2], "it was turned off for being too slow to match")
+        except FilterError as e:
+            reply["filter_invalid"](upd, ctx, mapping={"error": e.message})
+            return MAIN
+        feed_rules = rules.setdefault(url, {"include": [], "exclude": []})
+        if args[2].strip() not in feed_rules[kind]:
+            feed_rules[kind].append(args[2].strip())
+        filters.update(url, upd.effective_chat.id, feed_rules)
+        # tags are only kept for feeds which need them
+        registry.request_fields(url, ("tags",))
+        reply[f"filter_{kind}"](upd, ctx, mapping={"url": url, "rule": args[2].strip()})
+    return MAIN
+
+def unfilter_command(upd: Update, ctx: CallbackContext):
+    """Removes a rule from a feed's filters, or all of them if no rule is given"""
+    args = upd.message.text.split(None, 2)
+    if len(args) < 2:
+        reply["filter_what"](upd, ctx)
+        return MAIN
+    url = args[1]
+    rules = ctx.chat_data.setdefault("filters", {})
+    if url not in rules:
+        reply["unfilter_none"](upd, ctx, mapping={"url": url})
+        return MAIN
+    if len(args) < 3:
+        del rules[url]
+    else:
+        for kind in ("include", "exclude"):
+            if args[2].strip() in rules[url][kind]:
+                rules[url][kind].remove(args[2].strip())
+        if not rules[url]["include"] and not rules[url]["exclude"]:
+            del rules[url]
+    filters.update(url, upd.effective_chat.id, rules.get(url, None))
+    reply["unfilter_success"](upd, ctx, mapping={"url": url})
+    return MAIN
+
+def search_command(upd: Update, ctx: CallbackContext):
+    """Searches the archived entries of the chat's feeds"""
+    if not ctx.args:
+        reply["search_what"](upd, ctx)
+        return MAIN
+    if registry.archive is None:
+        reply["search_unavailable"](upd, ctx)
+        return MAIN
+    feeds = {
+        feed.key
+        for fc in ctx.chat_data["feeds"].values()
+        for feed in fc.feeds.values()
+    }
+    results = registry.archive.search(ctx.args, feeds)
+    if not results:
+        reply["search_none"](upd, ctx, mapping={"terms": " ".join(ctx.args)})
+        return MAIN
+    reply["search_results"](upd, ctx, mapping={
+        "terms": " ".join(ctx.args),
+        "results": "\n".join(
+            f"- <a href='{html.escape(link)}'>{html.escape(title or link)}</a> - "
+            f"{html.escape(registry.feeds[key].metadata['title'] if key in registry.feeds else key)}"
+            for key, link, title, published in results
+        ),
+    })
+    return MAIN
+
 # add flow callbacks
 def add_command(upd: Update, ctx: CallbackContext):
     """Processes args of /add and hands over to add_feed"""
@@ -143,21 +334,17 @@ def add_feed(upd: Update, ctx: CallbackContext):
         )
         return ADD_MODE
     else:
-        # proceed to add feeds
-        success = []
-        duplicates = []
-        for url in ctx.chat_data["add_url"]:
-            try:
-                ctx.chat_data["feeds"][ctx.chat_data["add_mode"]].add_feed(url)
-            except FeedCollectionError:
-                duplicates.append(url)
-            else:
-                success.append(url)
-        if success:
-            reply["add_success"](upd, ctx,
-                mapping={"urls":", ".join(success)},
+        # proceed to add feeds, which are checked concurrently and replied
+        # to as each is added, without holding up the handler
+        fc = ctx.chat_data["feeds"][ctx.chat_data["add_mode"]]
+        urls = [ url for url in ctx.chat_data["add_url"] if url not in fc.feeds ]
+        duplicates = [ url for url in ctx.chat_data["add_url"] if url in fc.feeds ]
+        if urls:
+            reply["add_checking"](upd, ctx,
+                mapping={"urls":", ".join(urls)},
                 reply_markup=ReplyKeyboardRemove(selective=True),
             )
+            PendingAdds(upd, ctx, ctx.chat_data["add_mode"], urls)
         if duplicates:
             reply["add_dupurl"](upd, ctx,
                 mapping={"urls":", ".join(duplicates)},
@@ -174,6 +361,82 @@ def add_cleanup(upd: Update, ctx: CallbackContext):
         pass
     return MAIN
 
+# import/export callbacks
+def import_command(upd: Update, ctx: CallbackContext):
+    """Records the mode feeds are imported into and moves main_conv into IMPORT_FILE"""
+    if ctx.args and ctx.args[-1].lower() in ("digest", "asap"):
+        ctx.chat_data["import_mode"] = ctx.args[-1].lower()
+    reply["import_requestfile"](upd, ctx)
+    return IMPORT_FILE
+
+def import_file_step(upd: Update, ctx: CallbackContext):
+    """Reads feeds from an OPML file and subscribes to them concurrently"""
+    if (upd.message.document.file_size or 0) > MAX_OPML_SIZE:
+        reply["import_toolarge"](upd, ctx)
+        return IMPORT_FILE
+    try:
+        feeds = read_opml(bytes(upd.message.document.get_file().download_as_bytearray()))
+    except ET.ParseError:
+        reply["import_what"](upd, ctx)
+        return IMPORT_FILE
+    default_mode = ctx.chat_data.pop("import_mode", None)
+    by_mode = { "asap": [], "digest": [] }
+    for url, mode in feeds:
+        mode = mode or default_mode or "digest"
+        if not any(url in fc.feeds for fc in ctx.chat_data["feeds"].values()):
+            by_mode[mode].append(url)
+    if not by_mode["asap"] and not by_mode["digest"]:
+        reply["import_nothing"](upd, ctx)
+        return MAIN
+    reply["import_started"](upd, ctx, mapping={"count": len(by_mode["asap"]) + len(by_mode["digest"])})
+    for mode, urls in by_mode.items():
+        if urls:
+            PendingAdds(upd, ctx, mode, urls, progress_every=25, summary=True)
+    return MAIN
+
+def import_cancel_conversation(upd: Update, ctx: CallbackContext):
+    ctx.chat_data.pop("import_mode", None)
+    reply["import_cancel"](upd, ctx)
+    return MAIN
+
+def read_opml(document: bytes):
+    """Returns (url, mode) for each feed outlined in an OPML document, with mode set if the feed is filed under an ASAP or Digest outline."""
+    feeds = {}
+    def walk(outlines, mode):
+        for outline in outlines:
+            url = outline.get("xmlUrl", "").strip()
+            if url:
+                feeds.setdefault(url, mode)
+            else:
+                group = outline.get("text", "").lower()
+                walk(outline.findall("outline"), group if group in ("asap", "digest") else mode)
+    body = ET.fromstring(document).find("body")
+    if body is not None:
+        walk(body.findall("outline"), None)
+    return list(feeds.items())
+
+def export_command(upd: Update, ctx: CallbackContext):
+    """Sends the chat's feeds back as an OPML file, grouped by mode"""
+    opml = write_opml({
+        mode: { url: feed.metadata.get("title", url) for url, feed in fc.feeds.items() }
+        for mode, fc in ctx.chat_data["feeds"].items()
+    })
+    # the file is opened anew for each attempt at sending it
+    sender.call(INTERACTIVE, upd.effective_chat.id,
+        lambda **kwargs: upd.message.reply_document(document=io.BytesIO(opml), **kwargs),
+        filename="feeds.opml",
+    )
+
+def write_opml(feeds: dict):
+    opml = ET.Element("opml", version="2.0")
+    ET.SubElement(ET.SubElement(opml, "head"), "title").text = "The Daily Telegram subscriptions"
+    body = ET.SubElement(opml, "body")
+    for mode, titles in feeds.items():
+        group = ET.SubElement(body, "outline", text={"asap": "ASAP", "digest": "Digest"}[mode])
+        for url, title in titles.items():
+            ET.SubElement(group, "outline", type="rss", text=title, title=title, xmlUrl=url)
+    return ET.tostring(opml, encoding="utf-8", xml_declaration=True)
+
 # remove flow callbacks
 def remove_command(upd: Update, ctx: CallbackContext):
     """Grabs URLs from entities and removes feeds, or bumps to REMOVE_URL if not found"""
@@ -204,6 +467,10 @@ def remove_command(upd: Update, ctx: CallbackContext):
             ctx.chat_data["feeds"]["digest"].remove_feed(url)
         except FeedCollectionError:
             _exc_counter += 1
+        if not any(url in fc.feeds for fc in ctx.chat_data["feeds"].values()):
+            # filters go with the feed
+            if ctx.chat_data.get("filters", {}).pop(url, None):
+                filters.update(url, upd.effective_chat.id, None)
         if _exc_counter >= 2:
             reply["remove_feednotfound"](upd, ctx,
                 mapping={"url": url},
@@ -223,84 +490,163 @@ def remove_cancel_conversation(upd: Update, ctx: CallbackContext):
     )
     return MAIN
 
-# job_queue callbacks
-def format_feeds(ctx: CallbackContext, fc: FeedCollection, reprs: dict, defaultrepr: str):
-    """Gets new entries from a FeedCollection and formats them according to reprs/defaultrepr"""
-    entries = fc.get_new_entries()
+# update callbacks
+def format_feeds(fc: FeedCollection, reprs: dict, defaultrepr: str, urls: list = None, rules: dict = None, delivered: DeliveredIndex = None):
+    """Gets new entries from a FeedCollection, drops those filtered out by rules or already in delivered, and formats them according to reprs/defaultrepr"""
+    entries = fc.get_new_entries(urls)
     formatted = {}
     for url in entries:
+        if isinstance(entries[url], str):
+            # a traceback is returned in place of entries if an Exception
+            # was raised while parsing this feed; it is reported by fan_out
+            formatted[url] = [compile_template(strings["fperror"]).render(url=url)]
+            continue
         try:
-            formatted[url] = [
-                (
-                    reprs[url] if url in reprs
-                    else defaultrepr
-                ).format(
-                    entry=entry,
-                    feed=fc.feeds[url].metadata,
-                    _escaped=EscapedDict(str, {
-                        "entry": entry,
-                        "feed": fc.feeds[url].metadata,
-                    })
-                ) for entry in entries[url]
-            ]
-        except TypeError:
-            # return a simple string representation
-            # this shoud only occur if an Exception was raised
-            # from parsing this feed, resulting in a exc_info tuple
-            formatted[url] = [strings["fperror"].format(
-                url=url,
-                _escaped=EscapedDict(str, {"url": url}),
-            )]
-            report(ctx, strings["fperrorreport"],
-                url=url,
-                trace="".join(traceback.format_exception(*entries[url])),
-            )
-        except KeyError:
-            formatted[url] = [strings["reprerror"].format(
-                url=url,
-                _escaped=EscapedDict(str, {"url": url}),
-            )]
+            # rendered entries are cached by the template, and shared with
+            # every other chat subscribed to the feed with the same repr
+            template = compile_template(reprs[url] if url in reprs else defaultrepr)
+            if rules and url in rules:
+                # entries are matched once against every subscriber's rules
+                entries[url] = filters.apply(url, fc.owner[0], rules[url], entries[url])
+            if delivered is not None:
+                # the same entry may have been sent from another of the chat's feeds
+                entries[url] = delivered.unseen(entries[url], fc.feeds[url].key)
+            with Timer() as timer:
+                formatted[url] = [
+                    template.render_entry(entry, fc.feeds[url].metadata)
+                    for entry in entries[url]
+                ]
+            if formatted[url]:
+                metrics.observe("render_seconds", timer.elapsed)
+                metrics.cost(fc.feeds[url].url, seconds=timer.elapsed)
+        except FilterError as e:
+            # e.g. rules stored before regexes were checked as they are now
+            formatted[url] = [compile_template(strings["filtererror"]).render(url=url, rule=e.rule, error=e.message)]
+        except (KeyError, IndexError, AttributeError, TypeError, ValueError, TemplateError):
+            formatted[url] = [compile_template(strings["reprerror"]).render(url=url)]
         # remove feed from result if it is empty
         if not formatted[url]:
             del formatted[url]
     return formatted
 
-@run_async
-def asap_update(ctx: CallbackContext):
-    chat_id = ctx.job.context
+def fan_out(dispatcher, url: str, feed):
+    """Called from FeedScheduler workers to deliver new entries of a feed to asap subscribers, and buffer them for digest subscribers"""
+    ctx = CallbackContext(dispatcher)
+    trace = feed.entries_since(feed.serial - 1)
+    if isinstance(trace, str):
+        # the feed started failing; chats are only told so, and the
+        # traceback is reported once rather than for each of them
+        report(ctx, strings["fperrorreport"],
+            url=url,
+            trace=trace,
+        )
+    for (chat_id, mode), feed_url in registry.subscribers_of(url):
+        try:
+            if mode == "asap":
+                asap_update(ctx, chat_id, [feed_url])
+            else:
+                dispatcher.chat_data[chat_id]["feeds"]["digest"].collect([feed_url])
+        except Exception:
+            # one chat's failure must not hold up the feed's other subscribers
+            logger.exception("Error while delivering %s to chat %s", url, chat_id)
+
+def asap_update(ctx: CallbackContext, chat_id: int, urls: list = None):
     fc = ctx.dispatcher.chat_data[chat_id]["feeds"]["asap"]
     reprs = ctx.dispatcher.chat_data[chat_id]["reprs"]
-    formatted = format_feeds(ctx, fc, reprs, strings["asapdefaultrepr"])
-    for url in formatted:
-        for entry in reversed(formatted[url]):
-            ctx.bot.send_message(
-                chat_id=chat_id,
+    rules = ctx.dispatcher.chat_data[chat_id].get("filters", None)
+    delivered = ctx.dispatcher.chat_data[chat_id].setdefault("delivered", DeliveredIndex())
+    formatted = format_feeds(fc, reprs, strings["asapdefaultrepr"], urls, rules, delivered)
+    entries = [ entry for url in formatted for entry in reversed(formatted[url]) ]
+    window = ctx.dispatcher.chat_data[chat_id].get("coalesce", None)
+    if window is None:
+        for entry in entries:
+            sender.send(ASAP, chat_id,
                 text=entry,
                 disable_web_page_preview=False,
             )
+    elif not window:
+        send_batch(chat_id, entries)
+    elif entries and batches.add(chat_id, entries):
+        # the first entries of a batch open its window
+        ctx.job_queue.run_once(callback=asap_flush, when=window, context=chat_id)
+
+def asap_flush(ctx: CallbackContext):
+    """Sends ASAP entries collected over a chat's batching window"""
+    send_batch(ctx.job.context, batches.take(ctx.job.context))
+
+def send_batch(chat_id: int, entries: list):
+    for text in pack(entries):
+        sender.send(ASAP, chat_id,
+            text=text,
+        )
+
+def digest_tick(ctx: CallbackContext):
+    """Runs every minute to send digests which have fallen due"""
+    for chat_id in digests.due():
+        digest_update(ctx, chat_id)
 
 @run_async
-def digest_update(ctx: CallbackContext):
-    chat_id = ctx.job.context
+def digest_update(ctx: CallbackContext, chat_id: int):
     fc = ctx.dispatcher.chat_data[chat_id]["feeds"]["digest"]
     reprs = ctx.dispatcher.chat_data[chat_id]["reprs"]
-    formatted = format_feeds(ctx, fc, reprs, strings["digestdefaultrepr"])
+    rules = ctx.dispatcher.chat_data[chat_id].get("filters", None)
+    delivered = ctx.dispatcher.chat_data[chat_id].setdefault("delivered", DeliveredIndex())
+    formatted = format_feeds(fc, reprs, strings["digestdefaultrepr"], rules=rules, delivered=delivered)
     for url in formatted:
-        msgheader = strings["digestheader"].format(
-            feed=fc.feeds[url].metadata,
-            _escaped=EscapedDict(str, {"feed": fc.feeds[url].metadata}),
-        )
-        msgbody = "".join(reversed(formatted[url]))
-        ctx.bot.send_message(
-            chat_id=chat_id,
-            text="".join([msgheader, msgbody]),
-        )
+        msgheader = compile_template(strings["digestheader"]).render(feed=fc.feeds[url].metadata)
+        # a busy feed's digest is split over as many messages as it takes
+        for text in pack([msgheader] + list(reversed(formatted[url]))):
+            sender.send(DIGEST, chat_id,
+                text=text,
+            )
+
+def restore_chat(dispatcher, chat_id: int, chat: dict, catch_up: bool = False):
+    """Subscribes a chat loaded from persistence to its feeds and digest, sending it any ASAP entries it missed while unloaded if catch_up"""
+    for mode, fc in chat["feeds"].items():
+        fc.bind((chat_id, mode))
+    digests.add(chat_id, chat["digesttime"])
+    for url, repr_ in chat["reprs"].items():
+        try:
+            registry.request_fields(url, compile_template(repr_).entry_fields())
+        except TemplateError:
+            pass
+    for url, rules in chat.get("filters", {}).items():
+        registry.request_fields(url, ("tags",))
+        try:
+            filters.update(url, chat_id, rules)
+        except FilterError as e:
+            # the chat is told when the feed's entries are next filtered
+            logger.warning("Could not restore filter %s of %s for chat %s: %s", e.rule, url, chat_id, e.message)
+    if catch_up:
+        fc = chat["feeds"]["asap"]
+        # feeds polled before the chat was loaded did not fan out to it
+        urls = [ url for url, feed in fc.feeds.items() if fc.cursors[url] != feed.serial ]
+        if urls:
+            asap_update(CallbackContext(dispatcher), chat_id, urls)
+
+def filter_disabled(chat_id: int, url: str, rule: str):
+    """Called from the FilterIndex when a regex in one of a chat's filters is turned off, as it was too slow to match"""
+    sender.send(ASAP, chat_id,
+        text=compile_template(strings["filter_disabled"]).render(url=url, rule=rule),
+    )
+
+def warm_up(persistence: SQLitePersistence):
+    """Loads chats in the background after a lazy startup, scheduling every digest first as it needs no more than the digest time"""
+    for chat_id, digesttime in persistence.digest_times():
+        digests.add(chat_id, digesttime)
+    persistence.warm_up()
+
+def persist(ctx: CallbackContext):
+    """Runs periodically to save feeds polled and cursors advanced outside of handlers"""
+    ctx.dispatcher.persistence.sync()
 
 # error handlers
 def bot_error(upd: Update, ctx: CallbackContext):
     # notify user
     if upd.effective_message:
-        upd.effective_message.reply_text(strings["error"])
+        sender.call(INTERACTIVE, upd.effective_chat.id, upd.effective_message.reply_text,
+            text=strings["error"],
+        )
 
     # report to devs
     report(ctx, strings["errorreport"],
@@ -319,8 +665,7 @@ def report(ctx: CallbackContext, template: str, **kwargs):
     for dev_id in envs["devs"]:
         # Markdown mode must be used as the Telegram API attempts to
         # parse html <tag>-like terms even within <pre> tags.
-        ctx.bot.send_message(
-            chat_id=dev_id,
+        sender.send(INTERACTIVE, dev_id,
             parse_mode=ParseMode.MARKDOWN,
             text=template.format(**kwargs),
         )
@@ -329,14 +674,44 @@ def report(ctx: CallbackContext, template: str, **kwargs):
 def announce(upd: Update, ctx: CallbackContext):
     if str(upd.effective_chat.id) in envs["devs"]:
         message = " ".join(ctx.args)
-        for chat_id in ctx.dispatcher.chat_data:
-            ctx.bot.send_message(
-                chat_id=chat_id,
+        for chat_id in ctx.dispatcher.persistence.chat_ids():
+            sender.send(BROADCAST, chat_id,
                 text=message,
             )
     else:
         reply["unknowninput"](upd, ctx)
 
+@run_async
+def stats_command(upd: Update, ctx: CallbackContext):
+    if str(upd.effective_chat.id) in envs["devs"]:
+        summary = metrics.summary()
+        reply["stats"](upd, ctx, mapping={
+            "pipeline": "\n".join(format_stats(summary)),
+            "feeds": "\n".join(
+                f"{seconds:8.1f}s {polls:6d} polls {size / 1024 / 1024:8.1f}MB  {url}"
+                for url, (seconds, size, polls, entries) in summary["feeds"]
+            ) or "-",
+        })
+    else:
+        reply["unknowninput"](upd, ctx)
+
+def format_stats(summary: dict):
+    """Yields lines describing the counters, timings and gauges in a metrics summary"""
+    counters = summary["counters"]
+    responses = {
+        dict(labels)["status"]: value
+        for (name, labels), value in counters.items() if name == "fetch_responses_total"
+    }
+    fetches = sum(responses.values())
+    yield f"fetches: {fetches:.0f}, {responses.get('304', 0) / (fetches or 1):.0%} not modified, {responses.get('error', 0):.0f} failed"
+    yield "statuses: " + ", ".join(f"{status} x{count:.0f}" for status, count in sorted(responses.items()))
+    yield f"downloaded: {counters.get(('fetch_bytes_total', ()), 0) / 1024 / 1024:.1f}MB"
+    yield f"entries: {counters.get(('parsed_entries_total', ()), 0):.0f} parsed, {counters.get(('new_entries_total', ()), 0):.0f} new"
+    for (name, labels), h in sorted(summary["histograms"].items()):
+        label = "".join(f" {value}" for key, value in labels)
+        yield f"{name}{label}: {h['count']} x {h['mean'] * 1000:.1f}ms, p50 <{h['p50']}s, p99 <{h['p99']}s"
+    for name, value in sorted(summary["gauges"].items()):
+        yield f"{name}: {value:g}"
 
 def main():
     logging.basicConfig(
@@ -344,6 +719,17 @@ def main():
         level=logging.INFO
     )
 
+    # the bot keeps nothing in user_data or bot_data, which would otherwise
+    # be rewritten after every update
+    persistence = SQLitePersistence(
+        f"{envs['pkl_location']}/bot.db",
+        store_user_data=False,
+        store_bot_data=False,
+        lazy=envs["lazy_startup"],
+    )
+    # carry over data saved by previous versions of the bot
+    persistence.migrate(f"{envs['pkl_location']}/bot.pkl")
+
     updater = Updater(
         token=envs["api_token"],
         use_context=True,
@@ -351,7 +737,7 @@ def main():
             parse_mode=ParseMode.HTML,
             disable_web_page_preview=True,
         ),
-        persistence=PicklePersistence(filename=f"{envs['pkl_location']}/bot.pkl")
+        persistence=persistence,
     )
 
     dispatcher = updater.dispatcher
@@ -366,7 +752,14 @@ def main():
                 CommandHandler("start", reply["alreadyinitialized"]),
                 CommandHandler("add", add_command),
                 CommandHandler("remove", remove_command),
-                # CommandHandler("edit", edit_command),
+                CommandHandler("batch", batch_command),
+                CommandHandler("edit", edit_command),
+                CommandHandler("include", functools.partial(filter_command, "include")),
+                CommandHandler("exclude", functools.partial(filter_command, "exclude")),
+                CommandHandler("unfilter", unfilter_command),
+                CommandHandler("search", search_command),
+                CommandHandler("import", import_command),
+                CommandHandler("export", export_command),
             ],
             ADD_URL: [
                 MessageHandler(Filters.entity(MessageEntity.URL), add_url_step),
@@ -383,6 +776,11 @@ def main():
                 CommandHandler("cancel", remove_cancel_conversation),
                 MessageHandler(Filters.all, reply["remove_what"]),
             ],
+            IMPORT_FILE: [
+                MessageHandler(Filters.document, import_file_step),
+                CommandHandler("cancel", import_cancel_conversation),
+                MessageHandler(Filters.all, reply["import_what"]),
+            ],
             # EDIT_URL: [],
             # EDIT_REPR: [],
         },
@@ -393,30 +791,147 @@ def main():
         name="main_conv"
     ))
     dispatcher.add_handler(CommandHandler("announce", announce))
+    dispatcher.add_handler(CommandHandler("stats", stats_command))
     dispatcher.add_handler(MessageHandler(Filters.all, reply["uninitialized"]))
     dispatcher.add_error_handler(bot_error)
 
-    job_queue = dispatcher.job_queue
-    # enqueue update jobs for persisted users
-    for chat_id in dispatcher.chat_data:
-        # check if chat_data is actually populated by data from /start
-        if dispatcher.chat_data[chat_id]:
-            job_queue.run_repeating(
-                callback=asap_update,
-                interval=envs["asap_freq"],
-                first=random.randrange(0, envs["asap_freq"]), # random staggering
-                context=chat_id,
-            )
-            job_queue.run_daily(
-                callback=digest_update,
-                time=dispatcher.chat_data[chat_id]["digesttime"],
-                context=chat_id,
+    filters.on_disable = filter_disabled
+    if envs["lazy_startup"]:
+        # chats are subscribed to their feeds and digests as they are loaded
+        persistence.on_load = functools.partial(restore_chat, dispatcher, catch_up=True)
+    else:
+        # subscribe persisted users to their feeds and digests
+        for chat_id in dispatcher.chat_data:
+            # check if chat_data is actually populated by data from /start
+            if dispatcher.chat_data[chat_id]:
+                restore_chat(dispatcher, chat_id, dispatcher.chat_data[chat_id])
+
+    registry.cache = ResponseCache(
+        f"{envs['pkl_location']}/responses.db",
+        max_bytes=envs["response_cache_size"] * 1024 * 1024,
+    )
+    if envs["archive_days"] > 0:
+        try:
+            registry.archive = EntryArchive(
+                f"{envs['pkl_location']}/archive.db",
+                max_age=envs["archive_days"] * 24 * 60 * 60,
+                max_entries=envs["archive_size"],
             )
-
-    updater.start_polling(
-        allowed_updates=["message"],
+        except sqlite3.OperationalError:
+            logger.exception("Could not open the entry archive; /search will be unavailable")
+        else:
+            registry.archive.start()
+    registry.fetcher = AsyncFetcher(
+        max_connections=envs["fetch_connections"],
+        max_per_host=envs["fetch_per_host"],
+        connect_timeout=envs["connect_timeout"],
+        read_timeout=envs["read_timeout"],
+        max_body=envs["max_feed_size"] * 1024 * 1024,
     )
+    if envs["parse_processes"] > 0:
+        # spawn rather than fork, as the fetcher's event loop is already running
+        registry.parser = futures.ProcessPoolExecutor(
+            max_workers=envs["parse_processes"],
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    if envs["worker_processes"] > 0:
+        # feeds are polled in worker processes, sharing out the fetcher's limits
+        workers = envs["worker_processes"]
+        scheduler = ShardSupervisor(
+            registry,
+            on_update=functools.partial(fan_out, dispatcher),
+            processes=workers,
+            max_workers=envs["fetch_workers"],
+            options={
+                "fetcher": {
+                    "max_connections": max(envs["fetch_connections"] // workers, 1),
+                    "max_per_host": envs["fetch_per_host"],
+                    "connect_timeout": envs["connect_timeout"],
+                    "read_timeout": envs["read_timeout"],
+                    "max_body": envs["max_feed_size"] * 1024 * 1024,
+                },
+                "cache": {
+                    "filename": registry.cache.db_filename,
+                    "max_bytes": envs["response_cache_size"] * 1024 * 1024,
+                },
+                "scheduler": {
+                    "interval": envs["asap_freq"],
+                    "min_interval": envs["min_freq"],
+                    "max_interval": envs["max_freq"],
+                    "max_workers": envs["fetch_workers"],
+                    "max_in_flight": max(envs["fetch_connections"] // workers, 1),
+                    "rate": envs["fetch_rate"] / workers,
+                    "push_interval": envs["push_freq"],
+                },
+                "flush": envs["persist_freq"],
+            },
+        )
+    else:
+        scheduler = FeedScheduler(
+            registry,
+            on_update=functools.partial(fan_out, dispatcher),
+            interval=envs["asap_freq"],
+            min_interval=envs["min_freq"],
+            max_interval=envs["max_freq"],
+            max_workers=envs["fetch_workers"],
+            max_in_flight=envs["fetch_connections"],
+            rate=envs["fetch_rate"],
+            push_interval=envs["push_freq"],
+        )
+    websub = None
+    if envs["websub_url"]:
+        # feeds advertising a hub have their updates pushed to this address
+        websub = WebSub(
+            registry,
+            on_update=functools.partial(fan_out, dispatcher),
+            base_url=envs["websub_url"],
+            port=envs["websub_port"],
+        )
+        websub.start()
+    metrics.register("scheduler", scheduler.stats)
+    metrics.register("send", sender.stats)
+    metrics_server = None
+    if envs["metrics_port"]:
+        metrics_server = MetricsServer(metrics, port=envs["metrics_port"])
+        metrics_server.start()
+    scheduler.start()
+    if envs["lazy_startup"]:
+        threading.Thread(target=warm_up, args=(persistence,), name="WarmUp", daemon=True).start()
+    dispatcher.job_queue.run_repeating(callback=digest_tick, interval=60, first=0)
+    dispatcher.job_queue.run_repeating(callback=persist, interval=envs["persist_freq"])
+
+    sender.start(updater.bot)
+    webhook = None
+    if envs["webhook_url"]:
+        webhook = WebhookServer(
+            updater,
+            url=envs["webhook_url"],
+            port=envs["webhook_port"],
+            secret=envs["webhook_secret"],
+            workers=envs["webhook_workers"],
+            queue_size=envs["webhook_queue"],
+        )
+        metrics.register("webhook", webhook.stats)
+        webhook.start()
+    else:
+        updater.start_polling(
+            allowed_updates=["message"],
+        )
     updater.idle()
+    if webhook is not None:
+        webhook.stop()
+    scheduler.stop()
+    if websub is not None:
+        websub.stop()
+    sender.stop()
+    registry.fetcher.close()
+    registry.cache.close()
+    if registry.archive is not None:
+        registry.archive.close()
+    if registry.parser is not None:
+        registry.parser.shutdown()
+    if metrics_server is not None:
+        metrics_server.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from concurrent import futures
+import zlib
+
+import aiohttp
+
+from metrics import metrics
+
+USER_AGENT = "DailyTelegram/1.0 (+https://github.com/jeslinmx/dailytelegram)"
+# largest response body downloaded, in bytes
+MAX_BODY = 10 * 1024 * 1024
+
+# headers are keyed in lowercase; permanent_url is set if the feed was permanently redirected
+FetchResult = namedtuple("FetchResult", ["url", "status", "headers", "body", "permanent_url"])
+
+class BodyTooLarge(Exception):
+    def __init__(self, url: str, max_body: int):
+        super().__init__(f"{url} is larger than {max_body} bytes")
+        self.url = url
+        self.max_body = max_body
+
+class CachedResponse(namedtuple("CachedResponse", ["headers", "body"])):
+    """A body kept by a ResponseCache, along with the headers it was served with"""
+    def validators(self):
+        return self.headers.get("etag", None), self.headers.get("last-modified", None)
+
+def record_fetch(url: str, start: float, result: FetchResult):
+    """Records the latency, status and size of a fetch started at start (a perf_counter time), with result None if it failed."""
+    elapsed = time.perf_counter() - start
+    size = len(result.body) if result is not None else 0
+    metrics.observe("fetch_seconds", elapsed)
+    metrics.count("fetch_responses_total", status=str(result.status) if result is not None else "error")
+    metrics.count("fetch_bytes_total", size)
+    metrics.cost(url, seconds=elapsed, size=size, polls=1)
+
+def conditional_headers(etag: str = None, modified: str = None):
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+    return headers
+
+class AsyncFetcher(object):
+    """Runs conditional GETs on a background event loop, sharing a pool of keep-alive connections between all feeds"""
+    def __init__(self, max_connections: int = 100, max_per_host: int = 4, connect_timeout: float = 10, read_timeout: float = 30, max_body: int = MAX_BODY):
+        self.max_body = max_body
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="AsyncFetcher", daemon=True)
+        self._thread.start()
+        self.session = asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+
+    async def _open(self):
+        # the session must be created from within its event loop
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_per_host,
+                ttl_dns_cache=5 * 60,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=self.connect_timeout,
+                sock_read=self.read_timeout,
+            ),
+            headers={"User-Agent": USER_AGENT},
+        )
+
+    def submit(self, url: str, etag: str = None, modified: str = None):
+        """Starts fetching url, returning a concurrent.futures.Future of its FetchResult."""
+        return asyncio.run_coroutine_threadsafe(self._fetch(url, etag, modified), self.loop)
+
+    def fetch(self, url: str, etag: str = None, modified: str = None):
+        return self.submit(url, etag, modified).result()
+
+    async def _fetch(self, url: str, etag: str, modified: str):
+        start = time.perf_counter()
+        try:
+            result = await self._get(url, etag, modified)
+        except Exception:
+            record_fetch(url, start, None)
+            raise
+        record_fetch(url, start, result)
+        return result
+
+    async def _get(self, url: str, etag: str, modified: str):
+        async with self.session.get(url, headers=conditional_headers(etag, modified)) as r:
+            if (r.content_length or 0) > self.max_body:
+                raise BodyTooLarge(url, self.max_body)
+            body = bytearray()
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                body += chunk
+                if len(body) > self.max_body:
+                    raise BodyTooLarge(url, self.max_body)
+            body = bytes(body)
+            permanent = r.history and all(h.status in (301, 308) for h in r.history)
+            return FetchResult(
+                url=url,
+                status=r.status,
+                headers={ key.lower(): value for key, value in r.headers.items() },
+                body=body,
+                permanent_url=str(r.url) if permanent else None,
+            )
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+class UrllibFetcher(object):
+    """Fetches feeds with blocking urllib requests, one connection per request"""
+    def __init__(self, max_workers: int = 5, timeout: float = 30, max_body: int = MAX_BODY):
+        self.timeout = timeout
+        self.max_body = max_body
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, url: str, etag: str = None, modified: str = None):
+        return self._executor.submit(self.fetch, url, etag, modified)
+
+    def fetch(self, url: str, etag: str = None, modified: str = None):
+        start = time.perf_counter()
+        try:
+            result = self._get(url, etag, modified)
+        except Exception:
+            record_fetch(url, start, None)
+            raise
+        record_fetch(url, start, result)
+        return result
+
+    def _get(self, url: str, etag: str = None, modified: str = None):
+        headers = conditional_headers(etag, modified)
+        headers["User-Agent"] = USER_AGENT
+        request = urllib.request.Request(url, headers=headers)
+        redirects = RedirectRecorder()
+        try:
+            with urllib.request.build_opener(redirects).open(request, timeout=self.timeout) as r:
+                return FetchResult(url, r.status, self._headers(r), self._read(url, r), redirects.permanent_url(r))
+        except urllib.error.HTTPError as e:
+            # non-2xx statuses (including 304) are left to the caller
+            return FetchResult(url, e.code, self._headers(e), self._read(url, e), redirects.permanent_url(e))
+
+    def _read(self, url: str, r):
+        body = r.read(self.max_body + 1)
+        if len(body) > self.max_body:
+            raise BodyTooLarge(url, self.max_body)
+        return body
+
+    def _headers(self, r):
+        return { key.lower(): value for key, value in r.headers.items() }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+class RedirectRecorder(urllib.request.HTTPRedirectHandler):
+    """Follows redirects for a single request, keeping their statuses"""
+    # followed as 307s, which urllib before Python 3.11 does not know
+    http_error_308 = urllib.request.HTTPRedirectHandler.http_error_307
+
+    def __init__(self):
+        self.statuses = []
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = super().redirect_request(req, fp, 307 if code == 308 else code, msg, headers, newurl)
+        if new is not None:
+            self.statuses.append(code)
+        return new
+
+    def permanent_url(self, r):
+        """Returns the url r was served from if every redirect to it was permanent, as AsyncFetcher does"""
+        if self.statuses and all(status in (301, 308) for status in self.statuses):
+            return r.geturl()
+        return None
+
+class ResponseCache(object):
+    """Keeps the last body downloaded from each url on disk, compressed, evicting the least recently used beyond max_bytes
+
+    This lets a feed which is new to the bot's process (such as one which no
+    chat had been subscribed to since the last restart) be fetched
+    conditionally, rather than downloaded in full.
+    """
+    def __init__(self, filename: str, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.db_filename = filename
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                headers TEXT,
+                body BLOB,
+                size INTEGER,
+                used REAL
+            );
+            CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+        """)
+        self._lock = threading.Lock()
+
+    def get(self, url: str):
+        """Returns the CachedResponse last stored for url, or None."""
+        with self._lock, self.db:
+            row = self.db.execute("SELECT headers, body FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE responses SET used = ? WHERE url = ?", (time.time(), url))
+        return CachedResponse(json.loads(row[0]), zlib.decompress(row[1]))
+
+    def put(self, url: str, headers: dict, body: bytes):
+        compressed = zlib.compress(body)
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (url, json.dumps(headers), compressed, len(compressed), time.time()),
+            )
+            # summed afresh each time, as other processes may share the database
+            self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            while self.size > self.max_bytes:
+                evicted = self.db.execute("SELECT url, size FROM responses ORDER BY used LIMIT 100").fetchall()
+                for url, size in evicted:
+                    if self.size <= self.max_bytes:
+                        break
+                    self.db.execute("DELETE FROM responses WHERE url = ?", (url,))
+                    self.size -= size
+
+    def close(self):
+        with self._lock:
+            self.db.close()
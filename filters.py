@@ -0,0 +1,205 @@
+import logging
+import re
+import threading
+
+import regex
+
+from fpwrapper import canonicalize
+from templates import BoundedCache
+
+logger = logging.getLogger(__name__)
+
+# number of entries whose matches are kept, so that each is scanned once for every chat
+MATCH_CACHE = 4096
+# longest regex accepted, and the number of characters of each entry regexes are run against
+MAX_PATTERN = 100
+MAX_REGEX_TEXT = 2000
+# seconds a regex may take to search an entry, and the number of times it may
+# run out of them (as a busy machine slows every regex down) before it is no
+# longer run
+SLOW_REGEX = 0.05
+SLOW_STRIKES = 3
+
+class FilterError(Exception):
+    def __init__(self, rule, message):
+        self.rule = rule
+        self.message = message
+
+def parse_rule(text: str):
+    """Returns the (kind, pattern) of a filter rule, which is a /regex/ or otherwise a keyword, both matched regardless of case."""
+    text = text.strip()
+    if len(text) > 2 and text.startswith("/") and text.endswith("/"):
+        if len(text) - 2 > MAX_PATTERN:
+            raise FilterError(text, f"regexes may be at most {MAX_PATTERN} characters long")
+        try:
+            regex.compile(text[1:-1], regex.IGNORECASE)
+        except regex.error as e:
+            raise FilterError(text, str(e))
+        return ("regex", text[1:-1])
+    if not text:
+        raise FilterError(text, "the rule is empty")
+    return ("keyword", text.lower())
+
+def entry_text(entry):
+    """Returns the parts of an entry filters are matched against: its title, summary and tags."""
+    tags = [ tag.get("term", "") or "" for tag in entry.get("tags", None) or () if isinstance(tag, dict) ]
+    return "\n".join([ entry.get("title", "") or "", entry.get("summary", "") or "" ] + tags)
+
+class Matcher(object):
+    """Matches entries against every rule of a feed's subscribers at once
+
+    Keywords are found in a single pass of one regex, which looks ahead for
+    the longest keyword at each position; the keywords it is prefixed by are
+    implied. Regexes are each run once, and only if their alternation found
+    anything. They run without holding the GIL, and are stopped after
+    SLOW_REGEX seconds; regexes stopped too often are added to disabled and
+    no longer run, and on_disable is called with them.
+    """
+    def __init__(self, rules: set, disabled: set = None, on_disable=None):
+        self.disabled = disabled if disabled is not None else set()
+        self.on_disable = on_disable
+        keywords = sorted({ pattern for kind, pattern in rules if kind == "keyword" }, key=len, reverse=True)
+        self.keywords = re.compile(
+            "(?=({}))".format("|".join(map(re.escape, keywords)))
+        ) if keywords else None
+        self.prefixes = {
+            keyword: { ("keyword", other) for other in keywords if keyword.startswith(other) }
+            for keyword in keywords
+        }
+        self._compile_regexes({ rule for rule in rules if rule[0] == "regex" })
+        self.strikes = {}
+        self.matches = BoundedCache(MATCH_CACHE)
+
+    def _compile_regexes(self, rules: set):
+        regexes = [
+            (rule, regex.compile(rule[1], regex.IGNORECASE))
+            for rule in sorted(rules - self.disabled)
+        ]
+        try:
+            any_regex = regex.compile(
+                "|".join(f"(?:{pattern})" for (kind, pattern), compiled in regexes),
+                regex.IGNORECASE,
+            )
+        except regex.error:
+            # e.g. inline flags, which are only allowed at the start
+            any_regex = None
+        self.regexes, self.any_regex = regexes, any_regex
+
+    def match(self, entry):
+        """Returns the set of rules an entry matches, computed once per entry."""
+        return self.matches.get((entry,), lambda: self._match(entry_text(entry)))
+
+    def _match(self, text: str):
+        matched = set()
+        if self.keywords is not None:
+            for keyword in { m.group(1) for m in self.keywords.finditer(text.lower()) }:
+                matched |= self.prefixes[keyword]
+        regexes, any_regex = self.regexes, self.any_regex
+        if regexes:
+            text = text[:MAX_REGEX_TEXT]
+            try:
+                found = any_regex is None or any_regex.search(text, timeout=SLOW_REGEX, concurrent=True)
+            except TimeoutError:
+                # each regex is run to find out which is slow
+                found = True
+            if found:
+                for rule, compiled in regexes:
+                    try:
+                        if compiled.search(text, timeout=SLOW_REGEX, concurrent=True):
+                            matched.add(rule)
+                    except TimeoutError:
+                        self._strike(rule)
+        return frozenset(matched)
+
+    def _strike(self, rule: tuple):
+        self.strikes[rule] = self.strikes.get(rule, 0) + 1
+        if self.strikes[rule] < SLOW_STRIKES or rule in self.disabled:
+            return
+        logger.warning("Disabling filter /%s/, which took over %ss to search %s entries", rule[1], SLOW_REGEX, SLOW_STRIKES)
+        self.disabled.add(rule)
+        self._compile_regexes({ rule for rule, compiled in self.regexes })
+        if self.on_disable is not None:
+            self.on_disable(rule)
+
+class FilterIndex(object):
+    """Holds every chat's filters by feed, compiling each feed's into one Matcher which is rebuilt only when they change
+
+    Rules are parsed when they are registered, and only parsed again if the
+    rules stored for the chat change. on_disable, if set, is called with
+    (owner, feed url, rule) for each filter using a regex which was turned off.
+    """
+    def __init__(self):
+        self.rules = {} # canonical url -> {owner: (include rules, exclude rules)}
+        self.sources = {} # (canonical url, owner) -> (feed url, filters the rules were parsed from)
+        self.matchers = {} # canonical url -> Matcher
+        # regexes found to be too slow, which are not run for any feed
+        self.disabled = set()
+        self.on_disable = None
+        self._lock = threading.Lock()
+
+    def update(self, feed_url: str, owner, filters: dict = None):
+        """Registers owner's filters ({"include": [rules], "exclude": [rules]}) for feed_url, or drops them if there are none."""
+        url = canonicalize(feed_url)
+        source = tuple(tuple((filters or {}).get(kind, ())) for kind in ("include", "exclude"))
+        with self._lock:
+            if self.sources.get((url, owner), (None, ((), ())))[1] == source:
+                return
+        rules = tuple(tuple(parse_rule(rule) for rule in kind) for kind in source)
+        with self._lock:
+            owners = self.rules.setdefault(url, {})
+            if any(rules):
+                owners[owner] = rules
+                self.sources[(url, owner)] = (feed_url, source)
+            else:
+                owners.pop(owner, None)
+                self.sources.pop((url, owner), None)
+                if not owners:
+                    del self.rules[url]
+            self.matchers.pop(url, None)
+
+    def matcher(self, url: str):
+        with self._lock:
+            matcher = self.matchers.get(url, None)
+            if matcher is None:
+                rules = { rule for include, exclude in self.rules.get(url, {}).values() for rule in include + exclude }
+                matcher = self.matchers[url] = Matcher(rules, self.disabled, self._disabled)
+            return matcher
+
+    def _disabled(self, rule: tuple):
+        users = []
+        with self._lock:
+            for url, owners in self.rules.items():
+                for owner, (include, exclude) in owners.items():
+                    if rule in include + exclude:
+                        users.append((owner, self.sources[(url, owner)][0]))
+                        # other feeds' matchers stop running it too
+                        self.matchers.pop(url, None)
+        if self.on_disable is not None:
+            for owner, feed_url in users:
+                self.on_disable(owner, feed_url, f"/{rule[1]}/")
+
+    def apply(self, feed_url: str, owner, filters: dict, entries: list):
+        """Returns the entries of feed_url which pass owner's filters: those matching one of any include rules, and none of the exclude rules.
+
+        Rules which were turned off are ignored, as if they had been removed.
+        """
+        if not filters or not (filters.get("include", None) or filters.get("exclude", None)):
+            return entries
+        url = canonicalize(feed_url)
+        # registered here too, so that filters are in the feed's matcher
+        # however the chat was loaded
+        self.update(feed_url, owner, filters)
+        with self._lock:
+            include, exclude = self.rules.get(url, {}).get(owner, ((), ()))
+        include = [ rule for rule in include if rule not in self.disabled ]
+        exclude = [ rule for rule in exclude if rule not in self.disabled ]
+        if not include and not exclude:
+            return entries
+        matcher = self.matcher(url)
+        return [
+            entry for entry in entries
+            if (not include or any(rule in matcher.match(entry) for rule in include))
+            and not any(rule in matcher.match(entry) for rule in exclude)
+        ]
+
+filters = FilterIndex()
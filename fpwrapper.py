@@ -1,81 +1,421 @@
+import bisect
+import email.utils
+import hashlib
+import random
+import re
 import sys
+import threading
 import time
+import traceback
+import xml.parsers.expat
+from array import array
+from collections import deque
 from concurrent import futures
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import feedparser
 
+from fetcher import UrllibFetcher
+from metrics import Timer, metrics
+
+# number of non-empty polls retained per feed for subscribers to catch up on
+BACKLOG_LENGTH = 100
+# number of entries per feed a collection buffers between digests
+BUFFER_LENGTH = 200
+# number of polls which returned new entries remembered for estimating a feed's cadence
+CADENCE_LENGTH = 10
+
+# entries remembered per feed to tell new entries apart, beyond those still in the feed,
+# and how long (in seconds) an entry which has left the feed is remembered for
+SEEN_LENGTH = 1000
+SEEN_MAX_AGE = 90 * 24 * 60 * 60
+# fingerprints (up to 3 per entry) of entries sent to a chat remembered to drop
+# copies of them from its other feeds, and for how long (in seconds)
+DELIVERED_LENGTH = 600
+DELIVERED_MAX_AGE = 2 * 24 * 60 * 60
+# shortest normalized title which identifies an entry across feeds
+DISTINCT_TITLE = 24
+# query parameters which only track where a link was followed from
+TRACKING_PARAMS = re.compile(r"^(utm_\w+|fbclid|gclid|mc_cid|mc_eid|ref|ref_src)$")
+
+# exponential backoff (in seconds) applied to a feed after consecutive failed polls
+BACKOFF_BASE = 60
+BACKOFF_MAX = 24 * 60 * 60
+# consecutive failures across a host's feeds before its circuit breaker opens,
+# and the bounds of how long it then stays open
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+BREAKER_COOLDOWN_MAX = 60 * 60
+
+# fields kept from feedparser's results, as only these are used by the bot;
+# entries are made of plain dicts so they are cheap to pass between processes
+FEED_FIELDS = ("title", "subtitle", "link", "description", "ttl", "sy_updateperiod", "sy_updatefrequency")
+ENTRY_FIELDS = ("id", "link", "title", "summary", "author", "published", "updated")
+# further fields of entries which are only kept for feeds whose reprs reference them
+EXTRA_ENTRY_FIELDS = ("content", "tags", "enclosures", "comments", "contributors", "media_content", "media_thumbnail", "source", "license")
+# fields of entries which are interned, as they are short and repeated across chats' buffers
+INTERNED_FIELDS = ("id", "link", "title", "author", "published", "updated")
+
+# parts of a feed's state maintained by whichever process polls it (see shards.py)
+POLL_FIELDS = (
+    "url", "seen", "legacy_links", "etag", "modified", "last_polled", "updates",
+    "hint", "feed_hint", "failures", "retry_at", "gone", "last_error", "digest",
+    "newest_first", "metadata", "hub", "topic",
+)
+
+# consecutive entries already seen after which the rest of a newest-first feed is not parsed
+STREAM_OVERLAP = 3
+
+# seconds in each sy:updatePeriod
+UPDATE_PERIODS = {
+    "hourly": 60 * 60,
+    "daily": 24 * 60 * 60,
+    "weekly": 7 * 24 * 60 * 60,
+    "monthly": 30 * 24 * 60 * 60,
+    "yearly": 365 * 24 * 60 * 60,
+}
+
 class Feed(object):
-    def __init__(self, feed_url: str):
-        self.url = feed_url
-        self.previous_entries = []
+    __slots__ = (
+        "url", "key", "seen", "legacy_links", "etag", "modified", "serial",
+        "backlog", "last_polled", "updates", "hint", "feed_hint", "failures", "retry_at",
+        "gone", "last_error", "digest", "newest_first", "metadata",
+        "hub", "topic", "push", "_lock",
+    )
+
+    def __init__(self, feed_url: str, response=None, cached=None):
+        self.url = sys.intern(feed_url)
+        # the canonical url the feed is registered under, which is kept
+        # even if the feed is later redirected
+        self.key = canonicalize(feed_url)
+        self.seen = SeenIndex()
+        self.legacy_links = None
         self.etag = ""
         self.modified = ""
+        self.serial = 0
+        self.backlog = deque(maxlen=BACKLOG_LENGTH)
+        self.last_polled = 0
+        self.updates = deque(maxlen=CADENCE_LENGTH)
+        self.hint = 0
+        # the interval hinted by the body last parsed, which still applies
+        # while it is unchanged
+        self.feed_hint = 0
+        self.failures = 0
+        self.retry_at = 0
+        self.gone = False
+        self.last_error = ""
+        # digest of the body last parsed, or None if none has been yet
+        self.digest = None
+        # whether entries were listed newest first when the feed was last parsed
+        self.newest_first = False
+        # the WebSub hub and topic the feed advertises, if any, and the state
+        # of its subscription to the hub (see websub.py)
+        self.hub = ""
+        self.topic = ""
+        self.push = None
+        self._lock = threading.Lock()
+
+        # grab feed metadata and populate the seen index
+        self.get_new_entries(response, cached)
+        self.last_polled = time.time()
+        # quiet feeds back off from when they were first seen, as their
+        # initial entries are not counted as updates
+        self.updates.append(self.last_polled)
+
+    def __getstate__(self):
+        return {
+            name: getattr(self, name) for name in self.__slots__
+            if name != "_lock" and hasattr(self, name)
+        }
+
+    def __setstate__(self, state):
+        # feeds persisted before they were shared have no backlog
+        defaults = {
+            "key": canonicalize(state["url"]),
+            "legacy_links": None,
+            "etag": "",
+            "modified": "",
+            "serial": 0,
+            "backlog": deque(maxlen=BACKLOG_LENGTH),
+            "last_polled": 0,
+            "updates": deque(maxlen=CADENCE_LENGTH),
+            "hint": 0,
+            "feed_hint": 0,
+            "failures": 0,
+            "retry_at": 0,
+            "gone": False,
+            "last_error": "",
+            "digest": None,
+            "newest_first": False,
+            "hub": "",
+            "topic": "",
+            "push": None,
+        }
+        # feeds persisted before failures were tracked as data had their
+        # get_new_entries method rebound to pause or disable updates
+        if "_get_new_entries" in state:
+            defaults["retry_at"] = state.get("delay_until", 0)
+            defaults["failures"] = 1
+        elif "get_new_entries" in state:
+            defaults["gone"] = True
+        # feeds persisted before the seen index recognise entries by link
+        # until their next successful poll
+        if "seen" not in state:
+            defaults["seen"] = SeenIndex()
+            defaults["legacy_links"] = set(state.get("previous_entries", ())) or None
+        # anything else feeds used to keep, such as rebound methods, is dropped
+        for name in self.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+            elif name in defaults:
+                setattr(self, name, defaults[name])
+        if not self.updates and self.last_polled:
+            # feeds which have not updated since they were persisted back
+            # off from then
+            self.updates.append(self.last_polled)
+        self.url = sys.intern(self.url)
+        self.key = sys.intern(self.key)
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        # route unpickling through the registry, so that chats restored
+        # from persistence continue to share a single instance per url
+        return (_restore_feed, (self.__getstate__(),))
+
+    def poll(self, max_age: float = 0, response=None):
+        """Calls get_new_entries unless the feed was polled within max_age seconds, recording any results in the backlog."""
+        with self._lock:
+            if response is None and time.time() - self.last_polled < max_age:
+                return False
+            result = self.get_new_entries(response)
+            self.last_polled = time.time()
+            if isinstance(result, tuple):
+                # keep the traceback as text, as it must survive pickling
+                self.last_error = "".join(traceback.format_exception(*result))
+                # only notify subscribers when the feed starts failing,
+                # rather than on every retry
+                result = self.last_error if self.failures == 1 else []
+            if result:
+                self.serial += 1
+                self.backlog.append((self.serial, result))
+            if isinstance(result, list) and result:
+                self.updates.append(self.last_polled)
+                self._archive(result)
+            registry.mark_feed(self.key)
+            return bool(result)
 
-        # grab feed metadata and populate previous_entries
-        self.get_new_entries()
+    def merge(self, state: dict, result=None):
+        """Takes on the polling state of a copy of this feed polled elsewhere, recording result (as returned by get_new_entries) in the backlog as poll does."""
+        with self._lock:
+            # states may arrive out of order, and only the latest is kept
+            if state.get("last_polled", 0) >= self.last_polled:
+                for name in POLL_FIELDS:
+                    if name not in state:
+                        continue
+                    seen = state[name] if name == "seen" else None
+                    if seen is not None and seen.hashes == self.seen.hashes and seen.times == self.seen.times:
+                        # the index is kept, so that persistence can tell it is unchanged
+                        continue
+                    setattr(self, name, state[name])
+            if result:
+                self.serial += 1
+                self.backlog.append((self.serial, result))
+            if isinstance(result, list) and result:
+                self._archive(result)
+            registry.mark_feed(self.key)
+            return bool(result)
 
-    def get_new_entries(self):
-        """Downloads and parses the RSS feed, returning new entries (by timestamp)."""
+    def polling_state(self):
+        """Returns the parts of the feed's state which a copy of it needs to be polled elsewhere."""
+        with self._lock:
+            return { name: getattr(self, name) for name in ("key",) + POLL_FIELDS if hasattr(self, name) }
+
+    def push_entries(self, body: bytes, headers: dict):
+        """Records new entries in content pushed by a hub into the backlog, as poll does for downloaded ones, returning whether there were any."""
+        with self._lock:
+            d = registry.parse(body, headers, None, registry.entry_fields.get(self.key, ()))
+            # hubs push only what is new, so the rest of the feed is not known
+            entries = self._unseen(d["entries"], complete=False)
+            if not entries:
+                return False
+            self.serial += 1
+            self.backlog.append((self.serial, entries))
+            self.updates.append(time.time())
+            self._archive(entries)
+            registry.mark_feed(self.key)
+            return True
+
+    def _archive(self, entries: list):
+        # only queued here; the archive writes entries in batches
+        if registry.archive is not None:
+            registry.archive.add(self.key, entries)
+
+    def push_active(self):
+        """Returns whether a hub has confirmed it pushes the feed's updates."""
+        return self.push is not None and self.push.get("expires", 0) > time.time()
+
+    def next_interval(self, minimum: float, maximum: float, default: float):
+        """Returns the number of seconds to wait before polling again, based on the feed's cadence and any hints it provided."""
+        now = time.time()
+        if len(self.updates) >= 2:
+            # poll twice per average gap between updates, backing off
+            # further if the feed has since been quiet for longer
+            gap = (self.updates[-1] - self.updates[0]) / (len(self.updates) - 1)
+            interval = max(gap, now - self.updates[-1]) / 2
+        elif self.updates:
+            interval = max(default, (now - self.updates[-1]) / 2)
+        else:
+            interval = default
+        # the server's hints may only slow polling down
+        interval = max(interval, self.hint)
+        interval = min(max(interval, minimum), maximum)
+        # failures are retried no earlier than their backoff allows
+        return max(interval, self.blocked_until() - now)
+
+    def ready(self):
+        """Returns whether the feed may be downloaded now, given its own and its host's failures."""
+        return not self.gone and time.time() >= self.retry_at and breakers.allow(self.url)
+
+    def blocked_until(self):
+        """Returns the time before which the feed will not be downloaded, due to its own failures or its host's."""
+        return max(self.retry_at, breakers.open_until(self.url))
+
+    def _record_failure(self):
+        self.failures += 1
+        delay = min(BACKOFF_BASE * 2 ** (self.failures - 1), BACKOFF_MAX)
+        # jitter so feeds which failed together are not retried together
+        self.retry_at = time.time() + random.uniform(delay / 2, delay)
+
+    def _record_success(self):
+        self.failures = 0
+        self.retry_at = 0
+        self.last_error = ""
+
+    def entries_since(self, cursor: int):
+        """Returns entries recorded in the backlog after cursor, or the traceback of a failed poll."""
+        entries = []
+        for serial, result in list(self.backlog):
+            if serial <= cursor:
+                continue
+            if isinstance(result, str):
+                return result
+            # keep the newest entries first, as feeds list them
+            entries = result + entries
+        return entries
+
+    def get_new_entries(self, response=None, cached=None):
+        """Downloads and parses the RSS feed, returning new entries (by timestamp).
+
+        response may be a Future of a FetchResult already requested by the
+        caller (who is then responsible for having checked ready()), with
+        cached the CachedResponse whose validators it was requested with.
+        """
+        if self.gone:
+            return self._nullupdate()
+        if response is None and not self.ready():
+            # backing off, either from this feed or from its host
+            return []
         try:
-            # xml/rss parsing and feedparser are complex beasts
-            d = feedparser.parse(self.url, etag=self.etag, modified=self.modified)
+            if response is None:
+                if self.digest is None:
+                    # a feed new to this process may have been downloaded before it was
+                    cached = registry.cached(self.url)
+                if cached is not None:
+                    response = registry.fetcher.fetch(self.url, *cached.validators())
+                else:
+                    response = registry.fetcher.fetch(self.url, self.etag, self.modified)
+            else:
+                response = response.result()
+            status, headers, body = response.status, response.headers, response.body
+            if status == 304 and cached is not None:
+                # parse the cached body as if it had just been downloaded
+                status, headers, body = 200, cached.headers, cached.body
+            digest = body_digest(body) if status < 300 else None
+            if status == 304 or (digest is not None and digest == self.digest):
+                # unchanged bodies are not parsed again, even if the server
+                # did not send validators to have them not be downloaded
+                status = 304
+                d = {"feed": {}, "entries": []}
+            else:
+                # entries past those already seen are only parsed if the feed is
+                # not known to list its entries newest first
+                seen = frozenset(self.seen.hashes) if self.newest_first and len(self.seen) and not self.seen.stale else None
+                # xml/rss parsing and feedparser are complex beasts
+                with Timer() as timer:
+                    d = registry.parse(body, headers, seen, registry.entry_fields.get(self.key, ()))
+                metrics.observe("parse_seconds", timer.elapsed)
+                metrics.count("parsed_entries_total", len(d["entries"]))
+                metrics.cost(self.url, seconds=timer.elapsed, entries=len(d["entries"]))
         except Exception:
             # so we just ignore anything that goes wrong with it
             # and worry about it later.
-            self.pause_updates()
-            self._nullupdate()
+            self._record_failure()
+            breakers.record(self.url, False)
+            if not hasattr(self, "metadata"):
+                self._nullupdate()
             return sys.exc_info()
 
-        if d.get("status", None) == 301:
+        if status < 300:
+            # only bodies which were parsed carry the feed's own hints
+            self.feed_hint = hinted_interval(d["feed"], status, {})
+        self.hint = max(self.feed_hint, hinted_interval({}, status, response.headers))
+        # server errors count against the host as well as the feed
+        breakers.record(self.url, status < 500 and status != 429)
+
+        if response.permanent_url:
             # if the feed is permanently redirected, update the feed url
-            self.url = d.get("href", self.url)
-        if d.get("status", None) == 304:
+            self.url = response.permanent_url
+        if status == 304:
             # if the server returns a Not Modified, return no entries
+            self._record_success()
             return []
-        if d.get("status", None) == 410:
+        if status == 410:
             # if the feed is Gone, disable future feedparser calls
-            self.get_new_entries = self._nullupdate
+            self.gone = True
             return self._nullupdate()
+        if status >= 400:
+            self._record_failure()
+            if not hasattr(self, "metadata"):
+                # a feed whose first download fails is still rendered
+                self._nullupdate()
+            return []
+        self._record_success()
 
         # update feed metadata
         self.metadata = {
-            "title": d.feed.get("title", f"Untitled feed - {self.url}"),
-            "subtitle": d.feed.get("subtitle", ""),
-            "link": d.feed.get("link", self.url),
-            "description": d.feed.get("description", "")
+            "title": sys.intern(d["feed"].get("title", f"Untitled feed - {self.url}")),
+            "subtitle": d["feed"].get("subtitle", ""),
+            "link": sys.intern(d["feed"].get("link", self.url)),
+            "description": d["feed"].get("description", "")
         }
 
-        self.etag = d.get("etag", None)
-        self.modified = d.get("modified", None)
+        self.etag = headers.get("etag", None)
+        self.modified = headers.get("last-modified", None)
+        self.digest = digest
+        self.newest_first = d.get("newest_first", False)
+        self.hub = d["feed"].get("hub", "")
+        self.topic = d["feed"].get("self", "") or self.url
+        if registry.cache is not None and digest is not None:
+            registry.cache.put(self.url, headers, body)
 
-        # cherry-pick only entries which do not match URLs from previous update
+        return self._unseen(d["entries"], d.get("complete", True))
+
+    def _unseen(self, entries: list, complete: bool = True):
+        # cherry-pick only entries which have not been seen before
         # this approach works for feeds which contain all posts ever published
         # as well as feeds which maintain a rolling window of latest entries.
-        if d.entries:
-            entries = [
-                entry for entry in d.entries
-                if entry.get("link", "") not in self.previous_entries
-            ]
-            self.previous_entries = [entry.get("link", "") for entry in d.entries]
-        else:
-            entries = []
-
-        return entries
-
-    def pause_updates(self, duration: float = 24 * 60 * 60):
-        """Rewrites get_new_updates to not download the feed, and return no entries, until duration is elapsed."""
-        self._get_new_entries = self.get_new_entries
-        self.get_new_entries = self._deferupdate
-        self.delay_until = time.time() + duration
-
-    def _deferupdate(self):
-        if time.time() >= self.delay_until:
-            # restore get_new_entries, and let it take over
-            self.get_new_entries = self._get_new_entries
-            del self._get_new_entries
-            return self.get_new_entries()
-        else:
+        if not entries:
             return []
+        now = time.time()
+        entries = [
+            Entry(entry) for entry in entries
+            if not self.seen.add(fingerprint(entry), now)
+            and not (self.legacy_links and entry.get("link", "") in self.legacy_links)
+        ]
+        self.seen.evict(now, complete)
+        self.legacy_links = None
+        metrics.count("new_entries_total", len(entries))
+        return entries
 
     def _nullupdate(self):
         self.metadata = {
@@ -84,25 +424,713 @@ class Feed(object):
         }
         return []
 
+    # feeds pickled before failures were tracked as data reference these
+    # names through rebound methods, which must still resolve when loaded
+    _deferupdate = get_new_entries
+
+def body_digest(body: bytes):
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+def fingerprint(entry: dict):
+    """Returns a 64-bit hash identifying an entry by its guid, falling back to its link and then its content."""
+    key = entry.get("id", "") or entry.get("link", "")
+    if not key:
+        key = "\0".join((entry.get("title", ""), entry.get("summary", "")))
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+def normalize_link(link: str):
+    """Normalizes a link to an entry as reposted by other feeds, ignoring its scheme, a www. prefix, tracking parameters and fragment."""
+    parts = urlsplit(link.strip())
+    netloc = parts.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    if netloc.endswith((":80", ":443")):
+        netloc = netloc.rpartition(":")[0]
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not TRACKING_PARAMS.match(key)
+    ))
+    return f"{netloc}{parts.path.rstrip('/') or '/'}?{query}"
+
+def entry_keys(entry: dict):
+    """Returns 64-bit hashes identifying an entry across feeds: by its normalized link, its guid if globally unique, and its title if distinctive."""
+    keys = set()
+    link = entry.get("link", "")
+    if link:
+        keys.add("link\0" + normalize_link(link))
+    guid = entry.get("id", "")
+    if guid.startswith(("http://", "https://")):
+        keys.add("link\0" + normalize_link(guid))
+    elif ":" in guid:
+        # e.g. tag: and urn: uris; other guids may only be unique within their feed
+        keys.add("id\0" + guid)
+    title = " ".join(re.findall(r"\w+", entry.get("title", "").lower()))
+    if len(title) >= DISTINCT_TITLE:
+        keys.add("title\0" + title)
+    return [
+        int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+        for key in keys
+    ]
+
+class DeliveredIndex(object):
+    """Fingerprints of entries recently sent to a chat from any of its feeds, oldest first, along with the feed each was sent from
+
+    Lookups scan the fingerprints rather than going through a dict, so that
+    each costs only its 24 bytes in the chat's data. Only copies from other
+    feeds are dropped, as a feed's own entries may share a link (e.g. to its
+    homepage, or to anchors within a single page) and still be distinct.
+    """
+    def __init__(self, max_length: int = DELIVERED_LENGTH, max_age: float = DELIVERED_MAX_AGE):
+        self.max_length = max_length
+        self.max_age = max_age
+        self.hashes = array("Q")
+        self.sources = array("Q")
+        self.times = array("d")
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "sources" not in state:
+            # indexes persisted before sources were kept match every feed
+            self.sources = array("Q", bytes(8 * len(self.hashes)))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def unseen(self, entries: list, feed_key: str):
+        """Returns the entries of the feed registered under feed_key which are not copies of those sent already from other feeds, remembering them as sent."""
+        now = time.time()
+        source = int.from_bytes(hashlib.blake2b(feed_key.encode("utf-8"), digest_size=8).digest(), "big")
+        kept = []
+        with self._lock:
+            for entry in entries:
+                keys = entry_keys(entry)
+                if any(self._sent_elsewhere(h, source) for h in keys):
+                    continue
+                kept.append(entry)
+                for h in keys:
+                    self.hashes.append(h)
+                    self.sources.append(source)
+                    self.times.append(now)
+            # fingerprints are appended in the order they are sent, so the
+            # oldest are at the front
+            start = max(bisect.bisect_left(self.times, now - self.max_age), len(self.hashes) - self.max_length)
+            if start > 0:
+                del self.hashes[:start]
+                del self.sources[:start]
+                del self.times[:start]
+        return kept
+
+    def _sent_elsewhere(self, h: int, source: int):
+        # most fingerprints are not found, which the first scan tells quickly
+        return h in self.hashes and any(
+            other != source for other_hash, other in zip(self.hashes, self.sources) if other_hash == h
+        )
+
+class SeenIndex(object):
+    """Bounded set of entry fingerprints, evicting those which have not been seen for longest
+
+    Fingerprints and the time each was last seen are kept in arrays, which is
+    all that is pickled; a dict of positions for lookups is rebuilt on load.
+    changes counts modifications since then, so that persistence can tell
+    whether the index needs writing.
+
+    Feeds may be parsed only in part, e.g. when cut short after the entries
+    already seen. The entries past the cut are not seen again, so anything
+    seen when the feed was last parsed whole is kept until it is parsed
+    whole again, which is asked for by stale once that has grown too much.
+    """
+    def __init__(self, max_length: int = SEEN_LENGTH, max_age: float = SEEN_MAX_AGE):
+        self.max_length = max_length
+        self.max_age = max_age
+        self.hashes = array("Q")
+        self.times = array("d")
+        # when the feed was last parsed whole, and how many entries it had then
+        self.complete_at = 0
+        self.complete_length = 0
+        self.stale = False
+        self.changes = 0
+        self._positions = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_positions"]
+        del state["changes"]
+        return state
+
+    def __setstate__(self, state):
+        # indexes persisted before feeds were parsed in part keep everything
+        # until the feed is next parsed whole
+        self.complete_at = 0
+        self.complete_length = 0
+        self.stale = False
+        self.__dict__.update(state)
+        self.changes = 0
+        self._positions = { h: i for i, h in enumerate(self.hashes) }
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, h: int):
+        return h in self._positions
+
+    def add(self, h: int, now: float):
+        """Marks h as seen at now, returning whether it had already been seen."""
+        self.changes += 1
+        position = self._positions.get(h, None)
+        if position is not None:
+            self.times[position] = now
+            return True
+        self._positions[h] = len(self.hashes)
+        self.hashes.append(h)
+        self.times.append(now)
+        return False
+
+    def evict(self, now: float, complete: bool = True):
+        """Forgets fingerprints older than max_age, then the oldest beyond max_length, sparing any seen at now.
+
+        If the feed was only parsed in part, those seen when it was last
+        parsed whole are spared too, as they may be in the part not parsed.
+        """
+        if complete:
+            self.complete_at = now
+            self.complete_length = sum(1 for t in self.times if t >= now)
+        spare = self.complete_at
+        cutoff = min(now - self.max_age, spare)
+        if len(self.hashes) > self.max_length or (self.times and min(self.times) < cutoff):
+            kept = sorted(
+                (
+                    (t, h) for h, t in zip(self.hashes, self.times)
+                    if t >= cutoff
+                ),
+                reverse=True,
+            )
+            # entries which may still be present in the feed are never evicted
+            current = sum(1 for t, h in kept if t >= spare)
+            kept = kept[:max(self.max_length, current)]
+            self.changes += 1
+            self.hashes = array("Q", (h for t, h in kept))
+            self.times = array("d", (t for t, h in kept))
+            self._positions = { h: i for i, h in enumerate(self.hashes) }
+        # spared entries pile up until the feed is parsed whole again
+        self.stale = len(self.hashes) > self.complete_length + self.max_length
+
+class CircuitBreaker(object):
+    """Tracks consecutive failures of a host, refusing downloads from it for a cooldown once they pile up"""
+    def __init__(self):
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0
+        # when the download testing a half-open host started, or 0 if none is
+        self.trial = 0
+
+    def allow(self):
+        now = time.time()
+        if now < self.open_until:
+            return False
+        if self.opened and self.trial:
+            if now - self.trial < self._cooldown():
+                # half-open; a single download is already testing the host
+                return False
+            # the trial was never recorded (e.g. its feed was removed while it
+            # was downloaded), so it counts as failed and another takes its place
+            self.failures += 1
+            self.opened += 1
+        if self.opened:
+            self.trial = now
+        return True
+
+    def record(self, success: bool):
+        self.trial = 0
+        if success:
+            self.failures = 0
+            self.opened = 0
+            self.open_until = 0
+            return
+        self.failures += 1
+        if self.opened or self.failures >= BREAKER_THRESHOLD:
+            self.opened += 1
+            cooldown = self._cooldown()
+            self.open_until = time.time() + random.uniform(cooldown / 2, cooldown)
+
+    def _cooldown(self):
+        return min(BREAKER_COOLDOWN * 2 ** (self.opened - 1), BREAKER_COOLDOWN_MAX)
+
+class HostBreakers(object):
+    """Process-wide circuit breakers, one per host"""
+    def __init__(self):
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def allow(self, url: str):
+        with self._lock:
+            breaker = self.hosts.get(_host(url), None)
+            return breaker.allow() if breaker is not None else True
+
+    def record(self, url: str, success: bool):
+        with self._lock:
+            breaker = self.hosts.get(_host(url), None)
+            if breaker is None:
+                if success:
+                    return
+                breaker = self.hosts[_host(url)] = CircuitBreaker()
+            breaker.record(success)
+            if success:
+                # forget healthy hosts to keep the table small
+                del self.hosts[_host(url)]
+
+    def open_until(self, url: str):
+        with self._lock:
+            breaker = self.hosts.get(_host(url), None)
+            return breaker.open_until if breaker is not None else 0
+
+breakers = HostBreakers()
+
+def _host(url: str):
+    return urlsplit(url).netloc.lower()
+
+def parse_feed(body: bytes, headers: dict, seen: frozenset = None, fields: tuple = ()):
+    """Parses a feed document, returning only FEED_FIELDS and ENTRY_FIELDS (and any extra entry fields). Runs in the registry's parser processes.
+
+    If seen fingerprints are given, entries after the first STREAM_OVERLAP
+    consecutive ones already seen are left out, without being parsed.
+    """
+    prefix = _new_prefix(body, seen) if seen else None
+    d = feedparser.parse(prefix or body, response_headers=headers)
+    links = _links(d.feed, headers)
+    dates = [ entry.get("published_parsed", None) or entry.get("updated_parsed", None) for entry in d.entries ]
+    return {
+        "feed": dict(_compact(d.feed, FEED_FIELDS), **links),
+        "entries": [ _compact(entry, ENTRY_FIELDS + tuple(fields)) for entry in d.entries ],
+        "newest_first": len(dates) > 1 and all(dates) and all(a >= b for a, b in zip(dates, dates[1:])),
+        # whether every entry was parsed, rather than only those before the cut
+        "complete": prefix is None,
+    }
+
+def _links(feed: dict, headers: dict):
+    """Returns the hub and self links a feed advertises, preferring its Link header to its document."""
+    links = {}
+    for href, params in re.findall(r"<([^>]*)>([^,]*)", headers.get("link", "")):
+        rel = re.search(r"""rel=["']?([^"';]*)""", params)
+        for rel in (rel.group(1).split() if rel else ()):
+            if rel in ("hub", "self"):
+                links.setdefault(rel, href)
+    for link in feed.get("links", []):
+        if link.get("rel", None) in ("hub", "self") and link.get("href", None):
+            links.setdefault(link["rel"], link["href"])
+    return links
+
+class _Cut(Exception):
+    pass
+
+def _new_prefix(body: bytes, seen: frozenset):
+    """Returns body cut short after the first STREAM_OVERLAP consecutive entries in seen, or None if it has to be parsed whole.
+
+    The document is streamed through expat just far enough to find where to
+    cut it, and the open elements are closed after the cut so that it can
+    still be parsed as a feed. Documents expat cannot read are left whole.
+    """
+    if body.startswith((b"\xff\xfe", b"\xfe\xff")):
+        # cutting relies on tags being ASCII bytes, which they are not in UTF-16
+        return None
+    parser = xml.parsers.expat.ParserCreate()
+    stack = [] # qualified names of open elements
+    entry = None # { local name: text } of the entry being read
+    state = { "field": None, "overlap": 0 }
+
+    def start(name, attrs):
+        nonlocal entry
+        local = name.rpartition(":")[2]
+        if entry is not None:
+            if local == "link" and "href" in attrs and attrs.get("rel", "alternate") == "alternate":
+                entry.setdefault("link", attrs["href"])
+            state["field"] = local if local in ("guid", "id", "link") and not entry.get(local, None) else None
+            if state["field"]:
+                entry[local] = ""
+        elif local in ("item", "entry"):
+            entry = {}
+            state["depth"] = len(stack)
+        stack.append(name)
+    def end(name):
+        nonlocal entry
+        stack.pop()
+        state["field"] = None
+        if entry is not None and len(stack) == state["depth"]:
+            key = (entry.get("guid", "") or entry.get("id", "") or entry.get("link", "")).strip()
+            entry = None
+            if key and int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big") in seen:
+                state["overlap"] += 1
+                if state["overlap"] >= STREAM_OVERLAP:
+                    raise _Cut(parser.CurrentByteIndex)
+            else:
+                state["overlap"] = 0
+    def text(data):
+        if entry is not None and state["field"]:
+            entry[state["field"]] += data
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text
+    try:
+        parser.Parse(body, True)
+    except _Cut as cut:
+        # the index is that of the entry's end tag, which is kept
+        end_tag = body.index(b">", cut.args[0]) + 1
+        return body[:end_tag] + "".join(f"</{name}>" for name in reversed(stack)).encode("utf-8")
+    except xml.parsers.expat.ExpatError:
+        pass
+    return None
+
+def _compact(d: dict, fields: tuple):
+    return { field: _plain(d[field]) for field in fields if field in d }
+
+def _plain(value):
+    """Converts FeedParserDicts nested in a field to plain dicts."""
+    if isinstance(value, dict):
+        return { key: _plain(item) for key, item in value.items() }
+    if isinstance(value, list):
+        return [ _plain(item) for item in value ]
+    return value
+
+class Entry(tuple):
+    """Immutable record of an entry, made of (field, value) pairs for only the fields it has
+
+    Entries are read like the dicts they replace. Short fields are interned,
+    so that entries loaded separately (such as into several chats' buffers)
+    share their strings.
+    """
+    __slots__ = ()
+
+    def __new__(cls, fields):
+        return tuple.__new__(cls, (
+            (sys.intern(field), sys.intern(value) if field in INTERNED_FIELDS and type(value) is str else value)
+            for field, value in (fields.items() if isinstance(fields, dict) else fields)
+        ))
+
+    def __getitem__(self, key):
+        for field, value in tuple.__iter__(self):
+            if field == key:
+                return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return any(field == key for field, value in tuple.__iter__(self))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [ field for field, value in tuple.__iter__(self) ]
+
+    def items(self):
+        return list(tuple.__iter__(self))
+
+    def __repr__(self):
+        return f"Entry({dict(self.items())!r})"
+
+def hinted_interval(feed: dict, status: int, headers: dict):
+    """Returns the longest polling interval requested by a parsed feed or its response headers, in seconds."""
+    hints = [0]
+    try:
+        hints.append(int(feed.get("ttl", 0)) * 60)
+    except (TypeError, ValueError):
+        pass
+    period = UPDATE_PERIODS.get(str(feed.get("sy_updateperiod", "")).strip().lower(), None)
+    if period:
+        try:
+            hints.append(period / max(int(feed.get("sy_updatefrequency", 1)), 1))
+        except (TypeError, ValueError):
+            hints.append(period)
+
+    headers = { key.lower(): value for key, value in headers.items() }
+    max_age = re.search(r"max-age=(\d+)", headers.get("cache-control", ""))
+    if max_age:
+        hints.append(int(max_age.group(1)))
+    elif "expires" in headers:
+        hints.append(_seconds_until(headers["expires"]))
+    if status in (429, 503) and "retry-after" in headers:
+        hints.append(_seconds_until(headers["retry-after"]))
+    return max(hints)
+
+def _seconds_until(value: str):
+    """Parses an HTTP delay (in seconds) or date into a number of seconds from now."""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return 0
+
+class FeedRegistry(object):
+    """Process-wide mapping of canonical feed urls to the Feed instances shared by all chats"""
+    def __init__(self):
+        self.feeds = {}
+        self.subscribers = {}
+        self.scheduler = None
+        # keys of feeds, and owners of collections, changed since persistence last saved them
+        self.changed_feeds = set()
+        self.changed_owners = set()
+        # replaced with an AsyncFetcher by the bot; see fetcher.py
+        self.fetcher = UrllibFetcher()
+        # a ProcessPoolExecutor, or None to parse in the calling thread
+        self.parser = None
+        # a ResponseCache set by the bot, or None to not cache responses
+        self.cache = None
+        # a WebSub set by the bot, or None to only poll feeds
+        self.websub = None
+        # an EntryArchive set by the bot, or None to not archive entries
+        self.archive = None
+        # extra entry fields kept per feed, as requested by reprs
+        self.entry_fields = {}
+        # parses feeds downloaded by prepare
+        self.builder = futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="FeedRegistry")
+        self._lock = threading.Lock()
+        # guards changed_feeds and changed_owners, which are marked from
+        # polling threads while persistence takes them
+        self._changes_lock = threading.Lock()
+
+    def mark_feed(self, key: str):
+        """Records that the feed registered under key changed, for persistence to write it."""
+        with self._changes_lock:
+            self.changed_feeds.add(key)
+
+    def mark_owner(self, owner: tuple):
+        """Records that the collection owned by owner changed, for persistence to write its chat."""
+        with self._changes_lock:
+            self.changed_owners.add(owner)
+
+    def take_changes(self):
+        """Returns the sets of feeds and owners marked since this was last called, and starts new ones."""
+        with self._changes_lock:
+            changes = self.changed_feeds, self.changed_owners
+            self.changed_feeds, self.changed_owners = set(), set()
+        return changes
+
+    def forget_changes(self, feeds=(), owners=()):
+        """Unmarks feeds and owners, e.g. as they were only restored from persistence."""
+        with self._changes_lock:
+            self.changed_feeds.difference_update(feeds)
+            self.changed_owners.difference_update(owners)
+
+    def prepare(self, feed_url: str):
+        """Returns a Future of the shared Feed for feed_url, without subscribing to it.
+
+        Feeds not known yet are downloaded on the fetcher, and parsed by the
+        builder once downloaded, so that many may be prepared at once.
+        """
+        url = canonicalize(feed_url)
+        result = futures.Future()
+        with self._lock:
+            feed = self.feeds.get(url, None)
+        if feed is not None:
+            result.set_result(feed)
+            return result
+        cached = self.cached(url)
+        response = self.fetcher.submit(url, *(cached.validators() if cached is not None else ()))
+        response.add_done_callback(lambda response: self.builder.submit(self._build, result, url, response, cached))
+        return result
+
+    def _build(self, result: futures.Future, url: str, response: futures.Future, cached):
+        try:
+            result.set_result(Feed(url, response=response, cached=cached))
+        except Exception as e:
+            result.set_exception(e)
+
+    def subscribe(self, feed_url: str, owner: tuple, feed=None):
+        """Returns the shared Feed for feed_url, downloading it (unless it was prepared) if no chat is subscribed yet."""
+        url = canonicalize(feed_url)
+        if feed is None:
+            with self._lock:
+                feed = self.feeds.get(url, None)
+        if feed is None:
+            # download outside the lock so a slow feed does not stall other chats
+            feed = Feed(url)
+        feed = self.adopt(feed)
+        with self._lock:
+            self.subscribers.setdefault(url, set()).add((owner, feed_url))
+        return feed
+
+    def adopt(self, feed: Feed):
+        """Registers a Feed (e.g. one restored from persistence) unless its url is already known, returning the shared instance."""
+        url = feed.key
+        with self._lock:
+            added = url not in self.feeds
+            feed = self.feeds.setdefault(url, feed)
+        if added and self.scheduler is not None:
+            self.scheduler.schedule(url)
+        if added and self.websub is not None:
+            # hubs may still be pushing a feed restored with its subscription
+            self.websub.track(feed)
+        return feed
+
+    def unsubscribe(self, feed_url: str, owner: tuple):
+        """Releases a subscription, dropping the shared Feed once no chat follows it."""
+        url = canonicalize(feed_url)
+        dropped = None
+        with self._lock:
+            self.subscribers.get(url, set()).discard((owner, feed_url))
+            if not self.subscribers.get(url, None):
+                self.subscribers.pop(url, None)
+                dropped = self.feeds.pop(url, None)
+                self.mark_feed(url)
+                if self.scheduler is not None:
+                    self.scheduler.unschedule(url)
+        if dropped is not None:
+            metrics.forget(dropped.url)
+            if self.websub is not None:
+                self.websub.release(dropped)
+
+    def cached(self, url: str):
+        """Returns the CachedResponse last stored for url, if responses are cached."""
+        return self.cache.get(url) if self.cache is not None else None
+
+    def request_fields(self, feed_url: str, fields):
+        """Has entries of feed_url keep any EXTRA_ENTRY_FIELDS among fields (e.g. those referenced by a repr) from its next poll on."""
+        fields = set(fields) & set(EXTRA_ENTRY_FIELDS)
+        if fields:
+            url = canonicalize(feed_url)
+            with self._lock:
+                previous = self.entry_fields.get(url, ())
+                self.entry_fields[url] = tuple(sorted(fields.union(previous)))
+                feed = self.feeds.get(url, None)
+            if self.entry_fields[url] != previous and feed is not None and self.scheduler is not None:
+                # the feed may be polled in another process
+                self.scheduler.update(url, feed)
+
+    def parse(self, body: bytes, headers: dict, seen: frozenset = None, fields: tuple = ()):
+        if self.parser is None:
+            return parse_feed(body, headers, seen, fields)
+        return self.parser.submit(parse_feed, body, headers, seen, fields).result()
+
+    def subscribers_of(self, url: str):
+        """Returns (owner, feed_url) pairs for every collection subscribed to the canonical url."""
+        with self._lock:
+            return list(self.subscribers.get(url, ()))
+
+registry = FeedRegistry()
+
+def canonicalize(feed_url: str):
+    """Normalizes the parts of a url which do not affect the resource it points to."""
+    parts = urlsplit(feed_url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rpartition(":")[2]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rpartition(":")[0]
+    return sys.intern(urlunsplit((scheme, netloc, parts.path or "/", parts.query, "")))
+
+def _restore_feed(state: dict):
+    with registry._lock:
+        feed = registry.feeds.get(state.get("key", None) or canonicalize(state["url"]), None)
+    if feed is None:
+        feed = Feed.__new__(Feed)
+        feed.__setstate__(state)
+    return feed
+
 class FeedCollection(object):
-    def __init__(self, feed_urls: list, max_workers:int=5):
-        self.feeds = { url: Feed(url) for url in feed_urls }
-        self.workers = max_workers
-    
-    def get_new_entries(self):
-        with futures.ThreadPoolExecutor(max_workers=self.workers) as ex:
-            fs = { url: ex.submit(feed.get_new_entries) for url, feed in self.feeds.items() }
-            return { url: f.result() for url, f in fs.items() }
-    
-    def add_feed(self, feed_url: str):
+    def __init__(self, feed_urls: list, owner: tuple = None):
+        self.feeds = {}
+        self.cursors = {}
+        self.buffer = {}
+        self.owner = owner
+        for url in feed_urls:
+            self.add_feed(url)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # collections persisted before feeds were shared have no owner
+        # or cursors, and start from the latest poll once bound
+        self.__dict__.setdefault("owner", None)
+        self.__dict__.setdefault("cursors", {})
+        self.__dict__.setdefault("buffer", {})
+        self.__dict__.pop("workers", None)
+        for url, feed in list(self.feeds.items()):
+            self.feeds[url] = registry.adopt(feed)
+            self.cursors.setdefault(url, self.feeds[url].serial)
+        if self.owner is not None:
+            self.bind(self.owner)
+
+    def bind(self, owner: tuple):
+        """Sets the (chat_id, mode) owning this collection, and subscribes it to its feeds."""
+        self.owner = owner
+        for url, feed in self.feeds.items():
+            registry.subscribe(url, owner)
+
+    def get_new_entries(self, urls: list = None):
+        """Returns entries buffered or polled since this collection last asked, for all feeds or only those in urls."""
+        results = self._advance(urls)
+        for url in list(results):
+            buffered = self.buffer.pop(url, [])
+            if buffered:
+                registry.mark_owner(self.owner)
+            if isinstance(buffered, str):
+                # a buffered error is reported only if nothing else is
+                if not results[url]:
+                    results[url] = buffered
+            elif buffered:
+                # as are errors polled since entries were buffered
+                results[url] = buffered if isinstance(results[url], str) else results[url] + buffered
+        return results
+
+    def collect(self, urls: list = None):
+        """Moves entries polled since this collection last asked into its buffer, so that they outlast the feeds' backlogs."""
+        for url, entries in self._advance(urls).items():
+            buffered = self.buffer.get(url, [])
+            if isinstance(entries, str):
+                # keep entries over errors; the error is reported only if nothing else is
+                if not buffered:
+                    self.buffer[url] = entries
+            elif entries:
+                if isinstance(buffered, str):
+                    buffered = []
+                self.buffer[url] = (entries + buffered)[:BUFFER_LENGTH]
+
+    def _advance(self, urls: list = None):
+        results = {}
+        for url in (self.feeds if urls is None else urls):
+            feed = self.feeds.get(url, None)
+            if feed is None:
+                continue
+            results[url] = feed.entries_since(self.cursors[url])
+            if self.cursors[url] != feed.serial:
+                self.cursors[url] = feed.serial
+                registry.mark_owner(self.owner)
+        return results
+
+    def restore_feed(self, feed_url: str, feed: Feed, cursor: int):
+        """Adds a feed loaded from persistence, without downloading it."""
+        feed_url = sys.intern(feed_url)
+        self.feeds[feed_url] = registry.adopt(feed)
+        self.cursors[feed_url] = cursor
+        if self.owner is not None:
+            registry.subscribe(feed_url, self.owner)
+
+    def add_feed(self, feed_url: str, feed: Feed = None):
+        """Subscribes to feed_url, using feed if it was already prepared by the registry."""
         if feed_url in self.feeds:
             raise FeedCollectionError(feed_url, "The provided url has already previously been added")
-        self.feeds[feed_url] = Feed(feed_url)
-    
+        feed_url = sys.intern(feed_url)
+        self.feeds[feed_url] = registry.subscribe(feed_url, self.owner, feed)
+        self.cursors[feed_url] = self.feeds[feed_url].serial
+        # feeds may be added outside of handlers, once they are prepared
+        registry.mark_owner(self.owner)
+
     def remove_feed(self, feed_url: str):
         if feed_url not in self.feeds:
             raise FeedCollectionError(feed_url, "The provided url does not exist in this FeedCollection")
         del self.feeds[feed_url]
+        del self.cursors[feed_url]
+        self.buffer.pop(feed_url, None)
+        registry.unsubscribe(feed_url, self.owner)
 
 class FeedCollectionError(Exception):
     def __init__(self, feed_url, message):
@@ -5,7 +5,35 @@ envs = {
     "api_token": os.getenv("TELEGRAM_API_TOKEN"),
     "devs": os.getenv("LOG_RECIPIENTS", "").split(","),
     "asap_freq": int(os.getenv("ASAP_UPDATE_FREQ", 5 * 60)),
-    "pkl_location": os.getenv("BOT_DATA", ".")
+    "min_freq": int(os.getenv("MIN_UPDATE_FREQ", 60)),
+    "max_freq": int(os.getenv("MAX_UPDATE_FREQ", 24 * 60 * 60)),
+    "fetch_workers": int(os.getenv("FETCH_WORKERS", 8)),
+    "fetch_rate": float(os.getenv("FETCH_RATE", 10)),
+    "fetch_connections": int(os.getenv("FETCH_CONNECTIONS", 100)),
+    "fetch_per_host": int(os.getenv("FETCH_PER_HOST", 4)),
+    "connect_timeout": float(os.getenv("CONNECT_TIMEOUT", 10)),
+    "read_timeout": float(os.getenv("READ_TIMEOUT", 30)),
+    "max_feed_size": int(os.getenv("MAX_FEED_SIZE", 10)),
+    "response_cache_size": int(os.getenv("RESPONSE_CACHE_SIZE", 64)),
+    "worker_processes": int(os.getenv("WORKER_PROCESSES", 0)),
+    "parse_processes": int(os.getenv("PARSE_PROCESSES", os.cpu_count() or 1)),
+    "webhook_url": os.getenv("WEBHOOK_URL", ""),
+    "webhook_port": int(os.getenv("WEBHOOK_PORT", 8443)),
+    "webhook_secret": os.getenv("WEBHOOK_SECRET", None),
+    "webhook_workers": int(os.getenv("WEBHOOK_WORKERS", 4)),
+    "webhook_queue": int(os.getenv("WEBHOOK_QUEUE", 100)),
+    "websub_url": os.getenv("WEBSUB_URL", ""),
+    "websub_port": int(os.getenv("WEBSUB_PORT", 8080)),
+    "push_freq": int(os.getenv("PUSH_FALLBACK_FREQ", 6 * 60 * 60)),
+    "metrics_port": int(os.getenv("METRICS_PORT", 0)),
+    "lazy_startup": os.getenv("LAZY_STARTUP", "1") != "0",
+    "archive_days": int(os.getenv("ARCHIVE_DAYS", 30)),
+    "archive_size": int(os.getenv("ARCHIVE_SIZE", 1000000)),
+    "pkl_location": os.getenv("BOT_DATA", "."),
+    "persist_freq": int(os.getenv("PERSIST_FREQ", 60)),
+    "digest_spread": int(os.getenv("DIGEST_SPREAD", 30 * 60)),
+    "send_rate": float(os.getenv("SEND_RATE", 30)),
+    "chat_send_rate": float(os.getenv("CHAT_SEND_RATE", 1)),
 }
 
 
@@ -33,6 +61,14 @@ strings = {
 
         You can view your feeds in /settings, /remove feeds, and for advanced users, /edit how they are presented.
 
+        You can /include only entries of a feed matching a keyword or /regex/, or /exclude them, and /unfilter a feed again.
+
+        Looking for an entry you have seen before? /search the entries of your feeds.
+
+        Moving from another reader? You can /import feeds from an OPML file, and /export yours to one.
+
+        If a feed sends you many entries at once, you can /batch them into fewer messages.
+
         Wish to zone out from your updates for a bit? You can use Telegram's disable notifications function, and archive this conversation to hide it from your chats. I don't mind.
     """),
     "unknowninput": dedent("""\
@@ -55,6 +91,12 @@ strings = {
     "add_success": dedent("""\
         Successfully subscribed to {_escaped[urls]}
     """),
+    "add_checking": dedent("""\
+        Checking {_escaped[urls]}; you will be told once each feed is added.
+    """),
+    "add_invalid": dedent("""\
+        Could not download or read a feed from {_escaped[urls]}, so nothing was added.
+    """),
     "add_dupurl": dedent("""\
         You are already subscribed to {_escaped[urls]}.
     """),
@@ -91,6 +133,98 @@ strings = {
     "remove_cancel": dedent("""\
         Feed deletion cancelled.
     """),
+    "import_requestfile": dedent("""\
+        Please send the OPML file to import feeds from.
+        <i>(or /cancel importing)</i>
+    """),
+    "import_what": dedent("""\
+        Sorry, I could not read that as an OPML file. Please send an OPML file, or /cancel importing.
+    """),
+    "import_toolarge": dedent("""\
+        Sorry, that file is too large. Please send a smaller OPML file, or /cancel importing.
+    """),
+    "import_nothing": dedent("""\
+        There are no feeds in that file which you are not already subscribed to.
+    """),
+    "import_started": dedent("""\
+        Importing {count} feeds; you will be told as they are added.
+    """),
+    "import_done": dedent("""\
+        Import finished: {added} feeds added, {invalid} could not be read and {duplicate} were already in your feeds.
+    """),
+    "import_cancel": dedent("""\
+        Importing cancelled.
+    """),
+    "batch_poll": dedent("""\
+        New ASAP entries will now be sent together in as few messages as possible.
+        <i>(use /batch &lt;seconds&gt; to also collect entries over a period of time, or /batch off to receive one message per entry)</i>
+    """),
+    "batch_window": dedent("""\
+        New ASAP entries will now be collected for {_escaped[seconds]} seconds, and sent together in as few messages as possible.
+    """),
+    "batch_off": dedent("""\
+        New ASAP entries will now be sent in one message each.
+    """),
+    "batch_what": dedent("""\
+        Sorry, I did not understand that input. Please use /batch, /batch &lt;seconds&gt; or /batch off.
+    """),
+    "filter_include": dedent("""\
+        Only entries of {_escaped[url]} matching {_escaped[rule]} (or any other rule to /include) will now be sent.
+    """),
+    "filter_exclude": dedent("""\
+        Entries of {_escaped[url]} matching {_escaped[rule]} will no longer be sent.
+    """),
+    "filter_list": dedent("""\
+        Filters of {_escaped[url]}:
+        <b>Include:</b> {_escaped[include]}
+        <b>Exclude:</b> {_escaped[exclude]}
+    """),
+    "filter_invalid": dedent("""\
+        Sorry, that rule could not be used ({_escaped[error]}).
+    """),
+    "filter_disabled": dedent("""\
+        The rule {_escaped[rule]} of {_escaped[url]} took too long to match entries and has been turned off. Please /unfilter it, or use a simpler rule.
+    """),
+    "filter_what": dedent("""\
+        Please use /include &lt;url&gt; &lt;rule&gt; or /exclude &lt;url&gt; &lt;rule&gt;, where a rule is a keyword or a /regex/, to filter entries by their title, summary and tags. /unfilter &lt;url&gt; [&lt;rule&gt;] removes rules.
+    """),
+    "unfilter_success": dedent("""\
+        The filters of {_escaped[url]} have been updated.
+    """),
+    "unfilter_none": dedent("""\
+        {_escaped[url]} has no filters.
+    """),
+    "search_results": dedent("""\
+        <b>Entries matching {_escaped[terms]}:</b>
+        {results}
+    """),
+    "search_none": dedent("""\
+        No entries of your feeds match {_escaped[terms]}.
+    """),
+    "search_what": dedent("""\
+        Please use /search &lt;terms&gt; to search the entries of your feeds.
+    """),
+    "search_unavailable": dedent("""\
+        Sorry, searching is not available at the moment.
+    """),
+    "edit_success": dedent("""\
+        Entries of {_escaped[url]} will now be presented with your repr.
+    """),
+    "edit_reset": dedent("""\
+        Entries of {_escaped[url]} will now be presented in the default way.
+    """),
+    "edit_invalid": dedent("""\
+        Sorry, that repr could not be used ({_escaped[error]}). Fields available are {{entry[id]}}, {{entry[link]}}, {{entry[title]}}, {{entry[summary]}}, {{entry[author]}}, {{entry[published]}}, {{entry[updated]}} and {{feed[title]}}, {{feed[subtitle]}}, {{feed[link]}}, {{feed[description]}}, which may be HTML-escaped as {{_escaped[entry][title]}}.
+    """),
+    "edit_what": dedent("""\
+        Please use /edit &lt;url&gt; &lt;repr&gt;, or /edit &lt;url&gt; to reset a feed to the default presentation.
+    """),
+    "stats": dedent("""\
+        <b>Pipeline</b>
+        <pre>{_escaped[pipeline]}</pre>
+        <b>Most expensive feeds</b>
+        <pre>{_escaped[feeds]}</pre>
+    """),
     "asapdefaultrepr": dedent("""\
         <a href='{entry[link]}'>{_escaped[entry][title]}</a> - {_escaped[feed][title]}
     """),
@@ -104,8 +238,11 @@ strings = {
     "reprerror": dedent("""\
         <pre>the repr for {_escaped[url]} is invalid and could not be processed.</pre>
     """),
+    "filtererror": dedent("""\
+        <pre>the filter {_escaped[rule]} of {_escaped[url]} is invalid ({_escaped[error]}) and could not be applied.</pre>
+    """),
     "fperror": dedent("""\
-         An error occurred while parsing the feed {_escaped[url]}. The devs have been notified; notifications from this feed have been put on pause for 24 hours while we see what can be done.
+         An error occurred while parsing the feed {_escaped[url]}. The devs have been notified; the feed will be retried less and less often until it recovers.
     """),
     "error": dedent("""\
         An unforeseen error occurred in the bot. The devs have been notified.
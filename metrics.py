@@ -0,0 +1,223 @@
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "dailytelegram"
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# number of feeds listed as the most expensive
+TOP_FEEDS = 10
+
+class Metrics(object):
+    """Counters, histograms and per-feed costs recorded across the pipeline, rendered in the Prometheus text format
+
+    Metrics are labelled with keyword arguments. Processes polling feeds on
+    behalf of this one (see shards.py) send snapshots of their own metrics,
+    which are added to this process's when rendered.
+    """
+    def __init__(self):
+        self.counters = defaultdict(float) # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [bucket counts, sum, count]
+        self.costs = {} # feed url -> [seconds, bytes, polls, entries]
+        self.gauges = {} # prefix -> function returning a dict of values
+        self.sources = {} # source -> its last snapshot
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount: float = 1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0, 0]
+            histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def cost(self, url: str, seconds: float = 0, size: int = 0, polls: int = 0, entries: int = 0):
+        """Adds to the time spent on, and bytes downloaded for, a feed."""
+        with self._lock:
+            cost = self.costs.get(url, None)
+            if cost is None:
+                cost = self.costs[url] = [0, 0, 0, 0]
+            cost[0] += seconds
+            cost[1] += size
+            cost[2] += polls
+            cost[3] += entries
+
+    def forget(self, url: str):
+        with self._lock:
+            self.costs.pop(url, None)
+
+    def register(self, prefix: str, stats):
+        """Has stats(), returning a dict of numbers, be rendered as gauges named after prefix."""
+        self.gauges[prefix] = stats
+
+    # combining metrics between processes
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": { key: [list(h[0]), h[1], h[2]] for key, h in self.histograms.items() },
+                "costs": { url: list(cost) for url, cost in self.costs.items() },
+            }
+
+    def absorb(self, source, snapshot: dict):
+        """Keeps the latest snapshot sent by source, replacing its previous one."""
+        with self._lock:
+            self.sources[source] = snapshot
+
+    def _combined(self):
+        combined = self.snapshot()
+        with self._lock:
+            sources = list(self.sources.values())
+        for snapshot in sources:
+            for key, value in snapshot["counters"].items():
+                combined["counters"][key] = combined["counters"].get(key, 0) + value
+            for key, (buckets, total, count) in snapshot["histograms"].items():
+                histogram = combined["histograms"].setdefault(key, [[0] * len(buckets), 0, 0])
+                histogram[0] = [ a + b for a, b in zip(histogram[0], buckets) ]
+                histogram[1] += total
+                histogram[2] += count
+            for url, cost in snapshot["costs"].items():
+                combined["costs"][url] = [ a + b for a, b in zip(combined["costs"].get(url, [0, 0, 0, 0]), cost) ]
+        return combined
+
+    # reading
+    def summary(self, top: int = TOP_FEEDS):
+        """Returns counter totals, histogram counts, means and approximate quantiles, gauges and the feeds most time was spent on."""
+        combined = self._combined()
+        histograms = {}
+        for (name, labels), (buckets, total, count) in combined["histograms"].items():
+            histograms[(name, labels)] = {
+                "count": count,
+                "mean": total / count if count else 0,
+                "p50": quantile(buckets, 0.5),
+                "p99": quantile(buckets, 0.99),
+            }
+        feeds = sorted(combined["costs"].items(), key=lambda item: item[1][0], reverse=True)[:top]
+        return {
+            "counters": combined["counters"],
+            "histograms": histograms,
+            "gauges": self._gauges(),
+            "feeds": feeds,
+        }
+
+    def _gauges(self):
+        gauges = {}
+        for prefix, stats in list(self.gauges.items()):
+            try:
+                for name, value in stats().items():
+                    gauges[f"{prefix}_{name}"] = value
+            except Exception:
+                logger.exception("Error while reading %s gauges", prefix)
+        return gauges
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        combined = self._combined()
+        lines = []
+        for name, values in _by_name(combined["counters"]):
+            lines.append(f"# TYPE {PREFIX}_{name} counter")
+            for labels, value in values:
+                lines.append(f"{PREFIX}_{name}{_labels(labels)} {value:g}")
+        for name, values in _by_name(combined["histograms"]):
+            lines.append(f"# TYPE {PREFIX}_{name} histogram")
+            for labels, (buckets, total, count) in values:
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ("+Inf",), buckets):
+                    cumulative += n
+                    lines.append(f"{PREFIX}_{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{PREFIX}_{name}_sum{_labels(labels)} {total:g}")
+                lines.append(f"{PREFIX}_{name}_count{_labels(labels)} {count}")
+        for name, value in sorted(self._gauges().items()):
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name} {value:g}")
+        feeds = sorted(combined["costs"].items(), key=lambda item: item[1][0], reverse=True)[:TOP_FEEDS]
+        if feeds:
+            # only the most expensive feeds, as every feed would be too many series
+            lines.append(f"# TYPE {PREFIX}_feed_seconds gauge")
+            for url, (seconds, size, polls, entries) in feeds:
+                lines.append(f"{PREFIX}_feed_seconds{_labels((('url', url),))} {seconds:g}")
+        return "\n".join(lines) + "\n"
+
+def quantile(buckets: list, q: float):
+    """Returns the upper bound of the bucket the q-quantile falls in, or None if nothing was observed."""
+    count = sum(buckets)
+    if not count:
+        return None
+    cumulative = 0
+    for bound, n in zip(BUCKETS + (float("inf"),), buckets):
+        cumulative += n
+        if cumulative >= q * count:
+            return bound
+
+def _by_name(series: dict):
+    names = defaultdict(list)
+    for (name, labels), value in series.items():
+        names[name].append((labels, value))
+    return sorted((name, sorted(values)) for name, values in names.items())
+
+def _labels(labels: tuple):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f"{key}=\"{value}\"" for key, value in escaped) + "}"
+
+class Timer(object):
+    """Measures the time spent within a with block, in seconds"""
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+class MetricsServer(object):
+    """Serves metrics to Prometheus at /metrics"""
+    def __init__(self, metrics: Metrics, port: int = 9100):
+        self.metrics = metrics
+        self.port = port
+        self.server = None
+
+    def start(self):
+        handler = type("Handler", (MetricsHandler,), {"metrics": self.metrics})
+        self.server = ThreadingHTTPServer(("", self.port), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+metrics = Metrics()
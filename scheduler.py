@@ -0,0 +1,208 @@
+import datetime
+import functools
+import heapq
+import logging
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent import futures
+
+logger = logging.getLogger(__name__)
+
+class FeedScheduler(object):
+    """Polls every feed in a FeedRegistry from a single time-ordered queue
+
+    Downloads are handed to the registry's fetcher, with at most max_in_flight
+    outstanding, and the responses are processed by a bounded pool of workers.
+    """
+    def __init__(self, registry, on_update, interval: float, min_interval: float = None, max_interval: float = None, max_workers: int = 8, max_in_flight: int = 100, rate: float = 10, overdue_after: float = 60, push_interval: float = 6 * 60 * 60):
+        self.registry = registry
+        self.on_update = on_update
+        self.interval = interval
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        self.workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.spacing = 1 / rate if rate > 0 else 0
+        self.overdue_after = overdue_after
+        self.push_interval = push_interval
+
+        self.queue = [] # heap of (due, url)
+        self.due = {} # url -> due time of its live heap item
+        self.in_flight = set()
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._stopped = False
+
+        registry.scheduler = self
+        for url in list(registry.feeds):
+            self.schedule(url)
+
+    def schedule(self, url: str, due: float = None):
+        """Queues url to be polled at due, by default one interval after it was last polled."""
+        if due is None:
+            feed = self.registry.feeds.get(url, None)
+            if feed is not None:
+                due = feed.last_polled + self.interval_of(feed)
+            else:
+                due = 0
+            if due <= time.time():
+                # spread out overdue feeds (e.g. after a restart) over one interval
+                due = time.time() + random.uniform(0, self.interval)
+        with self._cond:
+            if url in self.in_flight:
+                return
+            self.due[url] = due
+            heapq.heappush(self.queue, (due, url))
+            self._cond.notify()
+
+    def interval_of(self, feed):
+        interval = feed.next_interval(self.min_interval, self.max_interval, self.interval)
+        if feed.push_active():
+            # feeds pushed by a hub are only polled in case pushes go missing
+            interval = max(interval, self.push_interval)
+        return interval
+
+    def pushed(self, url: str, feed):
+        # entries pushed to a feed are seen by its next poll, as it is polled in this process
+        pass
+
+    def update(self, url: str, feed):
+        # as are changes to its subscription to a hub, and to the fields requested of it
+        pass
+
+    def unschedule(self, url: str):
+        with self._cond:
+            # the heap item is skipped when popped
+            self.due.pop(url, None)
+
+    def stats(self):
+        """Returns the number of feeds scheduled, due, in flight and overdue."""
+        now = time.time()
+        with self._cond:
+            due = [ t for t in self.due.values() if t <= now ]
+            return {
+                "feeds": len(self.due) + len(self.in_flight),
+                "due": len(due),
+                "in_flight": len(self.in_flight),
+                "overdue": sum(1 for t in due if t <= now - self.overdue_after),
+            }
+
+    def start(self):
+        self._stopped = False
+        self._executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        self._thread = threading.Thread(target=self._run, name="FeedScheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                url = self._next()
+                if url is None:
+                    return
+                self.in_flight.add(url)
+            feed = self.registry.feeds.get(url, None)
+            if feed is not None and feed.ready():
+                response = self.registry.fetcher.submit(feed.url, feed.etag, feed.modified)
+                response.add_done_callback(functools.partial(self._fetched, url))
+            else:
+                # backing off; reschedule without downloading
+                self._executor.submit(self._poll, url, None)
+            # enforce the global fetch rate
+            time.sleep(self.spacing)
+
+    def _next(self):
+        """Blocks until a feed is due and a worker is free, returning its url (or None once stopped)."""
+        while not self._stopped:
+            if self.queue and len(self.in_flight) < self.max_in_flight:
+                due, url = self.queue[0]
+                if self.due.get(url, None) != due:
+                    # stale item left behind by unschedule or reschedule
+                    heapq.heappop(self.queue)
+                    continue
+                if due <= time.time():
+                    heapq.heappop(self.queue)
+                    del self.due[url]
+                    return url
+                self._cond.wait(due - time.time())
+            else:
+                self._cond.wait()
+        return None
+
+    def _fetched(self, url: str, response):
+        try:
+            self._executor.submit(self._poll, url, response)
+        except RuntimeError:
+            # the executor was shut down while the download was in flight
+            pass
+
+    def _poll(self, url: str, response):
+        feed = self.registry.feeds.get(url, None)
+        try:
+            if feed is not None and response is not None and feed.poll(response=response):
+                self.on_update(url, feed)
+        except Exception:
+            logger.exception("Error while polling %s", url)
+        else:
+            if feed is not None and self.registry.websub is not None:
+                self.registry.websub.check(feed)
+        finally:
+            with self._cond:
+                self.in_flight.discard(url)
+                self._cond.notify()
+            if feed is not None and url in self.registry.feeds:
+                self.schedule(url, time.time() + self.interval_of(feed))
+
+class DigestSchedule(object):
+    """Buckets chats by the minute of day at which their digest is due
+
+    Each chat's digest is delayed by a stable offset of up to spread seconds
+    after its requested time, so that chats asking for the same time (most
+    commonly the default of midnight) do not all fall due at once.
+    """
+    def __init__(self, spread: float = 0):
+        self.spread = int(spread // 60)
+        self.buckets = defaultdict(set)
+        self.times = {}
+        self.last_tick = datetime.datetime.now()
+        self._lock = threading.Lock()
+
+    def add(self, chat_id, digesttime: datetime.time):
+        with self._lock:
+            self._discard(chat_id)
+            offset = zlib.crc32(str(chat_id).encode()) % self.spread if self.spread else 0
+            minute = (digesttime.hour * 60 + digesttime.minute + offset) % (24 * 60)
+            self.times[chat_id] = divmod(minute, 60)
+            self.buckets[self.times[chat_id]].add(chat_id)
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._discard(chat_id)
+
+    def _discard(self, chat_id):
+        if chat_id in self.times:
+            self.buckets[self.times.pop(chat_id)].discard(chat_id)
+
+    def due(self, now: datetime.datetime = None):
+        """Returns chats whose digest time has passed since the previous call."""
+        now = now or datetime.datetime.now()
+        chats = []
+        with self._lock:
+            minute = self.last_tick.replace(second=0, microsecond=0)
+            while minute < now.replace(second=0, microsecond=0):
+                minute += datetime.timedelta(minutes=1)
+                chats.extend(self.buckets.get((minute.hour, minute.minute), ()))
+            self.last_tick = now
+        return chats
@@ -0,0 +1,253 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent import futures
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# priority lanes, most urgent first
+INTERACTIVE, ASAP, DIGEST, BROADCAST = range(4)
+LANES = ("interactive", "asap", "digest", "broadcast")
+
+# attempts made at sending a message through network errors
+MAX_ATTEMPTS = 3
+# longest text the Bot API accepts in a single message
+MAX_MESSAGE_LENGTH = 4096
+
+def pack(texts: list, limit: int = MAX_MESSAGE_LENGTH):
+    """Concatenates texts into as few messages as possible no longer than limit, splitting only between texts."""
+    messages = []
+    current = ""
+    for text in texts:
+        if current and len(current) + len(text) > limit:
+            messages.append(current)
+            current = ""
+        # a text which is too long by itself is left for the Bot API to reject
+        current += text
+    if current:
+        messages.append(current)
+    return messages
+
+class Coalescer(object):
+    """Buffers texts per chat until they are taken to be sent together"""
+    def __init__(self):
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, chat_id: int, texts: list):
+        """Buffers texts, returning whether they started a new batch for the chat."""
+        with self._lock:
+            started = chat_id not in self.pending
+            self.pending.setdefault(chat_id, []).extend(texts)
+            return started
+
+    def take(self, chat_id: int):
+        with self._lock:
+            return self.pending.pop(chat_id, [])
+
+class TokenBucket(object):
+    """Allows rate events per second on average, in bursts of up to capacity"""
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.blocked_until = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available_at(self, now: float):
+        """Returns the time at which a token is available, which is no later than now if one already is."""
+        if min(self.capacity, self.tokens + (now - self.updated) * self.rate) >= 1:
+            return max(self.blocked_until, now)
+        # computed from the last refill only, so that it stays the same
+        # for every caller until a token is taken
+        return max(self.blocked_until, self.updated + (1 - self.tokens) / self.rate)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+
+    def idle(self, now: float):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+class Outgoing(object):
+    """A queued Bot API call"""
+    def __init__(self, priority: int, chat_id: int, func, kwargs: dict):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.func = func
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.seq = None
+        self.queued = time.time()
+        self.future = futures.Future()
+
+class SendQueue(object):
+    """Sends messages in priority order from a pool of threads, within Telegram's global and per-chat rate limits"""
+    def __init__(self, rate: float = 30, chat_rate: float = 1, group_rate: float = 20 / 60, workers: int = 4):
+        self.bot = None
+        self.global_bucket = TokenBucket(rate, capacity=rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.workers = workers
+        self.lanes = [ [] for lane in LANES ] # heaps of (ready_at, seq, Outgoing)
+        self.chat_buckets = {}
+        self.counters = { "sent": 0, "retried": 0, "failed": 0 }
+        self.in_flight = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+    def send(self, priority: int, chat_id: int, text: str, **kwargs):
+        """Queues bot.send_message, returning a Future of the sent Message."""
+        return self.call(priority, chat_id, lambda **kw: self.bot.send_message(**kw), chat_id=chat_id, text=text, **kwargs)
+
+    def call(self, priority: int, chat_id: int, func, /, **kwargs):
+        """Queues func(**kwargs), a call which sends a message to chat_id, returning a Future of its result."""
+        message = Outgoing(priority, chat_id, func, kwargs)
+        self._push(message, time.time())
+        return message.future
+
+    def stats(self):
+        with self._cond:
+            stats = { f"queued_{lane}": len(heap) for lane, heap in zip(LANES, self.lanes) }
+            stats["in_flight"] = self.in_flight
+            stats.update(self.counters)
+            return stats
+
+    def start(self, bot):
+        self.bot = bot
+        self._stopped = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"SendQueue_{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _push(self, message: Outgoing, ready_at: float):
+        with self._cond:
+            if message.seq is None:
+                message.seq = next(self._seq)
+            # retried messages keep their place ahead of the chat's later messages
+            heapq.heappush(self.lanes[message.priority], (ready_at, message.seq, message))
+            self._cond.notify()
+
+    def _bucket(self, chat_id: int):
+        bucket = self.chat_buckets.get(chat_id, None)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # forget chats which have not been sent anything lately
+                now = time.time()
+                self.chat_buckets = {
+                    chat: bucket for chat, bucket in self.chat_buckets.items()
+                    if not bucket.idle(now)
+                }
+            # group chats (with negative ids) are limited more strictly
+            bucket = TokenBucket(self.group_rate if str(chat_id).startswith("-") else self.chat_rate)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next(self):
+        """Blocks until a message may be sent, returning it (or None once stopped). Called with _cond held."""
+        while not self._stopped:
+            now = time.time()
+            wait = None
+            for lane in self.lanes:
+                while lane and lane[0][0] <= now:
+                    global_ready = self.global_bucket.available_at(now)
+                    if global_ready > now:
+                        break
+                    ready_at, seq, message = heapq.heappop(lane)
+                    bucket = self._bucket(message.chat_id)
+                    chat_ready = bucket.available_at(now)
+                    if chat_ready > now:
+                        # let other chats' messages go ahead in the meantime;
+                        # the chat's own messages keep their order as they
+                        # are all pushed back to the same time
+                        heapq.heappush(lane, (chat_ready, seq, message))
+                        continue
+                    self.global_bucket.take(now)
+                    bucket.take(now)
+                    self.in_flight += 1
+                    return message
+                if lane and lane[0][0] <= now:
+                    # rate limited globally, so nothing else may be sent either
+                    wait = global_ready - now
+                    break
+                if lane:
+                    wait = lane[0][0] - now if wait is None else min(wait, lane[0][0] - now)
+            self._cond.wait(wait)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                message = self._next()
+            if message is None:
+                return
+            start = time.time()
+            try:
+                result = message.func(**message.kwargs)
+            except RetryAfter as e:
+                logger.warning("Rate limited by Telegram in chat %s for %s seconds", message.chat_id, e.retry_after)
+                until = time.time() + e.retry_after
+                with self._cond:
+                    self._bucket(message.chat_id).block(until)
+                    self.counters["retried"] += 1
+                self._push(message, until)
+            except BadRequest as e:
+                self._fail(message, e)
+            except NetworkError as e:
+                message.attempts += 1
+                if message.attempts < MAX_ATTEMPTS:
+                    with self._cond:
+                        self.counters["retried"] += 1
+                    self._push(message, time.time() + 2 ** message.attempts)
+                else:
+                    self._fail(message, e)
+            except TelegramError as e:
+                # e.g. the bot was blocked by the user
+                self._fail(message, e)
+            except Exception as e:
+                # anything else is a bug in the call, which must not take the
+                # worker, and the messages queued behind it, down with it
+                logger.exception("Error while sending message to chat %s", message.chat_id)
+                self._fail(message, e)
+            else:
+                with self._cond:
+                    self.counters["sent"] += 1
+                # the time taken by the Bot API, and since the message was first queued
+                metrics.observe("send_call_seconds", time.time() - start, lane=LANES[message.priority])
+                metrics.observe("send_seconds", time.time() - message.queued, lane=LANES[message.priority])
+                message.future.set_result(result)
+            finally:
+                with self._cond:
+                    self.in_flight -= 1
+                    self._cond.notify()
+
+    def _fail(self, message: Outgoing, e: Exception):
+        logger.warning("Could not send message to chat %s: %s", message.chat_id, e)
+        with self._cond:
+            self.counters["failed"] += 1
+        message.future.set_exception(e)
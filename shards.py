@@ -0,0 +1,248 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import pickle
+import threading
+import time
+from concurrent import futures
+
+from fetcher import AsyncFetcher, ResponseCache
+from fpwrapper import Feed, registry
+from metrics import metrics
+from scheduler import FeedScheduler
+
+logger = logging.getLogger(__name__)
+
+# points each worker is given on the hash ring
+REPLICAS = 100
+
+class HashRing(object):
+    """Consistent hash ring assigning keys to nodes, such that adding a node only moves the keys it takes over"""
+    def __init__(self, nodes: list, replicas: int = REPLICAS):
+        points = sorted(
+            (self._hash(f"{node}#{i}"), node)
+            for node in nodes for i in range(replicas)
+        )
+        self.points = [ point for point, node in points ]
+        self.nodes = [ node for point, node in points ]
+
+    @staticmethod
+    def _hash(value: str):
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def node(self, key: str):
+        return self.nodes[bisect.bisect(self.points, self._hash(key)) % len(self.points)]
+
+class ShardSupervisor(object):
+    """Polls feeds in worker processes, each owning the feeds hashed to it, while chats and delivery stay in this process
+
+    The supervisor stands in for the registry's FeedScheduler. Feeds are sent
+    to their worker when scheduled, and the worker reports back after each
+    poll with the feed's polling state and any new entries, which are
+    recorded in this process's copy of the feed and handed to on_update.
+    Workers which die are restarted with the feeds they owned.
+    """
+    def __init__(self, registry, on_update, processes: int, options: dict, max_workers: int = 8):
+        self.registry = registry
+        self.on_update = on_update
+        self.options = options
+        self.ring = HashRing(list(range(processes)))
+        self.context = multiprocessing.get_context("spawn")
+        self.outbox = self.context.Queue()
+        self.workers = [ None ] * processes # (process, inbox)
+        self.owned = [ set() for i in range(processes) ]
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._stopped = False
+
+        registry.scheduler = self
+
+    # scheduler interface, as used by the registry
+    def schedule(self, url: str, due: float = None):
+        feed = self.registry.feeds.get(url, None)
+        if feed is None:
+            return
+        worker = self.ring.node(url)
+        with self._lock:
+            if url in self.owned[worker]:
+                return
+            self.owned[worker].add(url)
+            if self.workers[worker] is not None:
+                self._send(worker, ("add", feed.polling_state(), self._settings(url, feed)))
+
+    def unschedule(self, url: str):
+        worker = self.ring.node(url)
+        with self._lock:
+            if url in self.owned[worker]:
+                self.owned[worker].discard(url)
+                self._send(worker, ("remove", url))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "feeds": sum(len(owned) for owned in self.owned),
+                "workers": sum(1 for worker in self.workers if worker is not None and worker[0].is_alive()),
+            }
+
+    def pushed(self, url: str, feed):
+        """Tells a feed's worker of entries pushed to this process, so that it does not find them again."""
+        worker = self.ring.node(url)
+        with self._lock:
+            if url in self.owned[worker]:
+                with feed._lock:
+                    self._send(worker, ("seen", url, feed.seen))
+
+    def update(self, url: str, feed):
+        """Tells a feed's worker of changes to its settings, which are made in this process."""
+        worker = self.ring.node(url)
+        with self._lock:
+            if url in self.owned[worker]:
+                self._send(worker, ("update", url, self._settings(url, feed)))
+
+    def _settings(self, url: str, feed):
+        # the feed's subscription to a hub, which it is polled less often
+        # while active, and the extra entry fields its subscribers need
+        return { "push": feed.push, "fields": self.registry.entry_fields.get(url, ()) }
+
+    def start(self):
+        self._stopped = False
+        for worker in range(len(self.workers)):
+            self._start_worker(worker)
+        for url in list(self.registry.feeds):
+            self.schedule(url)
+        threading.Thread(target=self._receive, name="ShardSupervisor", daemon=True).start()
+        threading.Thread(target=self._monitor, name="ShardMonitor", daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            for worker in range(len(self.workers)):
+                self._send(worker, ("stop",))
+        for process, inbox in self.workers:
+            process.join()
+        self.outbox.put(None)
+        self._executor.shutdown(wait=True)
+
+    def _start_worker(self, worker: int):
+        inbox = self.context.Queue()
+        process = self.context.Process(
+            target=run_worker,
+            args=(worker, inbox, self.outbox, self.options),
+            name=f"FeedWorker_{worker}",
+            daemon=True,
+        )
+        process.start()
+        with self._lock:
+            self.workers[worker] = (process, inbox)
+            for url in self.owned[worker]:
+                feed = self.registry.feeds.get(url, None)
+                if feed is not None:
+                    self._send(worker, ("add", feed.polling_state(), self._settings(url, feed)))
+
+    def _send(self, worker: int, message: tuple):
+        # pickled straight away, rather than by the queue's feeder thread,
+        # as feeds' state may change in the meantime
+        if self.workers[worker] is not None:
+            self.workers[worker][1].put(pickle.dumps(message))
+
+    def _monitor(self):
+        while not self._stopped:
+            time.sleep(5)
+            for worker, (process, inbox) in enumerate(list(self.workers)):
+                if not self._stopped and not process.is_alive():
+                    logger.error("Feed worker %s exited with %s, restarting it", worker, process.exitcode)
+                    self._start_worker(worker)
+
+    def _receive(self):
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                return
+            kind, url, state, result = pickle.loads(message)
+            if kind == "metrics":
+                metrics.absorb(url, state)
+                continue
+            feed = self.registry.feeds.get(url, None)
+            if feed is None:
+                continue
+            try:
+                updated = feed.merge(state, result)
+                if self.registry.websub is not None:
+                    self.registry.websub.check(feed)
+            except Exception:
+                logger.exception("Error while merging %s", url)
+                continue
+            if updated:
+                self._executor.submit(self._deliver, url, feed)
+
+    def _deliver(self, url: str, feed):
+        try:
+            self.on_update(url, feed)
+        except Exception:
+            logger.exception("Error while delivering %s", url)
+
+def run_worker(worker: int, inbox, outbox, options: dict):
+    """Entry point of a worker process, polling the feeds it is sent with its own FeedScheduler."""
+    logging.basicConfig(
+        format=f"%(asctime)s - worker {worker} - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    registry.fetcher = AsyncFetcher(**options["fetcher"])
+    if options.get("cache", None):
+        # the cache's database is shared with the other processes
+        registry.cache = ResponseCache(**options["cache"])
+
+    def polled(url: str, feed):
+        # sent straight away, as the seen index must be in step with the
+        # entries delivered
+        result = feed.backlog[-1][1]
+        feed.backlog.clear()
+        outbox.put(pickle.dumps(("polled", url, feed.polling_state(), result)))
+    scheduler = FeedScheduler(registry, on_update=polled, **options["scheduler"])
+    scheduler.start()
+
+    stopped = threading.Event()
+    def flush():
+        # polls which found nothing new still change feeds' state
+        while not stopped.wait(options.get("flush", 60)):
+            changed, _ = registry.take_changes()
+            for url in changed:
+                feed = registry.feeds.get(url, None)
+                if feed is not None:
+                    outbox.put(pickle.dumps(("state", url, feed.polling_state(), None)))
+            outbox.put(pickle.dumps(("metrics", worker, metrics.snapshot(), None)))
+    threading.Thread(target=flush, name="FeedWorkerFlush", daemon=True).start()
+
+    while True:
+        message = pickle.loads(inbox.get())
+        if message[0] == "add":
+            feed = Feed.__new__(Feed)
+            feed.__setstate__(dict(message[1], push=message[2]["push"]))
+            registry.entry_fields[feed.key] = message[2]["fields"]
+            registry.adopt(feed)
+        elif message[0] == "update":
+            feed = registry.feeds.get(message[1], None)
+            if feed is not None:
+                with feed._lock:
+                    feed.push = message[2]["push"]
+                    registry.entry_fields[feed.key] = message[2]["fields"]
+                # polled as often as its subscription now allows
+                scheduler.schedule(message[1])
+        elif message[0] == "remove":
+            feed = registry.feeds.pop(message[1], None)
+            scheduler.unschedule(message[1])
+            if feed is not None:
+                metrics.forget(feed.url)
+        elif message[0] == "seen":
+            feed = registry.feeds.get(message[1], None)
+            if feed is not None:
+                now = time.time()
+                with feed._lock:
+                    for h in message[2].hashes:
+                        feed.seen.add(h, now)
+        elif message[0] == "stop":
+            break
+    stopped.set()
+    scheduler.stop()
+    registry.fetcher.close()
@@ -0,0 +1,426 @@
+import datetime
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+from fpwrapper import Feed, FeedCollection, registry
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    digesttime TEXT,
+    extra BLOB
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    chat_id INTEGER,
+    mode TEXT,
+    url TEXT,
+    feed TEXT,
+    cursor INTEGER,
+    PRIMARY KEY (chat_id, mode, url)
+);
+CREATE TABLE IF NOT EXISTS buffers (
+    chat_id INTEGER,
+    mode TEXT,
+    url TEXT,
+    entries BLOB,
+    PRIMARY KEY (chat_id, mode, url)
+);
+CREATE TABLE IF NOT EXISTS reprs (
+    chat_id INTEGER,
+    url TEXT,
+    repr TEXT,
+    PRIMARY KEY (chat_id, url)
+);
+CREATE TABLE IF NOT EXISTS feeds (
+    key TEXT PRIMARY KEY,
+    state BLOB
+);
+CREATE TABLE IF NOT EXISTS feed_parts (
+    key TEXT,
+    part TEXT,
+    data BLOB,
+    PRIMARY KEY (key, part)
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT,
+    key TEXT,
+    state BLOB,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data BLOB
+);
+CREATE TABLE IF NOT EXISTS bot_data (
+    id INTEGER PRIMARY KEY,
+    data BLOB
+);
+"""
+
+# chat_data keys stored in their own tables; anything else is pickled into chats.extra
+CHAT_KEYS = ("feeds", "reprs", "digesttime")
+# parts of a feed's state stored in feed_parts, which are only written when they
+# change rather than on every poll
+FEED_PARTS = ("backlog", "seen")
+
+class LazyChatData(defaultdict):
+    """chat_data which loads each chat from the database the first time it is looked up"""
+    def __init__(self, load):
+        super().__init__(dict)
+        self.load = load
+
+    def __missing__(self, chat_id):
+        chat = self.load(chat_id)
+        if chat is None:
+            # not a stored chat, e.g. one which has not been /started
+            return super().__missing__(chat_id)
+        return chat
+
+class SQLitePersistence(BasePersistence):
+    """Persists bot state into normalized SQLite tables, writing only the rows which changed
+
+    Shared feed state is stored once per feed, with each chat storing only
+    its subscriptions and their cursors. A feed's backlog and seen index,
+    which make up most of its state, are stored apart from the rest and only
+    written when they change.
+
+    If lazy, chats (and the feeds they are subscribed to) are only loaded
+    when first looked up, or by warm_up, so that the bot may start handling
+    updates straight away however many chats are stored. on_load is then
+    called with each chat loaded and its chat_data.
+    """
+    def __init__(self, filename: str, store_user_data: bool = True, store_chat_data: bool = True, store_bot_data: bool = True, lazy: bool = False):
+        super().__init__(
+            store_user_data=store_user_data,
+            store_chat_data=store_chat_data,
+            store_bot_data=store_bot_data,
+        )
+        self.filename = filename
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self.chat_data = None
+        self.lazy = lazy
+        self.on_load = None
+        # rows last written for each chat, to diff against
+        self._rows = {}
+        # markers of the feed parts last written or loaded, to tell whether they changed
+        self._parts = {}
+
+    # loading
+    def get_chat_data(self):
+        if self.chat_data is not None:
+            return self.chat_data
+        if self.lazy:
+            self.chat_data = LazyChatData(self._load_chat)
+            return self.chat_data
+        with self._lock:
+            parts = defaultdict(dict)
+            for key, part, data in self.db.execute("SELECT key, part, data FROM feed_parts"):
+                parts[key][part] = data
+            feeds = {
+                key: self._load_feed(key, state, parts.get(key, {}))
+                for key, state in self.db.execute("SELECT key, state FROM feeds")
+            }
+            self.chat_data = defaultdict(dict)
+            for chat_id, digesttime, extra in self.db.execute("SELECT chat_id, digesttime, extra FROM chats"):
+                chat = self.chat_data[chat_id]
+                chat.update(pickle.loads(extra) if extra else {})
+                chat["feeds"] = {
+                    mode: FeedCollection([], owner=(chat_id, mode))
+                    for mode in ("asap", "digest")
+                }
+                chat["reprs"] = {}
+                chat["digesttime"] = datetime.time.fromisoformat(digesttime)
+            for chat_id, mode, url, key, cursor in self.db.execute("SELECT chat_id, mode, url, feed, cursor FROM subscriptions"):
+                if chat_id in self.chat_data and key in feeds:
+                    self.chat_data[chat_id]["feeds"][mode].restore_feed(url, feeds[key], cursor)
+            for chat_id, mode, url, entries in self.db.execute("SELECT chat_id, mode, url, entries FROM buffers"):
+                if chat_id in self.chat_data and url in self.chat_data[chat_id]["feeds"][mode].feeds:
+                    self.chat_data[chat_id]["feeds"][mode].buffer[url] = pickle.loads(entries)
+            for chat_id, url, repr_ in self.db.execute("SELECT chat_id, url, repr FROM reprs"):
+                if chat_id in self.chat_data:
+                    self.chat_data[chat_id]["reprs"][url] = repr_
+            for chat_id, chat in self.chat_data.items():
+                self._rows[chat_id] = self._chat_rows(chat)
+            # restoring subscriptions is not a change worth writing back
+            registry.take_changes()
+        return self.chat_data
+
+    def _load_chat(self, chat_id: int):
+        """Loads a chat into chat_data, along with the feeds it is subscribed to which are not loaded yet, returning None if it is not stored."""
+        with self._lock:
+            if dict.__contains__(self.chat_data, chat_id):
+                # loaded by another thread in the meantime
+                return dict.__getitem__(self.chat_data, chat_id)
+            row = self.db.execute("SELECT digesttime, extra FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None:
+                return None
+            digesttime, extra = row
+            chat = pickle.loads(extra) if extra else {}
+            chat["feeds"] = {
+                mode: FeedCollection([], owner=(chat_id, mode))
+                for mode in ("asap", "digest")
+            }
+            chat["reprs"] = {}
+            chat["digesttime"] = datetime.time.fromisoformat(digesttime)
+            loaded = set()
+            for mode, url, key, cursor in self.db.execute("SELECT mode, url, feed, cursor FROM subscriptions WHERE chat_id = ?", (chat_id,)).fetchall():
+                feed = registry.feeds.get(key, None)
+                if feed is None:
+                    state = self.db.execute("SELECT state FROM feeds WHERE key = ?", (key,)).fetchone()
+                    if state is None:
+                        continue
+                    feed = self._load_feed(key, state[0], dict(
+                        self.db.execute("SELECT part, data FROM feed_parts WHERE key = ?", (key,))
+                    ))
+                    loaded.add(key)
+                chat["feeds"][mode].restore_feed(url, feed, cursor)
+            for mode, url, entries in self.db.execute("SELECT mode, url, entries FROM buffers WHERE chat_id = ?", (chat_id,)):
+                if url in chat["feeds"][mode].feeds:
+                    chat["feeds"][mode].buffer[url] = pickle.loads(entries)
+            for url, repr_ in self.db.execute("SELECT url, repr FROM reprs WHERE chat_id = ?", (chat_id,)):
+                chat["reprs"][url] = repr_
+            self._rows[chat_id] = self._chat_rows(chat)
+            # as with loading every chat, restoring subscriptions is not a change worth writing back
+            registry.forget_changes(loaded, [ (chat_id, mode) for mode in chat["feeds"] ])
+            dict.__setitem__(self.chat_data, chat_id, chat)
+        if self.on_load is not None:
+            self.on_load(chat_id, chat)
+        return chat
+
+    def _load_feed(self, key: str, state: bytes, parts: dict):
+        """Unpickles a feed and the parts stored apart from it."""
+        state = pickle.loads(state)
+        if not isinstance(state, dict):
+            # feeds written before their parts were split off are pickled whole
+            return state
+        feed = registry.feeds.get(key, None)
+        if feed is not None:
+            return feed
+        for part, data in parts.items():
+            state[part] = pickle.loads(data)
+        feed = Feed.__new__(Feed)
+        feed.__setstate__(state)
+        if parts.keys() >= set(FEED_PARTS):
+            self._parts[key] = self._markers(feed)
+        return feed
+
+    def chat_ids(self):
+        """Returns the ids of every chat stored or in chat_data, whether or not it has been loaded."""
+        with self._lock:
+            stored = [ chat_id for chat_id, in self.db.execute("SELECT chat_id FROM chats") ]
+        return sorted(set(stored).union(self.chat_data or ()))
+
+    def digest_times(self):
+        """Returns (chat_id, digesttime) for every stored chat, without loading the chats."""
+        with self._lock:
+            return [
+                (chat_id, datetime.time.fromisoformat(digesttime))
+                for chat_id, digesttime in self.db.execute("SELECT chat_id, digesttime FROM chats")
+            ]
+
+    def warm_up(self, batch: int = 100, pause: float = 0.01):
+        """Loads every stored chat not loaded yet, batch at a time, pausing between batches so that handlers are not held up."""
+        if not self.lazy:
+            return
+        chat_ids = self.chat_ids()
+        for i in range(0, len(chat_ids), batch):
+            for chat_id in chat_ids[i:i + batch]:
+                if not dict.__contains__(self.chat_data, chat_id):
+                    self.chat_data[chat_id]
+            time.sleep(pause)
+        logger.info("Loaded %s chats", len(chat_ids))
+
+    def get_user_data(self):
+        with self._lock:
+            return defaultdict(dict, {
+                user_id: pickle.loads(data)
+                for user_id, data in self.db.execute("SELECT user_id, data FROM user_data")
+            })
+
+    def get_bot_data(self):
+        with self._lock:
+            row = self.db.execute("SELECT data FROM bot_data WHERE id = 0").fetchone()
+        return pickle.loads(row[0]) if row else {}
+
+    def get_conversations(self, name: str):
+        with self._lock:
+            return {
+                tuple(json.loads(key)): pickle.loads(state)
+                for key, state in self.db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+            }
+
+    # saving
+    def update_conversation(self, name: str, key: tuple, new_state):
+        with self._lock, self.db:
+            self._write_conversation(name, key, new_state)
+
+    def update_user_data(self, user_id: int, data: dict):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO user_data VALUES (?, ?)", (user_id, pickle.dumps(data)))
+
+    def update_bot_data(self, data: dict):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO bot_data VALUES (0, ?)", (pickle.dumps(data),))
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        with self._lock, self.db:
+            self._write_chat(chat_id, data)
+
+    def sync(self):
+        """Writes feeds polled, and cursors advanced, since the last sync."""
+        if self.chat_data is None:
+            return
+        changed_feeds, changed_owners = registry.take_changes()
+        with self._lock, self.db:
+            self._write_feeds(changed_feeds)
+            for chat_id in { owner[0] for owner in changed_owners if owner is not None }:
+                if chat_id in self.chat_data:
+                    self._write_chat(chat_id, self.chat_data[chat_id])
+
+    def flush(self):
+        self.sync()
+        with self._lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
+
+    def _write_conversation(self, name: str, key: tuple, new_state):
+        if new_state is None:
+            self.db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+        else:
+            self.db.execute(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                (name, json.dumps(key), pickle.dumps(new_state)),
+            )
+
+    def _chat_rows(self, data: dict):
+        if "feeds" not in data:
+            # only chats which have been /started are stored
+            return None
+        extra = { key: value for key, value in data.items() if key not in CHAT_KEYS }
+        return {
+            "chat": (data["digesttime"].isoformat(), pickle.dumps(extra) if extra else None),
+            "subscriptions": {
+                (mode, url): (feed.key, fc.cursors[url])
+                for mode, fc in data["feeds"].items()
+                for url, feed in fc.feeds.items()
+            },
+            "buffers": {
+                (mode, url): pickle.dumps(entries)
+                for mode, fc in data["feeds"].items()
+                for url, entries in fc.buffer.items()
+            },
+            "reprs": dict(data["reprs"]),
+        }
+
+    def _write_chat(self, chat_id: int, data: dict):
+        old = self._rows.get(chat_id, None)
+        new = self._chat_rows(data)
+        if new == old:
+            return
+        if new is None:
+            for table in ("chats", "subscriptions", "buffers", "reprs"):
+                self.db.execute(f"DELETE FROM {table} WHERE chat_id = ?", (chat_id,))
+            del self._rows[chat_id]
+            return
+        old = old or {"chat": None, "subscriptions": {}, "buffers": {}, "reprs": {}}
+
+        if new["chat"] != old["chat"]:
+            self.db.execute("INSERT OR REPLACE INTO chats VALUES (?, ?, ?)", (chat_id, *new["chat"]))
+        for (mode, url) in old["subscriptions"].keys() - new["subscriptions"].keys():
+            self.db.execute("DELETE FROM subscriptions WHERE chat_id = ? AND mode = ? AND url = ?", (chat_id, mode, url))
+        for (mode, url), row in new["subscriptions"].items():
+            if old["subscriptions"].get((mode, url), None) != row:
+                self.db.execute("INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?, ?, ?)", (chat_id, mode, url, *row))
+        for (mode, url) in old["buffers"].keys() - new["buffers"].keys():
+            self.db.execute("DELETE FROM buffers WHERE chat_id = ? AND mode = ? AND url = ?", (chat_id, mode, url))
+        for (mode, url), entries in new["buffers"].items():
+            if old["buffers"].get((mode, url), None) != entries:
+                self.db.execute("INSERT OR REPLACE INTO buffers VALUES (?, ?, ?, ?)", (chat_id, mode, url, entries))
+        for url in old["reprs"].keys() - new["reprs"].keys():
+            self.db.execute("DELETE FROM reprs WHERE chat_id = ? AND url = ?", (chat_id, url))
+        for url, repr_ in new["reprs"].items():
+            if old["reprs"].get(url, None) != repr_:
+                self.db.execute("INSERT OR REPLACE INTO reprs VALUES (?, ?, ?)", (chat_id, url, repr_))
+        # feeds newly subscribed to must be stored alongside their subscriptions
+        self._write_feeds({
+            key for key, cursor in new["subscriptions"].values()
+        } - {
+            key for key, cursor in old["subscriptions"].values()
+        })
+        self._rows[chat_id] = new
+
+    def _write_feeds(self, keys: set):
+        for key in keys:
+            feed = registry.feeds.get(key, None)
+            if feed is None:
+                self.db.execute("DELETE FROM feeds WHERE key = ?", (key,))
+                self.db.execute("DELETE FROM feed_parts WHERE key = ?", (key,))
+                self._parts.pop(key, None)
+                continue
+            with feed._lock:
+                state = feed.__getstate__()
+                parts = { part: state.pop(part) for part in FEED_PARTS }
+                markers = self._markers(feed)
+                old = self._parts.get(key, {})
+                # e.g. polls which found nothing new only change the rest of the state
+                changed = {
+                    part: pickle.dumps(value) for part, value in parts.items()
+                    if old.get(part, None) != markers[part]
+                }
+                state = pickle.dumps(state)
+            self.db.execute("INSERT OR REPLACE INTO feeds VALUES (?, ?)", (key, state))
+            for part, data in changed.items():
+                self.db.execute("INSERT OR REPLACE INTO feed_parts VALUES (?, ?, ?)", (key, part, data))
+            self._parts[key] = markers
+
+    def _markers(self, feed: Feed):
+        # the backlog only grows along with the feed's serial; the seen index
+        # counts its changes, and is replaced when merged from another process
+        return {
+            "backlog": feed.serial,
+            "seen": (feed.seen, feed.seen.changes),
+        }
+
+    # migration
+    def migrate(self, pkl_filename: str):
+        """Imports a bot.pkl written by PicklePersistence into an empty database, renaming it once done."""
+        if not os.path.exists(pkl_filename):
+            return
+        with self._lock:
+            if self.db.execute("SELECT COUNT(*) FROM chats").fetchone()[0]:
+                logger.warning("Not migrating %s, as %s already holds data", pkl_filename, self.filename)
+                return
+        logger.info("Migrating %s into %s", pkl_filename, self.filename)
+        with open(pkl_filename, "rb") as f:
+            data = pickle.load(f)
+        with self._lock, self.db:
+            for chat_id, chat in data.get("chat_data", {}).items():
+                if chat:
+                    for mode, fc in chat["feeds"].items():
+                        fc.bind((chat_id, mode))
+                self._write_chat(chat_id, chat)
+            for user_id, user in data.get("user_data", {}).items():
+                self.db.execute("INSERT OR REPLACE INTO user_data VALUES (?, ?)", (user_id, pickle.dumps(user)))
+            if data.get("bot_data", None):
+                self.db.execute("INSERT OR REPLACE INTO bot_data VALUES (0, ?)", (pickle.dumps(data["bot_data"]),))
+            for name, conversations in data.get("conversations", {}).items():
+                for key, state in conversations.items():
+                    self._write_conversation(name, key, state)
+        registry.take_changes()
+        os.rename(pkl_filename, f"{pkl_filename}.migrated")
+        # the migrated chats are loaded back from the database
+        self._rows.clear()
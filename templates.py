@@ -0,0 +1,155 @@
+import functools
+import html
+import string
+import threading
+from collections import OrderedDict
+
+from _string import formatter_field_name_split
+
+from fpwrapper import ENTRY_FIELDS, EXTRA_ENTRY_FIELDS, Entry
+
+# number of compiled templates kept, and of rendered entries kept per template
+TEMPLATE_CACHE = 256
+RENDER_CACHE = 1024
+
+class Placeholder(dict):
+    """Stands in for dicts whose keys vary between feeds, such as an entry's source, accepting any key a dict could have"""
+    def __missing__(self, key):
+        if not isinstance(key, str):
+            raise KeyError(key)
+        return ""
+
+class PlaceholderList(list):
+    """Stands in for lists of such dicts, such as an entry's tags, whose length varies between feeds"""
+    def __getitem__(self, index):
+        if not isinstance(index, int):
+            raise TypeError(f"list indices must be integers, not {type(index).__name__}")
+        return Placeholder()
+
+# values a repr is checked against before it is saved, shaped like those
+# feedparser gives entries; reprs may opt into EXTRA_ENTRY_FIELDS, which are
+# then kept for the feed
+SAMPLE_EXTRA = { "comments": "", "license": "", "source": Placeholder() }
+SAMPLE_ENTRY = dict(
+    { field: SAMPLE_EXTRA.get(field, PlaceholderList()) for field in EXTRA_ENTRY_FIELDS },
+    **{ field: "" for field in ENTRY_FIELDS }
+)
+SAMPLE_FEED = { field: "" for field in ("title", "subtitle", "link", "description") }
+
+class TemplateError(Exception):
+    def __init__(self, template, message):
+        self.template = template
+        self.message = message
+
+class BoundedCache(object):
+    """Thread-safe LRU mapping of object ids to values, which keeps the objects alive so that their ids are not reused"""
+    def __init__(self, size: int):
+        self.size = size
+        self.items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, objs: tuple, compute):
+        key = tuple(map(id, objs))
+        with self._lock:
+            hit = self.items.get(key, None)
+            if hit is not None and all(a is b for a, b in zip(hit[0], objs)):
+                self.items.move_to_end(key)
+                return hit[1]
+        value = compute()
+        with self._lock:
+            self.items[key] = (objs, value)
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return value
+
+# escaped string values of dicts shared between templates, keyed by the dict
+_escapes = BoundedCache(RENDER_CACHE * 4)
+
+def escaped(d: dict, key):
+    """Returns d[key] html-escaped, computing it at most once per dict while it is cached."""
+    values = _escapes.get((d,), dict)
+    if key not in values:
+        values[key] = html.escape(d.get(key, ""))
+    return values[key]
+
+class Template(object):
+    """A str.format template parsed once into a render plan
+
+    Fields are looked up like str.format does. Fields under _escaped are
+    html-escaped if they are strings, and are empty if they do not exist,
+    as with the EscapedDict previously passed to str.format.
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.plan = []
+        try:
+            for literal, field_name, spec, conversion in string.Formatter().parse(text):
+                field = None
+                if field_name is not None:
+                    root, rest = formatter_field_name_split(field_name)
+                    path = list(rest)
+                    escape = root == "_escaped"
+                    if escape:
+                        if not path or path[0][0]:
+                            raise ValueError("_escaped must be indexed, e.g. _escaped[entry][title]")
+                        root = path.pop(0)[1]
+                    if "{" in spec:
+                        raise ValueError("nested format specifications are not supported")
+                    field = (escape, root, path, conversion, spec)
+                self.plan.append((literal, field))
+        except ValueError as e:
+            raise TemplateError(text, str(e))
+        self.rendered = BoundedCache(RENDER_CACHE)
+
+    def render(self, **values):
+        parts = []
+        for literal, field in self.plan:
+            parts.append(literal)
+            if field is not None:
+                parts.append(self._field(values, *field))
+        return "".join(parts)
+
+    def render_entry(self, entry: dict, feed: dict):
+        """Renders an entry of a feed, reusing the result for every chat sharing the entry."""
+        return self.rendered.get((entry, feed), lambda: self.render(entry=entry, feed=feed))
+
+    def entry_fields(self):
+        """Returns the fields of entries this template references."""
+        return {
+            path[0][1] for escape, root, path, conversion, spec in (field for literal, field in self.plan if field)
+            if root == "entry" and path and not path[0][0]
+        }
+
+    def _field(self, values: dict, escape: bool, root, path: list, conversion: str, spec: str):
+        if escape:
+            # as with EscapedDict, missing keys of dicts are empty strings
+            value, parent, key = values.get(root, ""), None, root
+            for is_attr, key_ in path:
+                if isinstance(value, (dict, Entry)) and not is_attr:
+                    value, parent, key = value.get(key_, ""), value, key_
+                else:
+                    value, parent = (getattr(value, key_) if is_attr else value[key_]), None
+            if isinstance(value, str):
+                value = html.escape(value) if parent is None else escaped(parent, key)
+        else:
+            value = values[root]
+            for is_attr, key in path:
+                value = getattr(value, key) if is_attr else value[key]
+        if conversion == "r":
+            value = repr(value)
+        elif conversion == "s":
+            value = str(value)
+        elif conversion == "a":
+            value = ascii(value)
+        return format(value, spec)
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE)
+def compile_template(text: str):
+    return Template(text)
+
+def validate(text: str):
+    """Raises TemplateError if text cannot render an entry of a feed."""
+    try:
+        compile_template(text).render(entry=SAMPLE_ENTRY, feed=SAMPLE_FEED)
+    except (KeyError, IndexError, AttributeError, TypeError, ValueError) as e:
+        raise TemplateError(text, f"{type(e).__name__}: {e}")
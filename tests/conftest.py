@@ -0,0 +1,96 @@
+import gzip
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the bot's modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class FeedServer(object):
+    """Stand-in for feed hosts, serving a synthetic RSS feed with validators at any path
+
+    The feed's entries, ETag and Last-Modified change each time publish is
+    called. Requests' headers are recorded in requests, and responses are
+    gzipped if the request accepts it. Paths in redirects are redirected
+    with the given status and location.
+    """
+    def __init__(self):
+        self.entries = 0
+        self.requests = []
+        self.responses = []
+        self.redirects = {}
+        self.publish(3)
+        handler = type("Handler", (FeedHandler,), {"server_state": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="FeedServer", daemon=True).start()
+
+    def url(self, path: str = "/feed"):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def publish(self, count: int = 1):
+        self.entries += count
+        self.etag = f'"v{self.entries}"'
+        self.modified = f"Mon, 0{min(self.entries, 9)} Jan 2024 00:00:00 GMT"
+        items = "".join(
+            f"<item><title>Entry {i}</title><link>http://example.com/{i}</link><guid>entry-{i}</guid>"
+            f"<description>Synthetic entry number {i}</description></item>"
+            for i in reversed(range(self.entries))
+        )
+        self.body = (
+            f"<?xml version='1.0' encoding='utf-8'?><rss version='2.0'><channel><title>Synthetic feed</title>"
+            f"<link>http://example.com/</link><description>Served for tests</description>{items}</channel></rss>"
+        ).encode("utf-8")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FeedHandler(BaseHTTPRequestHandler):
+    server_state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        state = self.server_state
+        state.requests.append({ key.lower(): value for key, value in self.headers.items() })
+        if self.path in state.redirects:
+            status, location = state.redirects[self.path]
+            state.responses.append((status, None))
+            self.send_response(status)
+            self.send_header("Location", location)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match", None) == state.etag or (
+            "If-None-Match" not in self.headers and self.headers.get("If-Modified-Since", None) == state.modified
+        ):
+            state.responses.append((304, None))
+            self.send_response(304)
+            self.send_header("ETag", state.etag)
+            self.end_headers()
+            return
+        body = state.body
+        encoding = "gzip" if "gzip" in self.headers.get("Accept-Encoding", "") else None
+        if encoding:
+            body = gzip.compress(body)
+        state.responses.append((200, encoding))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml; charset=utf-8")
+        self.send_header("ETag", state.etag)
+        self.send_header("Last-Modified", state.modified)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def feed_server():
+    server = FeedServer()
+    yield server
+    server.close()
@@ -0,0 +1,48 @@
+import pickle
+
+from fpwrapper import DeliveredIndex, Entry
+
+A = "http://a.example.com/feed"
+B = "http://b.example.com/feed"
+
+def entry(guid: str, link: str, title: str = ""):
+    return Entry({"id": guid, "link": link, "title": title})
+
+def test_copies_from_other_feeds_dropped():
+    delivered = DeliveredIndex()
+    post = entry("a-1", "https://www.example.com/post?utm_source=a")
+    assert delivered.unseen([post], A) == [post]
+    # the same link, reposted by another feed
+    assert delivered.unseen([ entry("b-1", "http://example.com/post/") ], B) == []
+    title = "A distinctive title shared by both feeds"
+    assert delivered.unseen([ entry("a-2", "http://a.example.com/2", title) ], A)
+    assert delivered.unseen([ entry("b-2", "http://b.example.com/2", title) ], B) == []
+
+def test_own_entries_kept():
+    delivered = DeliveredIndex()
+    # anchors within one page, and entries which all link to the homepage
+    changelog = [ entry("v2", "http://example.com/changelog#v2"), entry("v1", "http://example.com/changelog#v1") ]
+    assert delivered.unseen(changelog, A) == changelog
+    homepage = [ entry(f"post-{i}", "http://example.com/") for i in range(3) ]
+    assert delivered.unseen(homepage, A) == homepage
+    assert delivered.unseen([ entry("v3", "http://example.com/changelog#v3") ], A)
+    # but still dropped when another feed links to the same page
+    assert delivered.unseen([ entry("b-1", "http://example.com/changelog") ], B) == []
+
+def test_bounded():
+    delivered = DeliveredIndex(max_length=4)
+    delivered.unseen([ entry(f"a-{i}", f"http://example.com/{i}") for i in range(5) ], A)
+    assert len(delivered) == 4
+    # the oldest fingerprints are forgotten
+    assert delivered.unseen([ entry("b-0", "http://example.com/0") ], B)
+
+def test_persisted_without_sources():
+    delivered = DeliveredIndex()
+    delivered.unseen([ entry("a-1", "http://example.com/1") ], A)
+    state = delivered.__getstate__()
+    del state["sources"]
+    restored = DeliveredIndex.__new__(DeliveredIndex)
+    restored.__setstate__(state)
+    restored = pickle.loads(pickle.dumps(restored))
+    assert restored.unseen([ entry("b-1", "http://example.com/1") ], B) == []
+    assert len(restored.sources) == len(restored.hashes)
@@ -0,0 +1,96 @@
+import pytest
+
+from fetcher import AsyncFetcher, BodyTooLarge, UrllibFetcher
+from fpwrapper import Feed, registry
+
+@pytest.fixture(params=["async", "urllib"])
+def fetcher(request):
+    fetcher = AsyncFetcher(max_connections=4, max_per_host=2) if request.param == "async" else UrllibFetcher()
+    yield fetcher
+    fetcher.close()
+
+@pytest.fixture
+def polled_with(fetcher):
+    # feeds download through the registry's fetcher
+    previous, registry.fetcher = registry.fetcher, fetcher
+    yield fetcher
+    registry.fetcher = previous
+
+def test_fetch(feed_server, fetcher):
+    result = fetcher.fetch(feed_server.url())
+    assert result.status == 200
+    assert result.body == feed_server.body
+    assert result.headers["etag"] == feed_server.etag
+    assert result.headers["last-modified"] == feed_server.modified
+    assert result.permanent_url is None
+
+def test_not_modified_by_etag(feed_server, fetcher):
+    result = fetcher.fetch(feed_server.url(), etag=feed_server.etag)
+    assert result.status == 304
+    assert result.body == b""
+    assert feed_server.requests[-1]["if-none-match"] == feed_server.etag
+
+def test_not_modified_since(feed_server, fetcher):
+    result = fetcher.fetch(feed_server.url(), modified=feed_server.modified)
+    assert result.status == 304
+    assert feed_server.requests[-1]["if-modified-since"] == feed_server.modified
+
+def test_modified(feed_server, fetcher):
+    etag, modified = feed_server.etag, feed_server.modified
+    feed_server.publish()
+    result = fetcher.fetch(feed_server.url(), etag=etag, modified=modified)
+    assert result.status == 200
+    assert result.headers["etag"] == feed_server.etag
+    assert result.body == feed_server.body
+
+@pytest.mark.parametrize("statuses, permanent", [
+    ((301,), True),
+    ((308,), True),
+    ((301, 308), True),
+    ((302,), False),
+    ((301, 307), False),
+])
+def test_redirects(feed_server, fetcher, statuses, permanent):
+    paths = [ f"/hop{i}" for i in range(len(statuses)) ] + ["/feed"]
+    for path, status, location in zip(paths, statuses, paths[1:]):
+        feed_server.redirects[path] = (status, feed_server.url(location))
+    result = fetcher.fetch(feed_server.url(paths[0]))
+    assert result.status == 200
+    assert result.body == feed_server.body
+    # only a chain of permanent redirects moves the feed
+    assert result.permanent_url == (feed_server.url() if permanent else None)
+
+def test_validators_round_trip(feed_server, polled_with):
+    feed = Feed(feed_server.url())
+    assert feed.etag == feed_server.etag
+    assert feed.modified == feed_server.modified
+    assert len(feed.seen) == 3
+
+    # the stored validators are sent back, and nothing is new
+    assert not feed.poll()
+    assert feed_server.requests[-1]["if-none-match"] == feed_server.etag
+    assert feed_server.requests[-1]["if-modified-since"] == feed_server.modified
+    assert feed_server.responses[-1][0] == 304
+    assert feed.etag == feed_server.etag
+
+    feed_server.publish(2)
+    assert feed.poll()
+    assert [ entry["id"] for entry in feed.entries_since(0) ] == ["entry-4", "entry-3"]
+    assert feed.etag == feed_server.etag
+    assert feed.modified == feed_server.modified
+
+def test_gzip(feed_server):
+    fetcher = AsyncFetcher()
+    try:
+        result = fetcher.fetch(feed_server.url())
+    finally:
+        fetcher.close()
+    # pooled connections ask for compressed bodies, which are decompressed
+    assert "gzip" in feed_server.requests[-1]["accept-encoding"]
+    assert feed_server.responses[-1] == (200, "gzip")
+    assert result.body == feed_server.body
+
+def test_body_too_large(feed_server, fetcher):
+    fetcher.max_body = 100
+    with pytest.raises(BodyTooLarge):
+        fetcher.fetch(feed_server.url())
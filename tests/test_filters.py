@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+import filters as filters_module
+from filters import SLOW_STRIKES, FilterError, FilterIndex, parse_rule
+
+URL = "http://example.com/feed"
+
+def entry(title: str):
+    return {"title": title, "summary": ""}
+
+@pytest.fixture
+def index():
+    index = FilterIndex()
+    index.notices = []
+    index.on_disable = lambda *notice: index.notices.append(notice)
+    return index
+
+def test_parse_rule():
+    assert parse_rule(" Python ") == ("keyword", "python")
+    assert parse_rule("/py(thon)?/") == ("regex", "py(thon)?")
+    for rule in ("", "/(/", "/" + "a" * 101 + "/"):
+        with pytest.raises(FilterError):
+            parse_rule(rule)
+
+def test_apply(index):
+    entries = [ entry("Python news"), entry("Rust news"), entry("Python jobs") ]
+    rules = {"include": ["python"], "exclude": ["/jobs?/"]}
+    assert index.apply(URL, 1, rules, entries) == entries[:1]
+    assert index.apply(URL, 2, {"include": ["/rust|jobs/"], "exclude": []}, entries) == entries[1:]
+    assert index.apply(URL, 3, {}, entries) == entries
+
+def test_rules_parsed_once(index, monkeypatch):
+    rules = {"include": ["python", "/rust/"], "exclude": []}
+    index.apply(URL, 1, rules, [ entry("Python") ])
+    parsed = []
+    monkeypatch.setattr(filters_module, "parse_rule", lambda rule: parsed.append(rule) or parse_rule(rule))
+    index.apply(URL, 1, rules, [ entry("Rust") ])
+    assert parsed == []
+    rules["exclude"].append("news")
+    index.apply(URL, 1, rules, [ entry("Rust") ])
+    assert parsed == ["python", "/rust/", "news"]
+
+def test_slow_regex_disabled(index):
+    # backtracks exponentially on a long run of x not followed by y
+    rules = {"include": ["/(x+x+)+y/"], "exclude": []}
+    entries = [ entry("x" * 2000 + str(i)) for i in range(SLOW_STRIKES) ]
+    start = time.perf_counter()
+    assert index.apply(URL, 1, rules, entries) == []
+    assert time.perf_counter() - start < 5
+    assert ("regex", "(x+x+)+y") in index.disabled
+    assert index.notices == [(1, URL, "/(x+x+)+y/")]
+    # the rule is then ignored rather than dropping every entry
+    assert index.apply(URL, 1, rules, [ entry("Python") ]) == [ entry("Python") ]
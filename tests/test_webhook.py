@@ -0,0 +1,45 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from webhook import WebhookServer
+
+SECRET = "secret-path"
+
+def update(update_id: int, chat_id: int):
+    return json.dumps({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "/help"},
+    }).encode("utf-8")
+
+@pytest.fixture
+def webhook():
+    # not started, so queued updates stay queued
+    return WebhookServer(SimpleNamespace(bot=None), "https://bot.example.com/", secret=SECRET, workers=2, queue_size=2)
+
+def test_receive(webhook):
+    assert webhook.receive(f"/{SECRET}", {}, update(1, 10)) == 200
+    assert webhook.stats() == {"received": 1, "rejected": 0, "deferred": 0, "queued": 1}
+
+@pytest.mark.parametrize("path", ["/", "/other", f"/{SECRET}x", f"/x{SECRET}"])
+def test_secret_path(webhook, path):
+    assert webhook.receive(path, {}, update(1, 10)) == 403
+    assert webhook.stats()["rejected"] == 1
+    assert webhook.stats()["queued"] == 0
+
+def test_secret_header(webhook):
+    assert webhook.receive(f"/{SECRET}", {"x-telegram-bot-api-secret-token": "wrong"}, update(1, 10)) == 403
+    assert webhook.receive(f"/{SECRET}", {"x-telegram-bot-api-secret-token": SECRET}, update(2, 10)) == 200
+    assert webhook.stats()["rejected"] == 1
+
+@pytest.mark.parametrize("body", [b"", b"not json", b"[]", b"{}", b"5", b'"update"', b'{"message": 1}', b'{"message": {}}'])
+def test_malformed_update(webhook, body):
+    assert webhook.receive(f"/{SECRET}", {}, body) == 400
+    assert webhook.stats()["rejected"] == 1
+
+def test_queue_overflow(webhook):
+    # a chat's updates always go to the same worker's queue
+    assert [ webhook.receive(f"/{SECRET}", {}, update(i, 10)) for i in range(3) ] == [200, 200, 503]
+    assert webhook.stats() == {"received": 2, "rejected": 0, "deferred": 1, "queued": 2}
+    assert sum(q.full() for q in webhook.queues) == 1
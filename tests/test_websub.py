@@ -0,0 +1,108 @@
+import hashlib
+import hmac
+import time
+
+import pytest
+
+from fpwrapper import Feed, registry
+from websub import WebSub
+
+TOPIC = "http://example.com/feed"
+
+BODY = (
+    b"<?xml version='1.0' encoding='utf-8'?><rss version='2.0'><channel><title>Pushed feed</title>"
+    b"<item><title>Pushed entry</title><link>http://example.com/pushed</link><guid>pushed-1</guid></item>"
+    b"</channel></rss>"
+)
+
+@pytest.fixture
+def websub():
+    updates = []
+    websub = WebSub(registry, on_update=lambda url, feed: updates.append(url), base_url="http://bot.example.com/websub")
+    websub.updates = updates
+    yield websub
+    websub.stop()
+    registry.websub = None
+
+@pytest.fixture
+def feed(websub):
+    # as restored from persistence, subscribed to its hub but not yet verified
+    feed = Feed.__new__(Feed)
+    feed.__setstate__({
+        "url": TOPIC,
+        "metadata": {"title": "Pushed feed", "link": TOPIC},
+        "hub": "http://hub.example.com/",
+        "topic": TOPIC,
+        "push": {
+            "hub": "http://hub.example.com/",
+            "topic": TOPIC,
+            "id": "callback-id",
+            "secret": "secret",
+            "expires": 0,
+            "requested": time.time(),
+        },
+    })
+    registry.adopt(feed)
+    yield feed
+    registry.feeds.pop(feed.key, None)
+
+def signed(body: bytes, secret: str = "secret", algorithm: str = "sha256"):
+    return {"x-hub-signature": f"{algorithm}={hmac.new(secret.encode('ascii'), body, algorithm).hexdigest()}"}
+
+def test_verify_echoes_challenge(websub, feed):
+    challenge = websub.verify("callback-id", {
+        "hub.mode": "subscribe",
+        "hub.topic": TOPIC,
+        "hub.challenge": "challenge",
+        "hub.lease_seconds": "3600",
+    })
+    assert challenge == "challenge"
+    assert feed.push_active()
+    assert 3500 < feed.push["expires"] - time.time() <= 3600
+
+def test_verify_defaults_lease(websub, feed):
+    assert websub.verify("callback-id", {"hub.mode": "subscribe", "hub.topic": TOPIC, "hub.challenge": "c"}) == "c"
+    assert feed.push["expires"] - time.time() > websub.lease - 60
+
+@pytest.mark.parametrize("callback_id, topic", [
+    ("callback-id", "http://example.com/other"),
+    ("unknown-id", TOPIC),
+])
+def test_verify_refuses_other_subscriptions(websub, feed, callback_id, topic):
+    query = {"hub.mode": "subscribe", "hub.topic": topic, "hub.challenge": "challenge"}
+    assert websub.verify(callback_id, query) is None
+    assert not feed.push_active()
+
+def test_verify_unsubscribe_only_when_released(websub, feed):
+    query = {"hub.mode": "unsubscribe", "hub.topic": TOPIC, "hub.challenge": "challenge"}
+    assert websub.verify("callback-id", query) is None
+    websub.releasing["callback-id"] = TOPIC
+    assert websub.verify("callback-id", query) == "challenge"
+    assert "callback-id" not in websub.releasing
+
+def test_verify_denied(websub, feed):
+    feed.push["expires"] = time.time() + 3600
+    assert websub.verify("callback-id", {"hub.mode": "denied", "hub.topic": TOPIC}) is None
+    assert not feed.push_active()
+
+@pytest.mark.parametrize("algorithm", ["sha1", "sha256", "sha512"])
+def test_deliver_signed(websub, feed, algorithm):
+    websub.deliver("callback-id", BODY, signed(BODY, algorithm=algorithm))
+    assert websub.updates == [feed.key]
+    assert [ entry["id"] for entry in feed.entries_since(0) ] == ["pushed-1"]
+
+@pytest.mark.parametrize("headers", [
+    {},
+    {"x-hub-signature": "sha256"},
+    {"x-hub-signature": "md5=" + hashlib.md5(BODY).hexdigest()},
+    signed(BODY, secret="wrong"),
+    signed(BODY + b" "),
+])
+def test_deliver_rejects_bad_signatures(websub, feed, headers):
+    websub.deliver("callback-id", BODY, headers)
+    assert websub.updates == []
+    assert feed.entries_since(0) == []
+
+def test_deliver_unknown_callback(websub, feed):
+    websub.deliver("unknown-id", BODY, signed(BODY))
+    assert websub.updates == []
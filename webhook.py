@@ -0,0 +1,128 @@
+import hmac
+import json
+import logging
+import queue
+import secrets
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# largest update accepted, in bytes
+MAX_UPDATE_SIZE = 1024 * 1024
+
+class WebhookServer(object):
+    """Receives updates from Telegram on a built-in HTTP listener, as an alternative to Updater.start_polling
+
+    Updates are only accepted on a secret path, and with a matching
+    X-Telegram-Bot-Api-Secret-Token header if Telegram sends one. They are
+    handed to the dispatcher's handlers by a fixed pool of workers, each chat
+    always being served by the same worker so that its updates are handled in
+    order. When a worker's queue is full, Telegram is asked to retry later.
+    """
+    def __init__(self, updater, url: str, port: int = 8443, secret: str = None, workers: int = 4, queue_size: int = 100, max_connections: int = 40):
+        self.updater = updater
+        self.url = url.rstrip("/")
+        self.port = port
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.max_connections = max_connections
+        self.queues = [ queue.Queue(maxsize=queue_size) for i in range(workers) ]
+        self.counters = { "received": 0, "rejected": 0, "deferred": 0 }
+        self.server = None
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(q,), name=f"Webhook_{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        handler = type("Handler", (UpdateHandler,), {"webhook": self})
+        self.server = ThreadingHTTPServer(("", self.port), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="Webhook", daemon=True).start()
+        # the updater is marked as running so that idle() stops it, and
+        # flushes persistence, on a signal as it does when polling
+        self.updater.running = True
+        self.updater.job_queue.start()
+        self.updater.bot.set_webhook(
+            url=f"{self.url}/{self.secret}",
+            max_connections=self.max_connections,
+            allowed_updates=["message"],
+        )
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for q in self.queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["queued"] = sum(q.qsize() for q in self.queues)
+        return stats
+
+    def receive(self, path: str, headers: dict, body: bytes):
+        """Queues an update posted to path, returning the HTTP status to answer with."""
+        token = headers.get("x-telegram-bot-api-secret-token", None)
+        if not hmac.compare_digest(path.strip("/"), self.secret) or (token is not None and not hmac.compare_digest(token, self.secret)):
+            self._count("rejected")
+            return 403
+        try:
+            update = Update.de_json(json.loads(body), self.updater.bot)
+            # de_json returns None for empty objects, and fails on anything
+            # else not shaped like an update
+            chat = update.effective_chat
+        except (ValueError, TypeError, AttributeError, KeyError):
+            self._count("rejected")
+            return 400
+        key = chat.id if chat is not None else update.update_id
+        try:
+            self.queues[zlib.crc32(str(key).encode()) % len(self.queues)].put_nowait(update)
+        except queue.Full:
+            # Telegram redelivers the update after an error
+            self._count("deferred")
+            return 503
+        self._count("received")
+        return 200
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _run(self, q: queue.Queue):
+        dispatcher = self.updater.dispatcher
+        while True:
+            update = q.get()
+            if update is None:
+                return
+            try:
+                dispatcher.process_update(update)
+            except Exception:
+                logger.exception("Error while dispatching update %s", update.update_id)
+
+class UpdateHandler(BaseHTTPRequestHandler):
+    webhook = None
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length > MAX_UPDATE_SIZE:
+            self.send_error(413)
+            return
+        body = self.rfile.read(length)
+        headers = { key.lower(): value for key, value in self.headers.items() }
+        status = self.webhook.receive(self.path, headers, body)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
@@ -0,0 +1,228 @@
+import hashlib
+import hmac
+import logging
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fetcher import MAX_BODY, USER_AGENT
+
+logger = logging.getLogger(__name__)
+
+# lease requested from hubs, and how long before it runs out it is renewed
+LEASE = 10 * 24 * 60 * 60
+RENEW_BEFORE = 24 * 60 * 60
+# how long a hub has to verify a request before it is made again
+VERIFY_TIMEOUT = 60 * 60
+
+# algorithms hubs may sign content with, as named in X-Hub-Signature
+SIGNATURES = ("sha1", "sha256", "sha384", "sha512")
+
+class WebSub(object):
+    """Subscribes feeds which advertise a hub to have their updates pushed, serving the hubs' callbacks over HTTP
+
+    A feed's subscription is kept as plain data in Feed.push, so that it is
+    persisted along with the feed: the hub and topic subscribed to, the
+    callback id and secret, when it was last requested and when its lease
+    expires (0 until the hub has verified it). Feeds are checked after each
+    poll, which subscribes them, renews their leases and moves them between
+    hubs as needed.
+    """
+    def __init__(self, registry, on_update, base_url: str, port: int = 8080, lease: float = LEASE):
+        self.registry = registry
+        self.on_update = on_update
+        self.base_url = base_url.rstrip("/")
+        self.port = port
+        self.lease = lease
+        self.callbacks = {} # callback id -> feed key
+        self.releasing = {} # callback id -> topic being unsubscribed from
+        self.server = None
+        self._executor = futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="WebSub")
+        self._lock = threading.Lock()
+
+        registry.websub = self
+        for feed in list(registry.feeds.values()):
+            self.track(feed)
+
+    def start(self):
+        handler = type("Handler", (CallbackHandler,), {"websub": self})
+        self.server = ThreadingHTTPServer(("", self.port), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="WebSub", daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self._executor.shutdown(wait=True)
+
+    def track(self, feed):
+        """Serves the callback of a feed's subscription, for feeds registered (e.g. restored from persistence) after this was made."""
+        if feed.push is not None:
+            with self._lock:
+                self.callbacks[feed.push["id"]] = feed.key
+
+    def check(self, feed):
+        """Subscribes, renews or unsubscribes a feed as its hub and lease require."""
+        push, now = feed.push, time.time()
+        if not feed.hub:
+            if push is not None:
+                self._submit(self._request, feed, push, "unsubscribe")
+        elif push is None or (push["hub"], push["topic"]) != (feed.hub, feed.topic):
+            if push is not None:
+                self._submit(self._request, feed, push, "unsubscribe")
+            self._submit(self._request, feed, None, "subscribe")
+        elif push["expires"] - now < RENEW_BEFORE and now - push["requested"] > VERIFY_TIMEOUT:
+            # renew the lease, or ask again if the hub never verified it
+            self._submit(self._request, feed, push, "subscribe")
+
+    def release(self, feed):
+        """Unsubscribes a feed no chat follows any more."""
+        if feed.push is not None:
+            self._submit(self._request, feed, feed.push, "unsubscribe")
+
+    def _submit(self, *args):
+        try:
+            self._executor.submit(*args)
+        except RuntimeError:
+            # shut down
+            pass
+
+    def _request(self, feed, push: dict, mode: str):
+        if push is None:
+            push = {
+                "hub": feed.hub,
+                "topic": feed.topic,
+                "id": secrets.token_urlsafe(16),
+                "secret": secrets.token_hex(32),
+                "expires": 0,
+            }
+        with self._lock:
+            if mode == "subscribe":
+                self.callbacks[push["id"]] = feed.key
+                feed.push = dict(push, requested=time.time())
+            else:
+                self.callbacks.pop(push["id"], None)
+                self.releasing[push["id"]] = push["topic"]
+                if feed.push is push:
+                    feed.push = None
+        self._changed(feed)
+        params = {
+            "hub.mode": mode,
+            "hub.topic": push["topic"],
+            "hub.callback": f"{self.base_url}/{push['id']}",
+        }
+        if mode == "subscribe":
+            params["hub.secret"] = push["secret"]
+            params["hub.lease_seconds"] = str(int(self.lease))
+        request = urllib.request.Request(
+            push["hub"],
+            data=urllib.parse.urlencode(params).encode("ascii"),
+            headers={"User-Agent": USER_AGENT},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as r:
+                r.read()
+        except (urllib.error.URLError, OSError) as e:
+            # retried when the feed is next checked
+            logger.warning("Could not %s %s at %s: %s", mode, push["topic"], push["hub"], e)
+
+    def _changed(self, feed):
+        # persisted, and passed on to the process polling the feed, which
+        # polls it less often while it is pushed
+        self.registry.mark_feed(feed.key)
+        if self.registry.scheduler is not None:
+            self.registry.scheduler.update(feed.key, feed)
+
+    def _feed(self, callback_id: str):
+        with self._lock:
+            key = self.callbacks.get(callback_id, None)
+        return self.registry.feeds.get(key, None) if key is not None else None
+
+    def verify(self, callback_id: str, query: dict):
+        """Returns the challenge to answer a hub's verification of intent with, or None to refuse it."""
+        mode = query.get("hub.mode", "")
+        topic = query.get("hub.topic", "")
+        if mode == "unsubscribe":
+            with self._lock:
+                if self.releasing.get(callback_id, None) == topic:
+                    del self.releasing[callback_id]
+                    return query.get("hub.challenge", "")
+            return None
+        feed = self._feed(callback_id)
+        if feed is None or feed.push is None or feed.push["topic"] != topic:
+            return None
+        with feed._lock:
+            if mode == "subscribe":
+                try:
+                    lease = float(query.get("hub.lease_seconds", self.lease))
+                except ValueError:
+                    lease = self.lease
+                feed.push = dict(feed.push, expires=time.time() + lease)
+                self._changed(feed)
+                return query.get("hub.challenge", "")
+            if mode == "denied":
+                logger.warning("%s refused to push %s: %s", feed.push["hub"], topic, query.get("hub.reason", ""))
+                feed.push = dict(feed.push, expires=0)
+                self._changed(feed)
+        return None
+
+    def deliver(self, callback_id: str, body: bytes, headers: dict):
+        """Feeds content pushed by a hub, if correctly signed, into its feed's backlog and on to subscribers."""
+        feed = self._feed(callback_id)
+        if feed is None or feed.push is None:
+            return
+        algorithm, _, signature = headers.get("x-hub-signature", "").partition("=")
+        if algorithm not in SIGNATURES:
+            logger.warning("Ignoring unsigned content pushed for %s", feed.url)
+            return
+        expected = hmac.new(feed.push["secret"].encode("ascii"), body, getattr(hashlib, algorithm)).hexdigest()
+        if not hmac.compare_digest(expected, signature):
+            logger.warning("Ignoring content pushed for %s with a bad signature", feed.url)
+            return
+        try:
+            if feed.push_entries(body, headers):
+                if self.registry.scheduler is not None:
+                    self.registry.scheduler.pushed(feed.key, feed)
+                self.on_update(feed.key, feed)
+        except Exception:
+            logger.exception("Error while processing content pushed for %s", feed.url)
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    websub = None
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        challenge = self.websub.verify(url.path.rpartition("/")[2], query)
+        if challenge is None:
+            self.send_error(404)
+            return
+        body = challenge.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length > MAX_BODY:
+            self.send_error(413)
+            return
+        body = self.rfile.read(length)
+        # content is acknowledged whether or not its signature is valid,
+        # as the hub must not learn which secrets are accepted
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        headers = { key.lower(): value for key, value in self.headers.items() }
+        self.websub.deliver(urllib.parse.urlsplit(self.path).path.rpartition("/")[2], body, headers)